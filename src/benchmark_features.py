@@ -0,0 +1,79 @@
+import os
+import time
+import argparse
+import numpy as np
+from cutouts import load_cutout
+from features import calculate_batch_attributes, calculate_image_attributes
+
+
+def legacy_attributes(img_array):
+    # The per-image extractor that calculate_batch_attributes replaced
+    brightness = np.mean(img_array)
+    contrast = np.std(img_array)
+    h, w = img_array.shape[:2]
+    x = np.random.randint(0, w - 200)
+    y = np.random.randint(0, h - 200)
+    noise = np.std(img_array[y : y + 200, x : x + 200])
+    return brightness, contrast, noise
+
+
+def load_stack(folder, count):
+    image_files = sorted(f for f in os.listdir(folder) if f.endswith(".jpg"))
+    images = [np.asarray(load_cutout(os.path.join(folder, f))) for f in image_files]
+    # Only the most common shape, as the batch path needs a regular stack
+    shapes = [image.shape for image in images]
+    shape = max(set(shapes), key=shapes.count)
+    return np.stack([image for image in images if image.shape == shape][:count])
+
+
+def best_time(function, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time batched feature extraction against the per-image path"
+    )
+    parser.add_argument("folder", nargs="?", help="Cutouts to use, else synthetic")
+    parser.add_argument("--count", type=int, default=256)
+    parser.add_argument("--batch", type=int, default=64)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.folder:
+        stack = load_stack(args.folder, args.count)
+    else:
+        rng = np.random.default_rng(0)
+        stack = rng.normal(100, 10, (args.count, 500, 500, 3))
+        stack = stack.clip(0, 255).astype(np.uint8)
+    print(f"{len(stack)} images of shape {stack.shape[1:]}")
+
+    def batched():
+        for start in range(0, len(stack), args.batch):
+            calculate_batch_attributes(stack[start : start + args.batch])
+
+    timings = {
+        "legacy per-image": lambda: [legacy_attributes(image) for image in stack],
+        "per-image": lambda: [calculate_image_attributes(image) for image in stack],
+        f"batched ({args.batch})": batched,
+    }
+    for name, function in timings.items():
+        seconds = best_time(function, args.repeat)
+        print(f"{name:>20}: {seconds / len(stack) * 1000:.2f} ms/image")
+
+    # The legacy noise depends on where its random window lands
+    runs = np.array(
+        [[legacy_attributes(image)[2] for image in stack] for _ in range(2)]
+    )
+    print(
+        f"legacy noise changes between runs by up to {np.ptp(runs, axis=0).max():.2f}"
+    )
+
+
+if __name__ == "__main__":
+    main()
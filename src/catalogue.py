@@ -0,0 +1,202 @@
+import io
+import os
+import glob
+import tarfile
+import requests
+import numpy as np
+import astropy.units as u
+from astropy.coordinates import SkyCoord
+
+catalogue_folder = "cache"
+catalogue_url = (
+    "https://www.atnf.csiro.au/research/pulsar/psrcat/downloads/psrcat_pkg.tar.gz"
+)
+
+_catalogue = None
+
+
+def _sexagesimal_to_degrees(value, scale):
+    sign = -1 if value.startswith("-") else 1
+    parts = [float(part) for part in value.lstrip("+-").split(":")]
+    degrees = sum(part / 60**i for i, part in enumerate(parts))
+    return sign * degrees * scale
+
+
+def _parse_error(value, error):
+    try:
+        uncertainty = float(error)
+    except ValueError:
+        return np.nan
+    # Older databases quote the uncertainty in units of the last digit
+    if not any(c in error for c in ".eE"):
+        decimals = len(value.split(".")[1]) if "." in value else 0
+        uncertainty *= 10.0**-decimals
+    return uncertainty
+
+
+def parse_database(text):
+    version = "unknown"
+    entries = []
+    entry = {}
+    for line in text.splitlines():
+        if line.startswith("#CATALOGUE"):
+            version = line.split()[1]
+            continue
+        if line.startswith("@"):
+            if "PSRJ" in entry:
+                entries.append(entry)
+            entry = {}
+            continue
+        if not line.strip() or line.startswith("#"):
+            continue
+        tokens = line.split()
+        if len(tokens) >= 2:
+            entry[tokens[0]] = tokens[1:]
+    if "PSRJ" in entry:
+        entries.append(entry)
+
+    entries.sort(key=lambda entry: entry["PSRJ"][0])
+    count = len(entries)
+    columns = {
+        "name": np.array([e["PSRJ"][0] for e in entries], dtype="U16"),
+        "bname": np.array([e.get("PSRB", [""])[0] for e in entries], dtype="U16"),
+        "ra": np.full(count, np.nan),
+        "dec": np.full(count, np.nan),
+        "ra_error": np.full(count, np.nan),
+        "dec_error": np.full(count, np.nan),
+        "date": np.full(count, np.nan),
+    }
+    for i, entry in enumerate(entries):
+        if "RAJ" in entry and "DECJ" in entry:
+            raj, decj = entry["RAJ"], entry["DECJ"]
+            columns["ra"][i] = _sexagesimal_to_degrees(raj[0], 15)
+            columns["dec"][i] = _sexagesimal_to_degrees(decj[0], 1)
+            # Both errors are stored in arcseconds on the sky
+            if len(raj) > 1:
+                columns["ra_error"][i] = (
+                    _parse_error(raj[0], raj[1])
+                    * 15
+                    * np.cos(np.radians(columns["dec"][i]))
+                )
+            if len(decj) > 1:
+                columns["dec_error"][i] = _parse_error(decj[0], decj[1])
+        if "DATE" in entry:
+            try:
+                columns["date"][i] = float(entry["DATE"][0])
+            except ValueError:
+                pass
+
+    known = ~np.isnan(columns["ra"])
+    galactic = SkyCoord(
+        ra=columns["ra"][known] * u.deg, dec=columns["dec"][known] * u.deg
+    ).galactic
+    columns["gl"] = np.full(count, np.nan)
+    columns["gb"] = np.full(count, np.nan)
+    columns["gl"][known] = galactic.l.deg
+    columns["gb"][known] = galactic.b.deg
+
+    return Catalogue(columns, version)
+
+
+class Catalogue:
+    def __init__(self, columns, version):
+        self.version = version
+        self.columns = columns
+        self.name = columns["name"]
+        self.bname = columns["bname"]
+        self.ra = columns["ra"]
+        self.dec = columns["dec"]
+        self.gl = columns["gl"]
+        self.gb = columns["gb"]
+        self.date = columns["date"]
+        self.ra_error = columns["ra_error"]
+        self.dec_error = columns["dec_error"]
+        self.index = {name: i for i, name in enumerate(self.name)}
+
+    def __len__(self):
+        return len(self.name)
+
+    def mask(self, options):
+        # Mirrors the psrcat web conditions; NaN (missing) never passes a bound
+        bounds = [
+            ("max_dec", self.dec, np.less),
+            ("min_dec", self.dec, np.greater),
+            ("max_gb", self.gb, np.less),
+            ("min_gb", self.gb, np.greater),
+            ("min_year", self.date, np.greater),
+            ("max_error", self.dec_error, np.less),
+        ]
+        mask = np.ones(len(self), dtype=bool)
+        for key, column, compare in bounds:
+            value = options.get(key)
+            if value is not None and value != "":
+                mask &= compare(column, float(value))
+
+        pulsar_name = options.get("pulsar_name")
+        if pulsar_name:
+            pulsar_name = pulsar_name.replace("−", "-").replace("PSR", "").strip()
+            mask &= (self.name == pulsar_name) | (self.bname == pulsar_name)
+        return mask
+
+    def query(self, options):
+        return self.name[self.mask(options)].tolist()
+
+    def coordinates(self, names):
+        coordinates = {}
+        for name in names:
+            i = self.index.get(name)
+            if i is not None and not np.isnan(self.ra[i]):
+                coordinates[name] = {
+                    "RA": float(self.ra[i]),
+                    "DEC": float(self.dec[i]),
+                    "GLON": float(self.gl[i]),
+                    "GLAT": float(self.gb[i]),
+                }
+        return coordinates
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path + ".tmp", "wb") as f:
+            np.savez(f, version=self.version, **self.columns)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            columns = {key: data[key] for key in data.files if key != "version"}
+            return cls(columns, str(data["version"]))
+
+
+def snapshot_path(version):
+    return os.path.join(catalogue_folder, f"psrcat_{version}.npz")
+
+
+def _version_key(path):
+    version = os.path.basename(path)[len("psrcat_") : -len(".npz")]
+    return [int(part) if part.isdigit() else 0 for part in version.split(".")]
+
+
+def download_catalogue(session=None):
+    response = (session or requests).get(catalogue_url)
+    response.raise_for_status()
+    with tarfile.open(fileobj=io.BytesIO(response.content)) as tar:
+        member = next(m for m in tar.getmembers() if m.name.endswith("psrcat.db"))
+        text = tar.extractfile(member).read().decode("utf-8", "replace")
+    catalogue = parse_database(text)
+    catalogue.save(snapshot_path(catalogue.version))
+    return catalogue
+
+
+def load_catalogue(session=None, refresh=False):
+    global _catalogue
+    if _catalogue is not None and not refresh:
+        return _catalogue
+
+    snapshots = sorted(
+        glob.glob(os.path.join(catalogue_folder, "psrcat_*.npz")), key=_version_key
+    )
+    if snapshots and not refresh:
+        _catalogue = Catalogue.load(snapshots[-1])
+    else:
+        _catalogue = download_catalogue(session)
+    return _catalogue
@@ -0,0 +1,105 @@
+import os
+import argparse
+import numpy as np
+from PIL import Image
+from cutouts import display_stretch
+
+model_path = "pulsar_bow_shock_classifier.h5"
+tflite_path = "pulsar_bow_shock_classifier.tflite"
+
+# Must match the image size create_model is trained with in train.py
+image_size = 64
+batch_size = 64
+
+
+def preprocess(img_array):
+    # The same input train.py feeds the model: 64x64 RGB scaled to [0, 1],
+    # resized with nearest neighbour like Keras' flow_from_directory
+    image = display_stretch(np.asarray(img_array))
+    if image.ndim == 2:
+        image = np.repeat(image[..., None], 3, axis=2)
+    image = Image.fromarray(image[..., :3]).resize(
+        (image_size, image_size), Image.NEAREST
+    )
+    return np.asarray(image, dtype=np.float32) / 255
+
+
+class Classifier:
+    # Prefers the quantized TFLite export when there is one, as it is much
+    # lighter to load and run on a CPU than the Keras model
+    def __init__(self, path=None, batch_size=batch_size):
+        self.batch_size = batch_size
+        if path is None:
+            path = tflite_path if os.path.exists(tflite_path) else model_path
+        if path.endswith(".tflite"):
+            self.run_batch = self.load_tflite(path)
+        else:
+            self.run_batch = self.load_keras(path)
+
+    def load_tflite(self, path):
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            import tensorflow as tf
+
+            Interpreter = tf.lite.Interpreter
+
+        interpreter = Interpreter(model_path=path, num_threads=os.cpu_count())
+        input_index = interpreter.get_input_details()[0]["index"]
+        output_index = interpreter.get_output_details()[0]["index"]
+        interpreter.resize_tensor_input(
+            input_index, (self.batch_size, image_size, image_size, 3)
+        )
+        interpreter.allocate_tensors()
+
+        def run_batch(batch):
+            interpreter.set_tensor(input_index, batch)
+            interpreter.invoke()
+            return interpreter.get_tensor(output_index)
+
+        return run_batch
+
+    def load_keras(self, path):
+        import tensorflow as tf
+
+        model = tf.keras.models.load_model(path)
+        return lambda batch: model.predict_on_batch(batch)
+
+    def score(self, images):
+        # Fixed-size batches, with the last one padded, so the graph is
+        # only ever built for one input shape
+        probabilities = []
+        for start in range(0, len(images), self.batch_size):
+            batch = np.stack(
+                [preprocess(img) for img in images[start : start + self.batch_size]]
+            )
+            count = len(batch)
+            if count < self.batch_size:
+                padding = np.zeros(
+                    (self.batch_size - count,) + batch.shape[1:], batch.dtype
+                )
+                batch = np.concatenate([batch, padding])
+            probabilities.extend(np.ravel(self.run_batch(batch))[:count])
+        return [float(probability) for probability in probabilities]
+
+
+def export_tflite(path=model_path, output=tflite_path):
+    import tensorflow as tf
+
+    model = tf.keras.models.load_model(path)
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    # Dynamic-range quantization: int8 weights, float activations
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    with open(output, "wb") as f:
+        f.write(converter.convert())
+    print(f"Exported {path} to {output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Export the bow shock classifier for fast CPU inference"
+    )
+    parser.add_argument("--model", default=model_path)
+    parser.add_argument("--output", default=tflite_path)
+    args = parser.parse_args()
+    export_tflite(args.model, args.output)
@@ -0,0 +1,225 @@
+import os
+import argparse
+import numpy as np
+from cutouts import load_cutout, save_cutout
+from packstore import PackedStore, loose_files
+from pulsars import image_filename, image_folder
+
+# Narrow-band survey -> the broad band whose continuum it sits on
+continuum_pairs = {
+    "CDS/P/VPHAS/DR4/Halpha": "CDS/P/VPHAS/DR4/r",
+    "CDS/P/IPHAS/DR2/halpha": "CDS/P/IPHAS/DR2/r",
+}
+
+# Approximate filter widths in Angstrom, only meaningful for flux cutouts
+bandwidths = {
+    "CDS/P/VPHAS/DR4/Halpha": 107.0,
+    "CDS/P/VPHAS/DR4/r": 1380.0,
+    "CDS/P/IPHAS/DR2/halpha": 95.0,
+    "CDS/P/IPHAS/DR2/r": 1385.0,
+}
+
+# A known H-alpha bow shock, to calibrate the scale the rest are subtracted with
+reference_pulsar = "J2030+4415"
+
+methods = ("fit", "bandwidth", "reference")
+chunk_size = 256
+clip_sigma = 3
+clip_iterations = 3
+
+
+def subtracted_survey(survey):
+    return survey.rstrip("/") + "/subtracted"
+
+
+def greyscale(data):
+    data = np.asarray(data, dtype=np.float32)
+    return data.mean(axis=-1) if data.ndim == 3 else data
+
+
+def fit_continuum(narrow, broad, scale=None):
+    # Least-squares fit of narrow = scale * broad + offset for every cutout in
+    # the (N, H, W) stacks at once, sigma-clipping line emission and stars
+    # that differ between the bands out of the fit. A given scale is kept
+    # and only the offsets are fitted
+    count = len(narrow)
+    narrow = narrow.reshape(count, -1)
+    broad = broad.reshape(count, -1)
+    valid = np.isfinite(narrow) & np.isfinite(broad)
+    # Centred first, so the float32 sums below don't cancel on a bright sky
+    pixels = np.maximum(valid.sum(axis=1), 1)
+    narrow_zero = np.where(valid, narrow, 0).sum(axis=1, dtype=np.float64) / pixels
+    broad_zero = np.where(valid, broad, 0).sum(axis=1, dtype=np.float64) / pixels
+    narrow = np.where(valid, narrow - narrow_zero[:, None].astype(np.float32), 0)
+    broad = np.where(valid, broad - broad_zero[:, None].astype(np.float32), 0)
+    fixed = scale is not None
+    if fixed:
+        scale = np.full(count, scale, dtype=np.float32)
+
+    # Weighted sums as row-wise dot products, with no (N, H * W) temporaries
+    # beyond the weighted broad band and the residual
+    weights = valid.astype(np.float32)
+    for _ in range(clip_iterations):
+        total = np.maximum(weights.sum(axis=1), 1)
+        weighted_broad = weights * broad
+        narrow_mean = np.einsum("ij,ij->i", weights, narrow) / total
+        broad_mean = weighted_broad.sum(axis=1) / total
+        if not fixed:
+            covariance = (
+                np.einsum("ij,ij->i", weighted_broad, narrow)
+                - total * narrow_mean * broad_mean
+            )
+            variance = (
+                np.einsum("ij,ij->i", weighted_broad, broad) - total * broad_mean**2
+            )
+            scale = np.where(variance > 0, covariance / np.maximum(variance, 1e-12), 0)
+        offset = narrow_mean - scale * broad_mean
+
+        residual = narrow - scale[:, None].astype(np.float32) * broad
+        residual -= offset[:, None].astype(np.float32)
+        sigma = np.sqrt(np.einsum("ij,ij->i", weights * residual, residual) / total)
+        weights = (valid & (np.abs(residual) <= clip_sigma * sigma[:, None])).astype(
+            np.float32
+        )
+    offset += narrow_zero - scale * broad_zero
+    return scale.astype(np.float32), offset.astype(np.float32)
+
+
+def subtract(narrow, broad, scale=None):
+    scale, offset = fit_continuum(narrow, broad, scale)
+    return narrow - scale[:, None, None] * broad - offset[:, None, None]
+
+
+def find_images(folder=image_folder, store=None):
+    # {(pulsar, survey, fov): source}, with the same sources the sorter uses:
+    # store keys when there is a packed store, filenames otherwise
+    if store is not None:
+        return {key: key for key in store.keys()}
+    return loose_files(folder)
+
+
+class ContinuumSubtractor:
+    def __init__(self, folder=image_folder, store=None):
+        self.folder = folder
+        self.store = store
+        self.images = find_images(folder, store)
+
+    def load(self, source):
+        if self.store is not None:
+            return self.store.get(*source)
+        return load_cutout(os.path.join(self.folder, source))
+
+    def stamp(self, source):
+        if self.store is not None:
+            return self.store.stamps.get(source, 0)
+        return os.stat(os.path.join(self.folder, source)).st_mtime_ns
+
+    def save(self, pulsar, survey, fov, data):
+        if self.store is not None:
+            self.store.put(pulsar, survey, fov, data)
+        else:
+            path = os.path.join(
+                self.folder, image_filename(pulsar, survey, "fits", fov)
+            )
+            save_cutout(path, data)
+
+    def pairs(self, narrow, broad, force=False):
+        # (pulsar, fov, narrow source, broad source) for every field with both
+        # bands whose subtracted cutout is missing or older than its inputs
+        output = subtracted_survey(narrow)
+        pairs = []
+        for (pulsar, survey, fov), source in self.images.items():
+            broad_source = self.images.get((pulsar, broad, fov))
+            if survey != narrow or broad_source is None:
+                continue
+            output_source = self.images.get((pulsar, output, fov))
+            if (
+                not force
+                and output_source is not None
+                and self.stamp(output_source)
+                >= max(self.stamp(source), self.stamp(broad_source))
+            ):
+                continue
+            pairs.append((pulsar, fov, source, broad_source))
+        return pairs
+
+    def reference_scale(self, narrow, broad):
+        for (pulsar, survey, fov), source in self.images.items():
+            if pulsar == reference_pulsar and survey == narrow:
+                broad_source = self.images.get((pulsar, broad, fov))
+                if broad_source is not None:
+                    scale, _ = fit_continuum(
+                        greyscale(self.load(source))[None],
+                        greyscale(self.load(broad_source))[None],
+                    )
+                    return float(scale[0])
+        return None
+
+    def run(self, method="fit", force=False):
+        subtracted = 0
+        for narrow, broad in continuum_pairs.items():
+            pairs = self.pairs(narrow, broad, force)
+            if not pairs:
+                continue
+
+            scale = None
+            if method == "bandwidth":
+                scale = bandwidths[narrow] / bandwidths[broad]
+            elif method == "reference":
+                scale = self.reference_scale(narrow, broad)
+                if scale is None:
+                    print(f"No {reference_pulsar} reference for {narrow}, fitting")
+            if scale is not None:
+                print(f"Subtracting {scale:.4f} x {broad} from {narrow}")
+
+            # Stacks of matching shape, a chunk at a time to bound memory
+            stacks = {}
+            for pair in pairs:
+                narrow_data = greyscale(self.load(pair[2]))
+                broad_data = greyscale(self.load(pair[3]))
+                if narrow_data.shape != broad_data.shape:
+                    print(f"Skipping {pair[0]}: {narrow} and {broad} differ in size")
+                    continue
+                stack = stacks.setdefault(narrow_data.shape, ([], [], []))
+                stack[0].append(pair)
+                stack[1].append(narrow_data)
+                stack[2].append(broad_data)
+                if len(stack[0]) == chunk_size:
+                    subtracted += self.write(
+                        narrow, *stacks.pop(narrow_data.shape), scale
+                    )
+            for stack in stacks.values():
+                subtracted += self.write(narrow, *stack, scale)
+
+        if self.store is not None:
+            self.store.flush()
+        return subtracted
+
+    def write(self, narrow, pairs, narrow_data, broad_data, scale):
+        results = subtract(np.stack(narrow_data), np.stack(broad_data), scale)
+        for (pulsar, fov, _, _), data in zip(pairs, results):
+            self.save(pulsar, subtracted_survey(narrow), fov, data)
+        return len(pairs)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Subtract the broad-band continuum from every narrow-band cutout"
+    )
+    parser.add_argument("folder", nargs="?", default=image_folder)
+    parser.add_argument(
+        "--method",
+        choices=methods,
+        default="fit",
+        help="Fit the scale per cutout, use the filter bandwidth ratio, or fit "
+        f"it once on {reference_pulsar}",
+    )
+    parser.add_argument(
+        "--force", action="store_true", help="Redo cutouts that are up to date"
+    )
+    args = parser.parse_args()
+
+    packed = os.path.join(args.folder, "packed")
+    store = PackedStore(packed) if PackedStore.exists(packed) else None
+    subtractor = ContinuumSubtractor(args.folder, store)
+    print(f"Subtracted {subtractor.run(args.method, args.force)} cutouts")
@@ -0,0 +1,48 @@
+import os
+import io
+import numpy as np
+from PIL import Image
+from astropy.io import fits
+
+image_extensions = (".npy", ".jpg")
+
+
+def fits_to_array(content):
+    with fits.open(io.BytesIO(content)) as hdul:
+        data = np.asarray(hdul[0].data, dtype=np.float32)
+    # FITS rows run south to north, JPEG cutouts north to south
+    return np.ascontiguousarray(np.flipud(data))
+
+
+def save_cutout(path, data):
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as f:
+        np.save(f, np.asarray(data, dtype=np.float32))
+    os.replace(temp_path, path)
+
+
+def load_cutout(path):
+    # Flux cutouts are memory-mapped, so slicing them never copies
+    if path.endswith(".npy"):
+        return np.load(path, mmap_mode="r")
+    return np.asarray(Image.open(path))
+
+
+def is_blank(data):
+    if data.dtype.kind == "f":
+        finite = data[np.isfinite(data)]
+        return finite.size == 0 or finite.min() == finite.max()
+    return bool(np.all(data == 255))
+
+
+def display_stretch(data, low=0.5, high=99.5):
+    if data.dtype == np.uint8:
+        return data
+    vmin, vmax = np.nanpercentile(data, [low, high])
+    scale = 255.0 / (vmax - vmin) if vmax > vmin else 0.0
+    stretched = (np.nan_to_num(data, nan=vmin) - vmin) * scale
+    return np.clip(stretched, 0, 255).astype(np.uint8)
+
+
+def to_image(data):
+    return Image.fromarray(display_stretch(data)).convert("RGB")
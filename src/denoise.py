@@ -0,0 +1,142 @@
+import os
+import argparse
+import multiprocessing
+import concurrent.futures
+import cv2
+import numpy as np
+from PIL import Image
+from cutouts import display_stretch
+from features import load_source
+from packstore import PackedStore, loose_files
+from pulsars import image_filename, image_folder
+
+# cv2.fastNlMeansDenoising's filter strength and window sizes in pixels
+denoise_params = {"h": 10, "template_window": 7, "search_window": 21}
+
+
+def denoised_survey(survey):
+    return survey.rstrip("/") + "/denoised"
+
+
+def denoise_array(img_array, h=10, template_window=7, search_window=21):
+    # Greyscale surveys stay greyscale and colour ones keep their colour.
+    # Flux is stretched to 8 bits first, as the filter only takes uint8
+    data = display_stretch(np.asarray(img_array))
+    if data.ndim == 3 and data.shape[-1] > 3:
+        data = data[..., :3]
+    if data.ndim == 3 and not (
+        np.array_equal(data[..., 0], data[..., 1])
+        and np.array_equal(data[..., 0], data[..., 2])
+    ):
+        return cv2.fastNlMeansDenoisingColored(
+            np.ascontiguousarray(data), None, h, h, template_window, search_window
+        )
+    grey = np.ascontiguousarray(data[..., 0] if data.ndim == 3 else data)
+    denoised = cv2.fastNlMeansDenoising(grey, None, h, template_window, search_window)
+    if data.ndim == 3:
+        return np.repeat(denoised[..., None], 3, axis=2)
+    return denoised
+
+
+def denoise_source(source, store_folder=None, params=None):
+    # Runs in a worker process, so it loads its own copy of the cutout
+    return denoise_array(load_source(source, store_folder), **(params or {}))
+
+
+def find_sources(folder=image_folder, store=None):
+    # {(pulsar, survey, fov): (source, stamp)}, skipping derived surveys
+    if store is not None:
+        return {
+            key: (key, store.stamps.get(key, 0))
+            for key in store.keys()
+            if not key[1].endswith("/denoised")
+        }
+    sources = {}
+    for key, image_file in loose_files(folder).items():
+        if key[1].endswith("/denoised"):
+            continue
+        path = os.path.join(folder, image_file)
+        sources[key] = (path, os.stat(path).st_mtime_ns)
+    return sources
+
+
+def denoise_all(
+    folder=image_folder, store=None, params=None, workers=None, force=False
+):
+    # Every cutout denoised in parallel into a '<survey>/denoised' survey,
+    # which the sorter loads and scores like any other
+    params = params or denoise_params
+    sources = find_sources(folder, store)
+    jobs = []
+    for (pulsar, survey, fov), (source, stamp) in sources.items():
+        output = denoised_survey(survey)
+        if not force:
+            if store is not None:
+                key = (pulsar, output, fov)
+                if key in store and store.stamps.get(key, 0) >= stamp:
+                    continue
+            else:
+                path = os.path.join(folder, image_filename(pulsar, output, fov=fov))
+                if os.path.exists(path) and os.stat(path).st_mtime_ns >= stamp:
+                    continue
+        jobs.append((pulsar, output, fov, source))
+
+    store_folder = store.folder if store is not None else None
+    denoised = 0
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        futures = {
+            executor.submit(denoise_source, source, store_folder, params): (
+                pulsar,
+                output,
+                fov,
+            )
+            for pulsar, output, fov, source in jobs
+        }
+        for future in concurrent.futures.as_completed(futures):
+            pulsar, output, fov = futures[future]
+            try:
+                data = future.result()
+            except Exception as e:
+                print(f"Failed to denoise {pulsar} {output}: {e}")
+                continue
+            if store is not None:
+                store.put(pulsar, output, fov, data)
+            else:
+                path = os.path.join(folder, image_filename(pulsar, output, fov=fov))
+                Image.fromarray(data).save(path + ".tmp", "JPEG", quality=95)
+                os.replace(path + ".tmp", path)
+            denoised += 1
+
+    if store is not None:
+        store.flush()
+    return denoised
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    parser = argparse.ArgumentParser(
+        description="Denoise every cutout into a derived '<survey>/denoised' survey"
+    )
+    parser.add_argument("folder", nargs="?", default=image_folder)
+    parser.add_argument("--h", type=float, default=denoise_params["h"])
+    parser.add_argument(
+        "--template-window", type=int, default=denoise_params["template_window"]
+    )
+    parser.add_argument(
+        "--search-window", type=int, default=denoise_params["search_window"]
+    )
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument(
+        "--force", action="store_true", help="Redo cutouts that are up to date"
+    )
+    args = parser.parse_args()
+
+    packed = os.path.join(args.folder, "packed")
+    store = PackedStore(packed) if PackedStore.exists(packed) else None
+    params = {
+        "h": args.h,
+        "template_window": args.template_window,
+        "search_window": args.search_window,
+    }
+    count = denoise_all(args.folder, store, params, args.workers, args.force)
+    print(f"Denoised {count} cutouts")
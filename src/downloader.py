@@ -0,0 +1,204 @@
+import os
+import threading
+import concurrent.futures
+import requests
+from requests.adapters import HTTPAdapter
+from skycoverage import load_coverage
+from manifest import DownloadManifest
+from packstore import PackedStore
+from pulsars import image_folder, list_pulsars, resolve_pulsars, save_pulsar
+
+survey_options = {
+    "All": "CDS/P/VPHAS/DR4/Halpha,CDS/P/VPHAS/DR4/Halpha+,CDS/P/IPHAS/DR2/halpha,CDS/P/SHS/,CDS/P/allWISE/W3,CDS/P/allWISE/W4",
+    "VPHAS": "CDS/P/VPHAS/DR4/Halpha",
+    "All VPHAS": "CDS/P/VPHAS/DR4/Halpha,CDS/P/VPHAS/DR4/i,CDS/P/VPHAS/DR4/r",
+    "IPHAS": "CDS/P/IPHAS/DR2/halpha",
+    "All IPHAS": "CDS/P/IPHAS/DR2/halpha,CDS/P/IPHAS/DR2/i,CDS/P/IPHAS/DR2/r",
+    "SHS": "CDS/P/SHS",
+    "WISE 12um": "CDS/P/allWISE/W3",
+    "WISE 22um": "CDS/P/allWISE/W4",
+}
+
+# Maximum number of requests in flight to each service at once
+service_limits = {
+    "simbad": 2,
+    "atnf": 1,
+    "hips2fits": 8,
+}
+
+
+class DownloadEngine:
+    def __init__(self, limits=None, batch_size=200, backend="hips2fits"):
+        self.limits = {**service_limits, **(limits or {})}
+        self.backend = backend
+        self.batch_size = batch_size
+        self.semaphores = {
+            service: threading.BoundedSemaphore(limit)
+            for service, limit in self.limits.items()
+        }
+        self.stopped = threading.Event()
+        packed = os.path.join(image_folder, "packed")
+        self.store = PackedStore(packed) if PackedStore.exists(packed) else None
+
+        # One keep-alive pool shared by every worker
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=len(self.limits),
+            pool_maxsize=max(self.limits.values()),
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def stop(self):
+        self.stopped.set()
+
+    def close(self):
+        if self.store is not None:
+            self.store.flush()
+        self.session.close()
+
+    def list_pulsars(self, options):
+        with self.semaphores["atnf"]:
+            return list_pulsars(options, session=self.session)
+
+    def resolve(self, pulsars):
+        batches = [
+            pulsars[start : start + self.batch_size]
+            for start in range(0, len(pulsars), self.batch_size)
+        ]
+
+        def resolve_batch(batch):
+            with self.semaphores["simbad"]:
+                if self.stopped.is_set():
+                    return {}
+                return resolve_pulsars(batch, self.batch_size)
+
+        coordinates = {}
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.limits["simbad"]
+        ) as executor:
+            for resolved in executor.map(resolve_batch, batches):
+                coordinates.update(resolved)
+        return coordinates
+
+    def prune(self, jobs, coordinates, fov, manifest=None):
+        fov_degrees = float(fov) / 60
+        fractions = {}
+        for survey in dict.fromkeys(survey for _, survey in jobs):
+            footprint = load_coverage(survey, self.session)
+            pulsars = [p for p, s in jobs if s == survey and p in coordinates]
+            if footprint is None or not pulsars:
+                continue
+            ra = [coordinates[pulsar]["RA"] for pulsar in pulsars]
+            dec = [coordinates[pulsar]["DEC"] for pulsar in pulsars]
+            for pulsar, fraction in zip(
+                pulsars, footprint.fraction(ra, dec, fov_degrees)
+            ):
+                fractions[(pulsar, survey)] = float(fraction)
+
+        kept = []
+        for pulsar, survey in jobs:
+            if fractions.get((pulsar, survey)) == 0:
+                if manifest is not None:
+                    manifest.record(pulsar, survey, fov, "outside", coverage=0.0)
+                continue
+            kept.append((pulsar, survey))
+        return kept, fractions
+
+    def download(
+        self,
+        pulsars,
+        surveys,
+        fov=1,
+        coordinates=None,
+        progress=None,
+        resume=True,
+        prune=True,
+        image_format="jpg",
+    ):
+        surveys = [survey.strip() for survey in surveys]
+        manifest = DownloadManifest(image_folder) if resume else None
+
+        jobs = [(pulsar, survey) for pulsar in pulsars for survey in surveys]
+        total = len(jobs)
+        if manifest is not None:
+            extension = ".npy" if image_format == "fits" else ".jpg"
+            jobs = [job for job in jobs if manifest.needs_fetch(*job, fov, extension)]
+
+        if coordinates is None:
+            coordinates = self.resolve(list(dict.fromkeys(p for p, _ in jobs)))
+
+        # Skip pairs outside each survey's footprint before requesting anything
+        fractions = {}
+        if prune:
+            jobs, fractions = self.prune(jobs, coordinates, fov, manifest)
+
+        completed = total - len(jobs)
+        if progress is not None and completed:
+            progress(completed, total)
+
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.limits["hips2fits"]
+        ) as executor:
+            futures = [
+                executor.submit(
+                    self.fetch,
+                    pulsar,
+                    survey,
+                    fov,
+                    coordinates.get(pulsar),
+                    manifest,
+                    fractions.get((pulsar, survey)),
+                    image_format,
+                )
+                for pulsar, survey in jobs
+            ]
+            for future in concurrent.futures.as_completed(futures):
+                if self.stopped.is_set():
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    break
+                completed += 1
+                if progress is not None:
+                    progress(completed, total)
+
+        if manifest is not None:
+            manifest.compact()
+        if self.store is not None:
+            self.store.flush()
+        return completed, total
+
+    def fetch(
+        self,
+        pulsar,
+        survey,
+        fov,
+        coordinates,
+        manifest=None,
+        coverage=None,
+        image_format="jpg",
+    ):
+        if self.stopped.is_set():
+            return
+        if coordinates is None:
+            print(f"Skipping {pulsar}: coordinates not found")
+            return
+        with self.semaphores["hips2fits"]:
+            print(f"Downloading {pulsar} for survey {survey}")
+            return save_pulsar(
+                pulsar,
+                survey,
+                fov,
+                coordinates,
+                session=self.session,
+                manifest=manifest,
+                coverage=coverage,
+                image_format=image_format,
+                backend=self.backend,
+                store=self.store,
+            )
+
+    def run(self, options, surveys, fov=1, progress=None, image_format="jpg"):
+        pulsars = self.list_pulsars(options)
+        return self.download(
+            pulsars, surveys, fov, progress=progress, image_format=image_format
+        )
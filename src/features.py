@@ -0,0 +1,304 @@
+import collections
+import numpy as np
+from PIL import Image
+from cutouts import is_blank, load_cutout
+from packstore import PackedStore
+
+# Bump a feature's version whenever its definition changes, so values kept
+# in the feature store are recomputed for that column only
+feature_versions = {
+    "brightness": 2,
+    "contrast": 2,
+    "noise": 2,
+    "window_noise": 1,
+    "background": 1,
+    "centre_contrast": 1,
+    "num_circles": 1,
+    "bow_shock": 1,  # Bump after retraining the classifier
+    "stage": 1,
+}
+
+# Features that are too slow to score for every image up front
+lazy_features = ("num_circles", "bow_shock")
+eager_features = [name for name in feature_versions if name not in lazy_features]
+feature_dtype = np.dtype(
+    [(name, np.float32) for name in eager_features if name != "stage"]
+)
+
+# First stage of the scoring cascade: cutouts are previewed at
+# 1/preview_scale and rejected when the preview is saturated (mean at or
+# above "brightness") or featureless (range below "contrast"). Bump the
+# "stage" version after changing these so stored results are redone.
+preview_scale = 8
+cascade_thresholds = {"brightness": 254.0, "contrast": 2.0}
+
+# Robust statistics use every other pixel in each direction
+sample_step = 2
+clip_sigma = 3
+clip_iterations = 3
+
+# Smart Sort's noise tier was tuned on the spread of a random 200px window,
+# so that spread is kept for ranking, averaged over a fixed grid of window
+# placements instead of one random one. Every fourth pixel is enough there
+noise_window = 200
+noise_window_grid = 3
+noise_window_step = 4
+
+# Bow-shock search radii as fractions of the cutout's smaller side, the
+# shortest arc (radians) that counts, and its brightness in noise units
+arc_radii = (0.04, 0.45)
+arc_extent = np.pi / 3
+arc_threshold = 2.5
+
+# One store per worker process, reused across chunks
+_stores = {}
+
+
+def _sorted_median(ordered, start, stop):
+    # Median of ordered[i, start[i]:stop[i]] for every row at once
+    start = np.broadcast_to(start, stop.shape)
+    last = ordered.shape[1] - 1
+    lower = np.clip(start + (stop - start - 1) // 2, 0, last)[:, None]
+    upper = np.clip(start + (stop - start) // 2, 0, last)[:, None]
+    median = (
+        np.take_along_axis(ordered, lower, 1) + np.take_along_axis(ordered, upper, 1)
+    )[:, 0] / 2
+    return np.where(stop > start, median, np.nan)
+
+
+def _sorted_search(ordered, count, values, side="left"):
+    # np.searchsorted(ordered[i, :count[i]], values[i], side) for every row,
+    # as one bisection over all the rows at once
+    rows = np.arange(len(ordered))
+    low = np.zeros(len(ordered), dtype=np.intp)
+    high = count.astype(np.intp)
+    while True:
+        active = low < high
+        if not active.any():
+            return low
+        middle = (low + high) // 2
+        pixel = ordered[rows, np.minimum(middle, ordered.shape[1] - 1)]
+        right = pixel < values if side == "left" else pixel <= values
+        low = np.where(active & right, middle + 1, low)
+        high = np.where(active & ~right, middle, high)
+
+
+def calculate_batch_attributes(stack):
+    # One vectorized pass over a stack of same-shaped cutouts, (N, H, W) or
+    # (N, H, W, C). Flux cutouts can contain blank (NaN) pixels.
+    stack = np.asarray(stack)
+    n, h, w = stack.shape[:3]
+    attributes = np.zeros(n, dtype=feature_dtype)
+
+    # Greyscale of every other pixel, which is plenty for every statistic
+    sample = stack[:, ::sample_step, ::sample_step]
+    if sample.ndim == 4:
+        # Adding the planes is much faster than a mean over a length-3 axis
+        wide = np.float32 if sample.dtype.kind == "f" else np.uint16
+        planes = [sample[..., c].astype(wide) for c in range(sample.shape[3])]
+        sample = sum(planes).astype(np.float32) / len(planes)
+    sample = sample.reshape(n, -1).astype(np.float32, copy=False)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        if stack.dtype.kind == "f":
+            attributes["brightness"] = np.nanmean(sample, axis=1)
+            attributes["contrast"] = np.nanstd(sample, axis=1)
+        else:
+            attributes["brightness"] = sample.mean(axis=1)
+            attributes["contrast"] = sample.std(axis=1)
+
+    # NaNs sort last, so the finite pixels of each row are a prefix
+    ordered = np.sort(sample, axis=1)
+    count = np.isfinite(sample).sum(axis=1)
+    median = _sorted_median(ordered, 0, count)
+    deviation = np.sort(np.abs(sample - median[:, None]), axis=1)
+    noise = 1.4826 * _sorted_median(deviation, 0, count)
+
+    # Sigma-clipped background: the kept pixels are a contiguous run of the
+    # sorted row, so each iteration only moves its two ends
+    background = median
+    for _ in range(clip_iterations):
+        low = _sorted_search(ordered, count, background - clip_sigma * noise)
+        high = _sorted_search(ordered, count, background + clip_sigma * noise, "right")
+        background = np.where(high > low, _sorted_median(ordered, low, high), median)
+    attributes["noise"] = noise
+    attributes["background"] = background
+
+    # Spread of windows on the grid, in the image's own planes like before
+    pixels = stack[:, ::noise_window_step, ::noise_window_step]
+    window_h = min(noise_window // noise_window_step, pixels.shape[1])
+    window_w = min(noise_window // noise_window_step, pixels.shape[2])
+    grid_y = np.linspace(0, pixels.shape[1] - window_h, noise_window_grid)
+    grid_x = np.linspace(0, pixels.shape[2] - window_w, noise_window_grid)
+    spread = np.nanstd if stack.dtype.kind == "f" else np.std
+    axes = tuple(range(1, pixels.ndim))
+    spreads = []
+    for y in grid_y.astype(int):
+        for x in grid_x.astype(int):
+            window = pixels[:, y : y + window_h, x : x + window_w]
+            with np.errstate(invalid="ignore", divide="ignore"):
+                spreads.append(spread(window, axis=axes, dtype=np.float32))
+    attributes["window_noise"] = np.mean(spreads, axis=0)
+
+    # Pulsars sit at the centre: compare a central disc with an annulus
+    y, x = np.mgrid[0:h:sample_step, 0:w:sample_step]
+    radius = np.hypot(y - (h - 1) / 2, x - (w - 1) / 2).ravel()
+    inner = max(min(h, w) / 10, sample_step)
+    centre = sample[:, radius <= inner]
+    annulus = np.sort(sample[:, (radius > 2 * inner) & (radius <= 4 * inner)], axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        centre_mean = np.nanmean(centre, axis=1) if centre.size else np.nan
+        annulus_median = _sorted_median(annulus, 0, np.isfinite(annulus).sum(axis=1))
+        attributes["centre_contrast"] = np.where(
+            noise > 0, (centre_mean - annulus_median) / noise, 0
+        )
+    return attributes
+
+
+def detect_arcs(img_array, size=64, angles=64):
+    # Unwraps a downsampled region around the pulsar into (radius, angle)
+    # rings and counts the arcs that stand out from each ring's baseline
+    h, w = img_array.shape[:2]
+    span = min(2 * int(min(h, w) * arc_radii[1]) + 2, min(h, w))
+    step = max(1, span // size)
+    rows = cols = span // step
+    # Centre the region exactly so rings are concentric with the pulsar
+    top, left = (h - rows * step) // 2, (w - cols * step) // 2
+    roi = img_array[top : top + rows * step, left : left + cols * step]
+    if roi.ndim == 3:
+        roi = sum(roi[..., c].astype(np.float32) for c in range(roi.shape[2]))
+    roi = roi.astype(np.float32).reshape(rows, step, cols, step).mean(axis=(1, 3))
+
+    radii = np.arange(
+        max(int(arc_radii[0] * min(h, w) / step), 3),
+        min(int(arc_radii[1] * min(h, w) / step), min(rows, cols) // 2 - 1),
+    )
+    if len(radii) == 0:
+        return 0
+    # Bilinear samples keep each ring at a true radius, so a bright star at
+    # the centre falls off evenly instead of leaving arcs of rounding error
+    theta = np.linspace(0, 2 * np.pi, angles, endpoint=False)
+    y = (rows - 1) / 2 + radii[:, None] * np.sin(theta)
+    x = (cols - 1) / 2 + radii[:, None] * np.cos(theta)
+    y0, x0 = np.floor(y).astype(int), np.floor(x).astype(int)
+    dy, dx = y - y0, x - x0
+    polar = (
+        roi[y0, x0] * (1 - dy) * (1 - dx)
+        + roi[y0, x0 + 1] * (1 - dy) * dx
+        + roi[y0 + 1, x0] * dy * (1 - dx)
+        + roi[y0 + 1, x0 + 1] * dy * dx
+    )
+
+    percentile, median = (
+        (np.nanpercentile, np.nanmedian)
+        if np.isnan(polar).any()
+        else (np.percentile, np.median)
+    )
+    with np.errstate(invalid="ignore"):
+        residual = polar - percentile(polar, 25, axis=1, keepdims=True)
+        noise = 1.4826 * median(np.abs(residual - median(residual)))
+        if not noise > 0:
+            return 0
+        excess = residual > arc_threshold * noise
+
+    # Longest run of excess around each ring, wrapping past 2 pi
+    doubled = np.concatenate([excess, excess], axis=1)
+    index = np.arange(2 * angles)
+    last_gap = np.maximum.accumulate(np.where(doubled, -1, index), axis=1)
+    longest = (index - last_gap).max(axis=1)
+    # Full rings are haloes rather than shocks
+    on_arc = (longest >= arc_extent / (2 * np.pi) * angles) & (longest < angles)
+
+    # Neighbouring radii belong to the same arc
+    edges = np.diff(np.concatenate([[0], on_arc.astype(int), [0]]))
+    return int(np.count_nonzero(edges == 1))
+
+
+def row_attributes(row, names=None):
+    names = eager_features if names is None else names
+    return {name: row[name].item() for name in names if name in row.dtype.names}
+
+
+def calculate_image_attributes(img_array, names=None):
+    names = eager_features if names is None else names
+    attributes = {}
+    if any(name in eager_features for name in names):
+        row = calculate_batch_attributes(img_array[None])[0]
+        attributes = row_attributes(row, names)
+    if "num_circles" in names:
+        attributes["num_circles"] = detect_arcs(img_array)
+    return attributes
+
+
+def load_source(source, store_folder=None):
+    if isinstance(source, tuple):
+        if store_folder not in _stores:
+            _stores[store_folder] = PackedStore(store_folder)
+        return _stores[store_folder].get(*source)
+    return load_cutout(source)
+
+
+def load_preview(source, store_folder=None):
+    if isinstance(source, str) and source.endswith(".jpg"):
+        with Image.open(source) as image:
+            # Draft mode lets the JPEG decoder skip straight to a reduced size
+            image.draft(
+                image.mode,
+                (image.width // preview_scale, image.height // preview_scale),
+            )
+            return np.asarray(image)
+    return load_source(source, store_folder)[::preview_scale, ::preview_scale]
+
+
+def reject_reason(preview, thresholds=None):
+    thresholds = cascade_thresholds if thresholds is None else thresholds
+    if preview.dtype.kind == "f":
+        return "blank" if is_blank(preview) else None
+    if preview.mean() >= thresholds["brightness"]:
+        return "saturated"
+    # Previews are block averages, so noise barely moves their spread
+    if np.ptp(preview) < thresholds["contrast"]:
+        return "flat"
+    return None
+
+
+def cascade_report(stages):
+    counts = collections.Counter(stages)
+    return (
+        f"Scoring cascade: {sum(counts.values())} previewed, "
+        f"{counts[0]} rejected at preview, {counts[1]} scored at full resolution"
+    )
+
+
+def score_chunk(chunk, store_folder=None, thresholds=None):
+    # Runs in a worker process: each item is (pulsar, survey, source, names),
+    # where source is an image path or a packed store key and names are the
+    # features to compute (None for all of them)
+    results = []
+    stacks = {}
+    for pulsar, survey, source, names in chunk:
+        try:
+            preview = load_preview(source, store_folder)
+            if reject_reason(preview, thresholds):
+                # Junk is scored on the preview and skips every later stage
+                row = calculate_batch_attributes(preview[None])[0]
+                attributes = row_attributes(row, names)
+                results.append(
+                    (pulsar, survey, {**attributes, "num_circles": 0, "stage": 0})
+                )
+                continue
+            img_array = load_source(source, store_folder)
+        except Exception as e:
+            print(f"Failed to calculate attributes for {pulsar} {survey}: {e}")
+            continue
+        stack = stacks.setdefault((img_array.shape, img_array.dtype.str), [])
+        stack.append((pulsar, survey, names, img_array))
+
+    # Survivors are scored at full resolution, same-shaped cutouts together
+    for stack in stacks.values():
+        rows = calculate_batch_attributes(np.stack([item[3] for item in stack]))
+        for (pulsar, survey, names, img_array), row in zip(stack, rows):
+            attributes = row_attributes(row, names)
+            if names is not None and "num_circles" in names:
+                attributes["num_circles"] = detect_arcs(img_array)
+            results.append((pulsar, survey, {**attributes, "stage": 1}))
+    return results
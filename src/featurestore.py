@@ -0,0 +1,88 @@
+import os
+import json
+import threading
+from features import eager_features, feature_versions
+
+feature_folder = "cache"
+feature_name = "features.jsonl"
+
+
+def source_signature(source, image_store=None):
+    # Cheap identity for a cutout: size and mtime for a file, the write stamp
+    # of its slot for a packed store key
+    if isinstance(source, tuple):
+        return image_store.signature(*source)
+    stat = os.stat(source)
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+
+class FeatureStore:
+    # Appended one JSON line per image like the download manifest. A line
+    # holds [version, value] per feature; lines for the same image signature
+    # merge, and a new signature replaces everything stored before it.
+    def __init__(self, folder=feature_folder):
+        self.folder = folder
+        self.path = os.path.join(folder, feature_name)
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.lines = 0
+
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # Torn final line from a crash
+                    self.merge(entry)
+                    self.lines += 1
+
+    def merge(self, entry):
+        key = (entry["pulsar"], entry["survey"])
+        stored = self.entries.get(key)
+        if stored is None or stored["signature"] != entry["signature"]:
+            self.entries[key] = entry
+        else:
+            stored["features"].update(entry["features"])
+
+    def lookup(self, pulsar, survey, signature, names=None):
+        # Returns the stored values that are still valid and which of names
+        # (the eagerly scored features by default) have to be computed again
+        names = eager_features if names is None else names
+        entry = self.entries.get((pulsar, survey))
+        cached = {}
+        if entry is not None and entry["signature"] == signature:
+            for name, (version, value) in entry["features"].items():
+                if feature_versions.get(name) == version:
+                    cached[name] = value
+        missing = [name for name in names if name not in cached]
+        return cached, missing
+
+    def record(self, pulsar, survey, signature, attributes):
+        entry = {
+            "pulsar": pulsar,
+            "survey": survey,
+            "signature": signature,
+            "features": {
+                name: [feature_versions[name], float(value)]
+                for name, value in attributes.items()
+                if name in feature_versions
+            },
+        }
+        with self.lock:
+            self.merge(entry)
+            os.makedirs(self.folder, exist_ok=True)
+            with open(self.path, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+            self.lines += 1
+
+    def compact(self):
+        with self.lock:
+            if self.lines == len(self.entries):
+                return
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "w") as f:
+                for entry in self.entries.values():
+                    f.write(json.dumps(entry) + "\n")
+            os.replace(temp_path, self.path)
+            self.lines = len(self.entries)
@@ -1,8 +1,9 @@
 import tkinter as tk
 from tkinter import ttk
+import multiprocessing
 import concurrent.futures
 import subprocess
-from pulsars import list_pulsars, save_pulsar
+from downloader import DownloadEngine, survey_options
 from sorter import PulsarSorter
 import numpy as np
 
@@ -13,7 +14,7 @@ class PulsarDownloader(tk.Tk):
         self.iconphoto(False, tk.PhotoImage(file="icon.png"))
 
         self.title("Pulsar Image Downloader")
-        self.geometry("400x380")  # Smaller window size
+        self.geometry("400x410")  # Smaller window size
         self.resizable(False, False)
 
         # Settings Frame
@@ -24,16 +25,7 @@ class PulsarDownloader(tk.Tk):
         hips_label = ttk.Label(settings_frame, text="Select HIPS Survey:")
         hips_label.pack(side=tk.TOP)
 
-        self.hips_options = {
-            "All": "CDS/P/VPHAS/DR4/Halpha,CDS/P/VPHAS/DR4/Halpha+,CDS/P/IPHAS/DR2/halpha,CDS/P/SHS/,CDS/P/allWISE/W3,CDS/P/allWISE/W4",
-            "VPHAS": "CDS/P/VPHAS/DR4/Halpha",
-            "All VPHAS": "CDS/P/VPHAS/DR4/Halpha,CDS/P/VPHAS/DR4/i,CDS/P/VPHAS/DR4/r",
-            "IPHAS": "CDS/P/IPHAS/DR2/halpha",
-            "All IPHAS": "CDS/P/IPHAS/DR2/halpha,CDS/P/IPHAS/DR2/i,CDS/P/IPHAS/DR2/r",
-            "SHS": "CDS/P/SHS",
-            "WISE 12um": "CDS/P/allWISE/W3",
-            "WISE 22um": "CDS/P/allWISE/W4",
-        }
+        self.hips_options = survey_options
 
         self.selected_hips = tk.StringVar(value=list(self.hips_options.keys())[0])
         hips_dropdown = ttk.OptionMenu(
@@ -71,6 +63,13 @@ class PulsarDownloader(tk.Tk):
         fov_entry = ttk.Entry(fov_frame, textvariable=self.fov)
         fov_entry.pack(side=tk.LEFT)
 
+        # Store raw FITS flux instead of 8-bit JPEGs
+        self.download_fits = tk.BooleanVar(value=False)
+        fits_checkbox = ttk.Checkbutton(
+            settings_frame, text="Download FITS", variable=self.download_fits
+        )
+        fits_checkbox.pack(side=tk.TOP)
+
         # Button Frame
         button_frame = ttk.Frame(self)
         button_frame.pack(pady=10)
@@ -116,6 +115,7 @@ class PulsarDownloader(tk.Tk):
             self.progress["value"] = 0
             # self.sort_button.config(state=tk.DISABLED)
 
+            self.engine = DownloadEngine()
             self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
             self.future = self.executor.submit(self.download_thread_func)
             self.check_future()
@@ -126,6 +126,8 @@ class PulsarDownloader(tk.Tk):
         self.progress["value"] = 0
         self.progress_label_text.set("-/-")
         # self.sort_button.config(state=tk.DISABLED)
+        if hasattr(self, "engine"):
+            self.engine.stop()
         if hasattr(self, "executor"):
             self.executor.shutdown(wait=False)
 
@@ -139,6 +141,16 @@ class PulsarDownloader(tk.Tk):
         else:
             self.after(100, self.check_future)
 
+    def update_progress(self, progress_count, total_pulsars):
+        # Called from worker threads, so hand the widget updates to the Tk loop
+        def update():
+            if self.downloading:
+                self.progress["maximum"] = total_pulsars
+                self.progress["value"] = progress_count
+                self.progress_label_text.set(f"{progress_count}/{total_pulsars}")
+
+        self.after(0, update)
+
     def download_thread_func(self):
         pulsar_options = {}
         for key, value in self.pulsar_options.items():
@@ -149,29 +161,19 @@ class PulsarDownloader(tk.Tk):
                     pulsar_options[key] = float(value.get())
             except ValueError:
                 pulsar_options[key] = None
-        pulsars = list_pulsars(pulsar_options)
         selected_surveys = self.hips_options[self.selected_hips.get()].split(",")
         print(f"Selected surveys: {selected_surveys}")
-        total_pulsars = len(pulsars) * len(selected_surveys)
-        self.progress["maximum"] = total_pulsars
-
-        progress_count = 0
-        for pulsar in pulsars:
-            if not self.downloading:
-                break
-            for survey in selected_surveys:
-                survey = survey.strip()
-                print(f"Downloading {pulsar} for survey {survey}")
-                save_pulsar(
-                    pulsar,
-                    survey,
-                    self.fov.get(),
-                )
-                if self.downloading:
-                    progress_count += 1
-                    self.progress["value"] = progress_count
-                    self.progress_label_text.set(f"{progress_count}/{total_pulsars}")
-                    self.update_idletasks()  # Update the GUI
+
+        try:
+            self.engine.run(
+                pulsar_options,
+                selected_surveys,
+                self.fov.get(),
+                progress=self.update_progress,
+                image_format="fits" if self.download_fits.get() else "jpg",
+            )
+        finally:
+            self.engine.close()
 
         print("Download completed")
 
@@ -180,5 +182,7 @@ class PulsarDownloader(tk.Tk):
 
 
 if __name__ == "__main__":
+    # Spawned scoring workers in the frozen build must not start another GUI
+    multiprocessing.freeze_support()
     app = PulsarDownloader()
     app.mainloop()
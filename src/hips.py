@@ -0,0 +1,271 @@
+import io
+import os
+import threading
+import collections
+import requests
+import numpy as np
+from PIL import Image
+from astropy.io import fits
+from astropy.coordinates import SkyCoord
+import astropy.units as u
+from skycoverage import ang2pix_nest
+
+tile_folder = os.path.join("cache", "hips")
+record_url = "https://alasky.cds.unistra.fr/MocServer/query"
+
+# Upper bound on the raw tiles kept on disk, least recently used go first
+max_cache_bytes = 2 * 1024**3
+
+_surveys = {}
+_surveys_lock = threading.Lock()
+_tile_cache = None
+
+
+class TileCache:
+    def __init__(self, folder=tile_folder, max_bytes=max_cache_bytes, max_decoded=64):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.max_decoded = max_decoded
+        self.lock = threading.Lock()
+        self.decoded = collections.OrderedDict()
+
+        # File mtimes double as last-use times so eviction order survives restarts
+        self.files = {}
+        for root, _, names in os.walk(folder):
+            for name in names:
+                path = os.path.join(root, name)
+                stat = os.stat(path)
+                self.files[path] = (stat.st_mtime, stat.st_size)
+        self.total_bytes = sum(size for _, size in self.files.values())
+
+    def path(self, survey, order, ipix, extension):
+        return os.path.join(
+            self.folder,
+            survey.replace("/", "-"),
+            f"Norder{order}",
+            f"Dir{(ipix // 10000) * 10000}",
+            f"Npix{ipix}.{extension}",
+        )
+
+    def touch(self, path):
+        # Files written since the index was built are added to it
+        os.utime(path)
+        stat = os.stat(path)
+        with self.lock:
+            if path not in self.files:
+                self.total_bytes += stat.st_size
+            self.files[path] = (stat.st_mtime, stat.st_size)
+
+    def store(self, path, content):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "wb") as f:
+            f.write(content)
+        os.replace(path + ".tmp", path)
+        with self.lock:
+            if path in self.files:
+                self.total_bytes -= self.files[path][1]
+            self.files[path] = (os.path.getmtime(path), len(content))
+            self.total_bytes += len(content)
+            self.evict()
+
+    def evict(self):
+        if self.total_bytes <= self.max_bytes:
+            return
+        # Free a little extra so the next few stores don't rescan the index
+        target = self.max_bytes * 0.9
+        for path, (_, size) in sorted(self.files.items(), key=lambda f: f[1][0]):
+            if self.total_bytes <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            del self.files[path]
+            self.decoded.pop(path, None)
+            self.total_bytes -= size
+
+    def get_decoded(self, path):
+        with self.lock:
+            if path in self.decoded:
+                self.decoded.move_to_end(path)
+                return self.decoded[path]
+        return None
+
+    def put_decoded(self, path, data):
+        with self.lock:
+            self.decoded[path] = data
+            while len(self.decoded) > self.max_decoded:
+                self.decoded.popitem(last=False)
+
+
+def get_tile_cache():
+    global _tile_cache
+    if _tile_cache is None:
+        _tile_cache = TileCache()
+    return _tile_cache
+
+
+def _read_properties(text):
+    properties = {}
+    for line in text.splitlines():
+        if "=" in line and not line.lstrip().startswith("#"):
+            key, value = line.split("=", 1)
+            properties[key.strip()] = value.strip()
+    return properties
+
+
+def _decode_tile(content, extension):
+    if extension == "fits":
+        with fits.open(io.BytesIO(content)) as hdul:
+            # FITS tiles are stored bottom row first
+            return np.flipud(np.asarray(hdul[0].data, dtype=np.float32))
+    image = Image.open(io.BytesIO(content))
+    if image.mode not in ("L", "RGB"):
+        # Alpha and palette PNG tiles, which cutouts can't be saved as JPEG with
+        image = image.convert("L" if image.mode.startswith(("L", "I", "F")) else "RGB")
+    return np.asarray(image)
+
+
+def _deinterleave(values, bits):
+    x = np.zeros_like(values)
+    y = np.zeros_like(values)
+    for bit in range(bits):
+        x |= ((values >> (2 * bit)) & 1) << bit
+        y |= ((values >> (2 * bit + 1)) & 1) << bit
+    return x, y
+
+
+class HipsSurvey:
+    # base_url can also be a local directory laid out like a HiPS server
+    def __init__(self, survey, base_url=None, cache=None, session=None):
+        self.survey = survey.strip().strip("/")
+        self.cache = cache or get_tile_cache()
+        self.session = session
+        self.base_url = base_url or self.lookup_base_url()
+
+        properties = _read_properties(self.read("properties").decode())
+        self.max_order = int(properties.get("hips_order", 3))
+        self.tile_width = int(properties.get("hips_tile_width", 512))
+        self.tile_bits = self.tile_width.bit_length() - 1
+        self.formats = properties.get("hips_tile_format", "jpeg").split()
+        self.galactic = properties.get("hips_frame", "equatorial") == "galactic"
+
+    def lookup_base_url(self):
+        response = (self.session or requests).get(
+            record_url,
+            params={"ID": self.survey, "get": "record", "fmt": "json"},
+        )
+        response.raise_for_status()
+        url = response.json()[0]["hips_service_url"]
+        return url[0] if isinstance(url, list) else url
+
+    def read(self, path):
+        if not self.base_url.startswith(("http://", "https://")):
+            with open(os.path.join(self.base_url, path), "rb") as f:
+                return f.read()
+        response = (self.session or requests).get(f"{self.base_url}/{path}")
+        response.raise_for_status()
+        return response.content
+
+    def tile(self, order, ipix, extension):
+        path = self.cache.path(self.survey, order, ipix, extension)
+        data = self.cache.get_decoded(path)
+        if data is not None:
+            return data
+
+        try:
+            self.cache.touch(path)
+            with open(path, "rb") as f:
+                content = f.read()
+        except OSError:
+            # Not cached, or evicted by another thread since
+            try:
+                content = self.read(
+                    f"Norder{order}/Dir{(ipix // 10000) * 10000}/Npix{ipix}.{extension}"
+                )
+            except FileNotFoundError:
+                content = b""
+            except requests.HTTPError as e:
+                if e.response is None or e.response.status_code != 404:
+                    return None  # Worth trying again next time
+                content = b""
+            except OSError:
+                return None
+            # Missing tiles are cached empty, so they're only asked for once
+            self.cache.store(path, content)
+
+        if not content:
+            return None  # No tile means no coverage here
+        data = _decode_tile(content, extension)
+        self.cache.put_decoded(path, data)
+        return data
+
+    def choose_order(self, pixel_scale):
+        # Coarsest order whose HiPS pixels are at least as fine as the output's
+        for order in range(self.max_order + 1):
+            hips_scale = np.degrees(np.sqrt(np.pi / 3)) / 2 ** (order + self.tile_bits)
+            if hips_scale <= pixel_scale:
+                return order
+        return self.max_order
+
+    def cutout(self, ra, dec, fov, width=500, height=500, image_format="jpg"):
+        # Gnomonic projection centred on (ra, dec), north up and east left
+        pixel_scale = fov / width
+        xi = np.radians((np.arange(width) - (width - 1) / 2) * -pixel_scale)
+        eta = np.radians(((height - 1) / 2 - np.arange(height)) * pixel_scale)
+        xi, eta = np.meshgrid(xi, eta)
+        ra0, dec0 = np.radians(ra), np.radians(dec)
+        rho = np.hypot(xi, eta)
+        c = np.arctan(rho)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            sky_dec = np.arcsin(
+                np.cos(c) * np.sin(dec0)
+                + np.where(rho > 0, eta * np.sin(c) * np.cos(dec0) / rho, 0)
+            )
+        sky_ra = ra0 + np.arctan2(
+            xi * np.sin(c),
+            rho * np.cos(dec0) * np.cos(c) - eta * np.sin(dec0) * np.sin(c),
+        )
+        lon, lat = np.degrees(sky_ra).ravel(), np.degrees(sky_dec).ravel()
+        if self.galactic:
+            galactic = SkyCoord(ra=lon * u.deg, dec=lat * u.deg).galactic
+            lon, lat = galactic.l.deg, galactic.b.deg
+
+        extension = "fits" if image_format == "fits" else "jpg"
+        if extension == "jpg" and "jpeg" not in self.formats:
+            extension = "png"
+
+        order = self.choose_order(pixel_scale)
+        pixels = ang2pix_nest(order + self.tile_bits, lon, lat)
+        tiles = pixels >> (2 * self.tile_bits)
+        x, y = _deinterleave(pixels & (self.tile_width**2 - 1), self.tile_bits)
+        # Tiles put the cell's north corner top left, east along the top row
+        rows = self.tile_width - 1 - x
+        cols = self.tile_width - 1 - y
+
+        output = None
+        for ipix in np.unique(tiles):
+            data = self.tile(order, int(ipix), extension)
+            if data is None:
+                continue
+            if output is None:
+                fill = np.nan if data.dtype.kind == "f" else 255
+                output = np.full((len(pixels),) + data.shape[2:], fill, data.dtype)
+            selected = tiles == ipix
+            output[selected] = data[rows[selected], cols[selected]]
+
+        if output is None:
+            return None
+        return output.reshape((height, width) + output.shape[1:])
+
+
+def tile_cutout(hips, ra, dec, fov, image_format="jpg", session=None):
+    survey = hips.strip().strip("/")
+    hips_survey = _surveys.get(survey)
+    if hips_survey is None:
+        # Built outside the lock, as it fetches the survey's properties; if
+        # two threads race, the first one stored wins
+        hips_survey = HipsSurvey(survey, session=session)
+        with _surveys_lock:
+            hips_survey = _surveys.setdefault(survey, hips_survey)
+    return hips_survey.cutout(ra, dec, fov, image_format=image_format)
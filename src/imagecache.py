@@ -0,0 +1,60 @@
+import threading
+from collections import OrderedDict
+
+# Bytes of decoded images kept for the pulsars around the one being viewed
+cache_budget = 512 * 2**20
+
+
+class ImageCache:
+    # Least recently used entries are dropped first once the budget is
+    # exceeded. Shared between the Tk thread and the prefetch worker
+    def __init__(self, budget=cache_budget):
+        self.budget = budget
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+    def put(self, key, value, size):
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size)
+            self.size += size
+            # The newest entry stays even if it is over budget on its own
+            while self.size > self.budget and len(self.entries) > 1:
+                self.size -= self.entries.popitem(last=False)[1][1]
+
+    def discard(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self.entries),
+                "bytes": self.size,
+            }
@@ -0,0 +1,129 @@
+import os
+import json
+import time
+import hashlib
+import threading
+
+manifest_name = "manifest.jsonl"
+
+# Failed downloads are retried once their last attempt is older than this
+retry_failed_after = 24 * 60 * 60
+
+
+class DownloadManifest:
+    # Entries are appended one JSON line at a time so an interrupted run
+    # loses at most the record it was writing; later lines win on load.
+    def __init__(self, folder):
+        self.folder = folder
+        self.path = os.path.join(folder, manifest_name)
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.lines = 0
+
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # Torn final line from a crash
+                    self.entries[self.key(*entry["key"])] = entry
+                    self.lines += 1
+
+    @staticmethod
+    def key(pulsar, survey, fov):
+        return (pulsar.replace("PSR ", ""), survey.strip(), float(fov))
+
+    def get(self, pulsar, survey, fov):
+        return self.entries.get(self.key(pulsar, survey, fov))
+
+    def record(
+        self,
+        pulsar,
+        survey,
+        fov,
+        status,
+        image_path=None,
+        error=None,
+        coverage=None,
+    ):
+        key = self.key(pulsar, survey, fov)
+        entry = {"key": list(key), "status": status, "time": time.time()}
+        if error is not None:
+            entry["error"] = error
+        if coverage is not None:
+            entry["coverage"] = coverage
+
+        with self.lock:
+            # JPEG and FITS cutouts of a field are fetched separately, so the
+            # files of the other formats carry over to the new entry
+            files = self.files(self.entries.get(key))
+            if image_path is not None:
+                stat = os.stat(image_path)
+                with open(image_path, "rb") as f:
+                    sha256 = hashlib.sha256(f.read()).hexdigest()
+                files[os.path.splitext(image_path)[1]] = {
+                    "file": os.path.basename(image_path),
+                    "sha256": sha256,
+                    "size": stat.st_size,
+                    "mtime": stat.st_mtime,
+                }
+            if files:
+                entry["files"] = files
+            self.entries[key] = entry
+            os.makedirs(self.folder, exist_ok=True)
+            with open(self.path, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+            self.lines += 1
+
+    @staticmethod
+    def files(entry):
+        # {extension: file record}, reading entries from before there was one
+        # per format as well
+        if entry is None:
+            return {}
+        if "files" in entry:
+            return dict(entry["files"])
+        if "file" in entry:
+            record = {name: entry[name] for name in ("file", "sha256", "size", "mtime")}
+            return {os.path.splitext(entry["file"])[1]: record}
+        return {}
+
+    def needs_fetch(self, pulsar, survey, fov, extension=None):
+        entry = self.get(pulsar, survey, fov)
+        if entry is None:
+            return True
+        if entry["status"] in ("blank", "outside"):
+            return False
+        files = self.files(entry)
+        if extension is not None:
+            files = {extension: files[extension]} if extension in files else {}
+        if any(self.is_current(record) for record in files.values()):
+            return False
+        if entry["status"] == "failed":
+            return time.time() - entry["time"] > retry_failed_after
+        return True
+
+    def is_current(self, entry):
+        image_path = os.path.join(self.folder, entry["file"])
+        try:
+            stat = os.stat(image_path)
+        except OSError:
+            return False
+        if stat.st_size == entry["size"] and stat.st_mtime == entry["mtime"]:
+            return True
+
+        # Touched since it was recorded, so fall back to the content hash
+        with open(image_path, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest() == entry["sha256"]
+
+    def compact(self):
+        with self.lock:
+            if self.lines == len(self.entries):
+                return
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "w") as f:
+                for entry in self.entries.values():
+                    f.write(json.dumps(entry) + "\n")
+            os.replace(temp_path, self.path)
+            self.lines = len(self.entries)
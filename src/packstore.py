@@ -0,0 +1,238 @@
+import os
+import json
+import time
+import argparse
+import threading
+import numpy as np
+from cutouts import image_extensions, load_cutout
+from manifest import DownloadManifest
+from pulsars import parse_image_filename
+
+store_folder = os.path.join("images", "packed")
+
+# A lock file older than this was left by a crashed writer
+stale_lock_seconds = 60
+
+
+class FileLock:
+    # Serialises writers across processes: the lock is a file that only one
+    # of them can create. Portable, unlike fcntl/msvcrt
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        while True:
+            try:
+                os.close(os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return self
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(self.path) > stale_lock_seconds:
+                        os.remove(self.path)
+                        continue
+                except OSError:
+                    continue
+                time.sleep(0.01)
+
+    def __exit__(self, *exc):
+        os.remove(self.path)
+
+
+class PackedStore:
+    # Cutouts of the same shape and dtype share one flat file of fixed-size
+    # slots, so each pack can be memory-mapped as a single (N, H, W[, C]) array
+    def __init__(self, folder=store_folder):
+        self.folder = folder
+        self.index_path = os.path.join(folder, "index.json")
+        self.lock_path = os.path.join(folder, "index.lock")
+        self.lock = threading.Lock()
+        self.index = {}
+        self.stamps = {}
+        self.packs = {}
+        self.maps = {}
+        self.version = None
+        self.refresh()
+
+    def index_version(self):
+        # Every flush replaces the index with a new file, so its inode changes
+        # even when two flushes land in the same mtime tick
+        stat = os.stat(self.index_path)
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def refresh(self):
+        # Picks up entries another process has flushed since the index was
+        # last read, for readers only as unflushed puts would be dropped.
+        # Lookups see either the old or the new dicts, never a mix
+        try:
+            version = self.index_version()
+        except OSError:
+            return
+        if version == self.version:
+            return
+        packs, index, stamps = self.read_index()
+        with self.lock:
+            self.packs, self.index, self.stamps = packs, index, stamps
+            self.version = version
+
+    def read_index(self):
+        with open(self.index_path) as f:
+            saved = json.load(f)
+        index, stamps = {}, {}
+        for pulsar, survey, fov, pack, slot, *stamp in saved["entries"]:
+            index[(pulsar, survey, fov)] = (pack, slot)
+            stamps[(pulsar, survey, fov)] = stamp[0] if stamp else 0
+        return saved["packs"], index, stamps
+
+    @staticmethod
+    def exists(folder=store_folder):
+        return os.path.exists(os.path.join(folder, "index.json"))
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return DownloadManifest.key(*key) in self.index
+
+    def keys(self):
+        return list(self.index)
+
+    def pack_path(self, pack):
+        return os.path.join(self.folder, f"{pack}.bin")
+
+    def put(self, pulsar, survey, fov, data):
+        data = np.ascontiguousarray(data)
+        # Greyscale surveys arrive as identical RGB planes; keep one
+        if data.ndim == 3 and np.array_equal(data[..., 0], data[..., -1]):
+            if np.array_equal(data[..., 0], data[..., 1]):
+                data = np.ascontiguousarray(data[..., 0])
+
+        key = DownloadManifest.key(pulsar, survey, fov)
+        pack = f"{'x'.join(map(str, data.shape))}_{data.dtype.name}"
+        os.makedirs(self.folder, exist_ok=True)
+        with self.lock, FileLock(self.lock_path):
+            info = self.packs.setdefault(
+                pack, {"shape": list(data.shape), "dtype": data.dtype.str, "count": 0}
+            )
+            if key in self.index and self.index[key][0] == pack:
+                slot = self.index[key][1]
+                with open(self.pack_path(pack), "r+b") as f:
+                    f.seek(slot * data.nbytes)
+                    f.write(data.tobytes())
+            else:
+                # New slots go at the file's real end, which can be past what
+                # the index records after another writer or an unflushed run
+                with open(self.pack_path(pack), "a+b") as f:
+                    f.seek(0, os.SEEK_END)
+                    slot = f.tell() // data.nbytes
+                    # A torn write from a crash leaves a partial slot
+                    f.truncate(slot * data.nbytes)
+                    f.write(data.tobytes())
+                info["count"] = max(info["count"], slot + 1)
+            self.index[key] = (pack, slot)
+            # Slots are rewritten in place, so readers need a per-entry stamp
+            self.stamps[key] = time.time_ns()
+
+    def signature(self, pulsar, survey, fov):
+        key = DownloadManifest.key(pulsar, survey, fov)
+        pack, slot = self.index[key]
+        return f"{pack}:{slot}:{self.stamps.get(key, 0)}"
+
+    def memmap(self, pack):
+        info = self.packs[pack]
+        array = self.maps.get(pack)
+        if array is None or len(array) < info["count"]:
+            array = np.memmap(
+                self.pack_path(pack),
+                dtype=np.dtype(info["dtype"]),
+                mode="r",
+                shape=(info["count"], *info["shape"]),
+            )
+            self.maps[pack] = array
+        return array
+
+    def get(self, pulsar, survey, fov):
+        pack, slot = self.index[DownloadManifest.key(pulsar, survey, fov)]
+        return self.memmap(pack)[slot]
+
+    def stacks(self):
+        # Whole packs in slot order, for sequential scans during scoring/training
+        for pack in self.packs:
+            keys = [None] * self.packs[pack]["count"]
+            for key, (key_pack, slot) in self.index.items():
+                if key_pack == pack:
+                    keys[slot] = key
+            yield keys, self.memmap(pack)
+
+    def flush(self):
+        # Merged with what other writers have flushed since this store read
+        # the index, the newer write of any entry both have winning
+        os.makedirs(self.folder, exist_ok=True)
+        with self.lock, FileLock(self.lock_path):
+            if os.path.exists(self.index_path):
+                packs, index, stamps = self.read_index()
+                for pack, info in packs.items():
+                    ours = self.packs.setdefault(pack, info)
+                    ours["count"] = max(ours["count"], info["count"])
+                for key, entry in index.items():
+                    if stamps[key] > self.stamps.get(key, -1):
+                        self.index[key] = entry
+                        self.stamps[key] = stamps[key]
+
+            entries = [
+                [*key, pack, slot, self.stamps.get(key, 0)]
+                for key, (pack, slot) in self.index.items()
+            ]
+            with open(self.index_path + ".tmp", "w") as f:
+                json.dump({"packs": self.packs, "entries": entries}, f)
+            os.replace(self.index_path + ".tmp", self.index_path)
+            self.version = self.index_version()
+
+
+def loose_files(image_folder="images", default_fov=1):
+    # {(pulsar, survey, fov): filename} for the cutouts outside the store
+    if not os.path.isdir(image_folder):
+        return {}
+    # Manifest keys keep the real survey names, which filenames can't round-trip
+    files = {
+        record["file"]: DownloadManifest.key(*entry["key"])
+        for entry in DownloadManifest(image_folder).entries.values()
+        for record in DownloadManifest.files(entry).values()
+    }
+
+    keys = {}
+    image_files = [f for f in os.listdir(image_folder) if f.endswith(image_extensions)]
+    # FITS cutouts go first so they win over a JPEG of the same field
+    for image_file in sorted(image_files, key=lambda f: not f.endswith(".npy")):
+        if image_file in files:
+            key = files[image_file]
+        else:
+            pulsar, survey, fov = parse_image_filename(image_file)
+            key = DownloadManifest.key(
+                pulsar, survey, default_fov if fov is None else fov
+            )
+        keys.setdefault(key, image_file)
+    return keys
+
+
+def migrate(image_folder="images", store=None, default_fov=1):
+    store = store or PackedStore(os.path.join(image_folder, "packed"))
+
+    migrated = 0
+    for key, image_file in loose_files(image_folder, default_fov).items():
+        if key in store:
+            continue
+        store.put(*key, load_cutout(os.path.join(image_folder, image_file)))
+        migrated += 1
+
+    store.flush()
+    return migrated
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Pack an images/ folder of cutouts into a memory-mapped store"
+    )
+    parser.add_argument("folder", nargs="?", default="images")
+    parser.add_argument("--fov", type=float, default=1, help="FOV of unlisted files")
+    args = parser.parse_args()
+    print(f"Packed {migrate(args.folder, default_fov=args.fov)} images")
@@ -0,0 +1,259 @@
+import os
+import csv
+import queue
+import argparse
+import threading
+import concurrent.futures
+from downloader import DownloadEngine, survey_options
+from features import cascade_report, cascade_thresholds, score_chunk
+from manifest import DownloadManifest
+from pulsars import image_filename, image_folder
+from ranking import sort_key
+
+_done = object()
+
+
+def score_image(image_path, thresholds=None):
+    # Runs in a worker process, so only plain floats travel back
+    results = score_chunk([(None, None, image_path, None)], thresholds=thresholds)
+    if not results:
+        raise ValueError("unreadable image")
+    attributes = results[0][2]
+    return {
+        key: None if value is None else float(value)
+        for key, value in attributes.items()
+    }
+
+
+class Pipeline:
+    # catalogue -> download -> score -> rank, each stage feeding the next
+    # through a bounded queue so scoring starts with the first cutout
+    def __init__(
+        self,
+        surveys,
+        fov=1,
+        download_workers=8,
+        score_workers=None,
+        queue_size=64,
+        image_format="jpg",
+        engine=None,
+        thresholds=None,
+    ):
+        self.surveys = [survey.strip() for survey in surveys]
+        self.fov = fov
+        self.download_workers = download_workers
+        self.score_workers = score_workers or os.cpu_count() or 1
+        self.image_format = image_format
+        self.thresholds = thresholds or cascade_thresholds
+        self.engine = engine or DownloadEngine(limits={"hips2fits": download_workers})
+        self.download_queue = queue.Queue(maxsize=queue_size)
+        self.score_queue = queue.Queue(maxsize=queue_size)
+        self.results = queue.Queue()
+        self.coordinates = {}
+
+    def image_path(self, pulsar, survey):
+        return os.path.join(
+            image_folder, image_filename(pulsar, survey, self.image_format, self.fov)
+        )
+
+    def catalogue_stage(self, options, manifest):
+        pulsars = self.engine.list_pulsars(options)
+        print(f"Found {len(pulsars)} pulsars")
+        extension = ".npy" if self.image_format == "fits" else ".jpg"
+
+        for start in range(0, len(pulsars), self.engine.batch_size):
+            batch = pulsars[start : start + self.engine.batch_size]
+            coordinates = self.engine.resolve(batch)
+            self.coordinates.update(coordinates)
+
+            jobs = []
+            for pulsar in batch:
+                for survey in self.surveys:
+                    if manifest.needs_fetch(pulsar, survey, self.fov, extension):
+                        jobs.append((pulsar, survey))
+                    elif extension in manifest.files(
+                        manifest.get(pulsar, survey, self.fov)
+                    ):
+                        # Already on disk from an earlier run
+                        self.score_queue.put(
+                            (pulsar, survey, self.image_path(pulsar, survey))
+                        )
+
+            jobs, fractions = self.engine.prune(jobs, coordinates, self.fov, manifest)
+            for pulsar, survey in jobs:
+                self.download_queue.put(
+                    (
+                        pulsar,
+                        survey,
+                        coordinates.get(pulsar),
+                        fractions.get((pulsar, survey)),
+                    )
+                )
+
+    def download_stage(self, manifest):
+        while True:
+            job = self.download_queue.get()
+            if job is _done:
+                return
+            pulsar, survey, coordinates, coverage = job
+            status = self.engine.fetch(
+                pulsar,
+                survey,
+                self.fov,
+                coordinates,
+                manifest,
+                coverage,
+                self.image_format,
+            )
+            if status == "ok":
+                self.score_queue.put((pulsar, survey, self.image_path(pulsar, survey)))
+
+    def score_stage(self, executor):
+        while True:
+            item = self.score_queue.get()
+            if item is _done:
+                return
+            pulsar, survey, image_path = item
+            try:
+                attributes = executor.submit(
+                    score_image, image_path, self.thresholds
+                ).result()
+            except Exception as e:
+                print(f"Failed to score {image_path}: {e}")
+                continue
+            self.results.put((pulsar, survey, attributes))
+
+    def run(self, options, output=None):
+        manifest = DownloadManifest(image_folder)
+        with concurrent.futures.ProcessPoolExecutor(self.score_workers) as executor:
+            catalogue = threading.Thread(
+                target=self.catalogue_stage, args=(options, manifest)
+            )
+            downloaders = [
+                threading.Thread(target=self.download_stage, args=(manifest,))
+                for _ in range(self.download_workers)
+            ]
+            scorers = [
+                threading.Thread(target=self.score_stage, args=(executor,))
+                for _ in range(self.score_workers)
+            ]
+            for thread in [catalogue, *downloaders, *scorers]:
+                thread.start()
+
+            # Shut each stage down once everything upstream of it has finished
+            catalogue.join()
+            for _ in downloaders:
+                self.download_queue.put(_done)
+            for thread in downloaders:
+                thread.join()
+            for _ in scorers:
+                self.score_queue.put(_done)
+            for thread in scorers:
+                thread.join()
+
+        manifest.compact()
+        self.engine.close()
+
+        rows = self.rank()
+        if output is not None:
+            write_table(rows, output)
+        return rows
+
+    def rank(self):
+        scored = []
+        while not self.results.empty():
+            scored.append(self.results.get())
+        print(cascade_report(attributes["stage"] for _, _, attributes in scored))
+        scored.sort(key=lambda result: (sort_key(result[2]), result[0], result[1]))
+
+        rows = []
+        survey_ranks = {}
+        for rank, (pulsar, survey, attributes) in enumerate(scored, 1):
+            survey_ranks[survey] = survey_ranks.get(survey, 0) + 1
+            coordinates = self.coordinates.get(pulsar, {})
+            rows.append(
+                {
+                    "rank": rank,
+                    "survey_rank": survey_ranks[survey],
+                    "pulsar": pulsar,
+                    "survey": survey,
+                    **attributes,
+                    **{key.lower(): value for key, value in coordinates.items()},
+                }
+            )
+        return rows
+
+
+def write_table(rows, output):
+    fields = list(dict.fromkeys(key for row in rows for key in row))
+    with open(output, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(rows)
+    print(f"Wrote {len(rows)} candidates to {output}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Download, score and rank pulsar cutouts without the GUI"
+    )
+    parser.add_argument(
+        "--surveys",
+        default="All",
+        help="A preset from the GUI or a comma-separated list of HiPS IDs",
+    )
+    parser.add_argument("--fov", type=float, default=1, help="FOV in arcmin")
+    parser.add_argument("--max-dec", type=float, default=0)
+    parser.add_argument("--min-dec", type=float, default=-90)
+    parser.add_argument("--max-gb", type=float, default=5)
+    parser.add_argument("--min-gb", type=float, default=-5)
+    parser.add_argument("--min-year", type=float, default=2012)
+    parser.add_argument("--max-error", type=float, default=1)
+    parser.add_argument("--pulsar-name", default="")
+    parser.add_argument("--download-workers", type=int, default=8)
+    parser.add_argument("--score-workers", type=int, default=None)
+    parser.add_argument("--fits", action="store_true", help="Store float32 flux")
+    parser.add_argument(
+        "--reject-brightness",
+        type=float,
+        default=cascade_thresholds["brightness"],
+        help="Reject cutouts whose preview is at least this bright",
+    )
+    parser.add_argument(
+        "--reject-contrast",
+        type=float,
+        default=cascade_thresholds["contrast"],
+        help="Reject cutouts whose preview spans fewer grey levels than this",
+    )
+    parser.add_argument("--output", default="candidates.csv")
+    args = parser.parse_args()
+
+    options = {
+        key: getattr(args, key)
+        for key in [
+            "max_dec",
+            "min_dec",
+            "max_gb",
+            "min_gb",
+            "min_year",
+            "max_error",
+            "pulsar_name",
+        ]
+    }
+    surveys = survey_options.get(args.surveys, args.surveys).split(",")
+    pipeline = Pipeline(
+        surveys,
+        fov=args.fov,
+        download_workers=args.download_workers,
+        score_workers=args.score_workers,
+        image_format="fits" if args.fits else "jpg",
+        thresholds={
+            "brightness": args.reject_brightness,
+            "contrast": args.reject_contrast,
+        },
+    )
+    pipeline.run(options, args.output)
+
+
+if __name__ == "__main__":
+    main()
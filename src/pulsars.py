@@ -1,15 +1,30 @@
 import os
 import io
+import json
+import threading
 import requests
 import warnings
+import numpy as np
 import astropy.units as u
 from PIL import Image
+from catalogue import load_catalogue
+from cutouts import fits_to_array, is_blank, load_cutout, save_cutout, to_image
+from hips import tile_cutout
 from urllib.parse import urlencode
 from astroquery.simbad import Simbad
 from astropy.coordinates import SkyCoord
 from astropy.utils.exceptions import AstropyWarning
 
 image_folder = "images"
+default_fov = 1
+cache_folder = "cache"
+coordinate_file = os.path.join(cache_folder, "coordinates.json")
+
+# When set, coordinates are only ever read from the local cache
+offline = False
+
+_coordinate_cache = None
+_coordinate_lock = threading.Lock()
 
 
 def fetch_pulsar_coordinates(pulsar_name):
@@ -24,7 +39,132 @@ def fetch_pulsar_coordinates(pulsar_name):
     return coordinates
 
 
-def list_pulsars(options):
+def _coordinate_key(pulsar_name):
+    return pulsar_name.replace("PSR", "").strip()
+
+
+def _load_coordinate_cache():
+    global _coordinate_cache
+    if _coordinate_cache is None:
+        try:
+            with open(coordinate_file) as f:
+                _coordinate_cache = json.load(f)
+        except (OSError, ValueError):
+            _coordinate_cache = {}
+    return _coordinate_cache
+
+
+def _save_coordinate_cache():
+    os.makedirs(os.path.dirname(coordinate_file) or ".", exist_ok=True)
+    temp_file = coordinate_file + ".tmp"
+    with open(temp_file, "w") as f:
+        json.dump(_coordinate_cache, f, indent=1, sort_keys=True)
+    os.replace(temp_file, coordinate_file)
+
+
+def coordinate_details(coordinates, index=0):
+    return {
+        "RA": float(coordinates.ra.deg[index]),
+        "DEC": float(coordinates.dec.deg[index]),
+        "GLON": float(coordinates.galactic.l.deg[index]),
+        "GLAT": float(coordinates.galactic.b.deg[index]),
+    }
+
+
+def cache_coordinates(entries, overwrite=True):
+    with _coordinate_lock:
+        cache = _load_coordinate_cache()
+        entries = {
+            _coordinate_key(name): details
+            for name, details in entries.items()
+            if overwrite or _coordinate_key(name) not in cache
+        }
+        if entries:
+            cache.update(entries)
+            _save_coordinate_cache()
+
+
+def get_pulsar_coordinates(pulsar_name):
+    key = _coordinate_key(pulsar_name)
+    with _coordinate_lock:
+        cache = _load_coordinate_cache()
+        if key in cache:
+            return dict(cache[key])
+
+    if offline:
+        raise ValueError("Pulsar not found in local coordinate cache.")
+
+    details = coordinate_details(fetch_pulsar_coordinates(f"PSR {key}"))
+    cache_coordinates({key: details})
+    return dict(details)
+
+
+def resolve_pulsars(pulsar_names, batch_size=200):
+    keys = list(dict.fromkeys(_coordinate_key(name) for name in pulsar_names))
+    with _coordinate_lock:
+        cache = _load_coordinate_cache()
+        missing = [key for key in keys if key not in cache]
+
+    if missing and not offline:
+        warnings.simplefilter("ignore", AstropyWarning)
+        for start in range(0, len(missing), batch_size):
+            batch = missing[start : start + batch_size]
+            try:
+                result = Simbad.query_objects([f"PSR {key}" for key in batch])
+            except Exception as e:
+                print(f"Failed to resolve pulsars: {e}")
+                continue
+            if result is None or len(result) == 0:
+                continue
+
+            # Names SIMBAD can't resolve are dropped, so map rows back by script index
+            if "SCRIPT_NUMBER_ID" in result.colnames:
+                indices = [int(i) - 1 for i in result["SCRIPT_NUMBER_ID"]]
+            elif "user_specified_id" in result.colnames:
+                indices = [
+                    batch.index(_coordinate_key(name))
+                    for name in result["user_specified_id"]
+                ]
+            elif len(result) == len(batch):
+                indices = list(range(len(batch)))
+            else:
+                print("Failed to resolve pulsars: unmatched SIMBAD response")
+                continue
+
+            coordinates = SkyCoord(
+                ra=result["RA"], dec=result["DEC"], unit=(u.hourangle, u.deg)
+            )
+            cache_coordinates(
+                {
+                    batch[index]: coordinate_details(coordinates, row)
+                    for row, index in enumerate(indices)
+                }
+            )
+
+    with _coordinate_lock:
+        cache = _load_coordinate_cache()
+        return {
+            name: dict(cache[_coordinate_key(name)])
+            for name in pulsar_names
+            if _coordinate_key(name) in cache
+        }
+
+
+def list_pulsars(options, session=None):
+    try:
+        catalogue = load_catalogue(session=session)
+    except Exception as e:
+        print(f"Failed to load ATNF snapshot, querying psrcat instead: {e}")
+        return query_psrcat(options, session)
+
+    pulsars = catalogue.query(options)
+
+    # The snapshot already has positions, so SIMBAD is only a fallback
+    cache_coordinates(catalogue.coordinates(pulsars), overwrite=False)
+    return pulsars
+
+
+def query_psrcat(options, session=None):
     pulsars = []
     conditions = []
 
@@ -54,7 +194,7 @@ def list_pulsars(options):
         condition_string += f"+&&+pulsar_names=+{pulsar_name}"
 
     url = f"https://www.atnf.csiro.au/research/pulsar/psrcat/proc_form.php?version=2.1.1&Name=Name&sort_attr=jname&sort_order=asc&condition={condition_string}&state=query&table_bottom.x=45&table_bottom.y=2"
-    response = requests.get(url).text
+    response = (session or requests).get(url).text
     list = response.split("<pre>")[1].split("</pre>")[0]
 
     for line in list.split("\n"):
@@ -69,74 +209,136 @@ def list_pulsars(options):
     return pulsars
 
 
-def save_pulsar(pulsar_name, hips, fov=1):
+def save_pulsar(
+    pulsar_name,
+    hips,
+    fov=1,
+    coordinates=None,
+    session=None,
+    manifest=None,
+    coverage=None,
+    image_format="jpg",
+    backend="hips2fits",
+    store=None,
+):
     pulsar_name = "PSR " + pulsar_name
     try:
-        coordinates = fetch_pulsar_coordinates(pulsar_name)
-
-        details = {
-            "Name": pulsar_name,
-            "RA": coordinates.ra.deg[0],
-            "DEC": coordinates.dec.deg[0],
-            "GLON": coordinates.galactic.l.deg[0],
-            "GLAT": coordinates.galactic.b.deg[0],
-        }
+        if coordinates is None:
+            coordinates = get_pulsar_coordinates(pulsar_name)
+        details = {"Name": pulsar_name, **coordinates}
 
         image_path = os.path.join(
-            image_folder,
-            f"{pulsar_name.replace('PSR ', '')}_{hips.replace('/', '-')}.jpg",
+            image_folder, image_filename(pulsar_name, hips, image_format, fov)
         )
 
-        # Prepare API request
-        query_params = {
-            "hips": hips,
-            "format": "jpg",
-            "ra": coordinates.ra.deg[0],
-            "dec": coordinates.dec.deg[0],
-            "fov": (int(fov) * u.arcmin).to(u.deg).value,
-            "width": 500,
-            "height": 500,
-        }
+        if backend == "tiles":
+            # Assemble the cutout locally from cached HiPS tiles
+            data = tile_cutout(
+                hips,
+                details["RA"],
+                details["DEC"],
+                (float(fov) * u.arcmin).to(u.deg).value,
+                image_format=image_format,
+                session=session,
+            )
+            content = None
+        else:
+            # Prepare API request
+            query_params = {
+                "hips": hips,
+                "format": image_format,
+                "ra": details["RA"],
+                "dec": details["DEC"],
+                "fov": (float(fov) * u.arcmin).to(u.deg).value,
+                "width": 500,
+                "height": 500,
+            }
 
-        url = f"http://alasky.u-strasbg.fr/hips-image-services/hips2fits?{urlencode(query_params)}"
-        response = requests.get(url)
-        response.raise_for_status()  # Raises an HTTPError for bad responses
+            url = f"http://alasky.u-strasbg.fr/hips-image-services/hips2fits?{urlencode(query_params)}"
+            response = (session or requests).get(url)
+            response.raise_for_status()  # Raises an HTTPError for bad responses
+            content = response.content
+            data = fits_to_array(content) if image_format == "fits" else None
 
         # Save the image
         os.makedirs(image_folder, exist_ok=True)
 
-        # Check if the response content is pure white
-        image = Image.open(io.BytesIO(response.content))
-        if image.getextrema() == ((255, 255), (255, 255), (255, 255)):
-            print(f"Skipping pure white image: {image_path}")
-            return
+        if image_format == "fits":
+            # Keep the flux values as float32 so they can be memory-mapped later
+            if data is None or is_blank(data):
+                print(f"Skipping empty image: {image_path}")
+                if manifest is not None:
+                    manifest.record(pulsar_name, hips, fov, "blank", coverage=coverage)
+                return "blank"
+            save_cutout(image_path, data)
+        else:
+            # Check if the response content is pure white
+            if content is not None:
+                data = np.asarray(Image.open(io.BytesIO(content)))
+            if data is None or is_blank(data):
+                print(f"Skipping pure white image: {image_path}")
+                if manifest is not None:
+                    manifest.record(pulsar_name, hips, fov, "blank", coverage=coverage)
+                return "blank"
+
+            if content is not None:
+                with open(image_path, "wb") as f:
+                    f.write(content)
+            else:
+                Image.fromarray(data).save(image_path, "JPEG", quality=95)
+
+        # Once a packed store exists the sorter reads from it, so new
+        # downloads go in there as well as the folder the manifest tracks
+        if store is not None:
+            store.put(pulsar_name.replace("PSR ", ""), hips, fov, data)
 
-        with open(image_path, "wb") as f:
-            f.write(response.content)
+        if coverage is not None and coverage < 1:
+            print(f"Partial survey coverage ({coverage:.0%}): {image_path}")
+        if manifest is not None:
+            manifest.record(
+                pulsar_name, hips, fov, "ok", image_path=image_path, coverage=coverage
+            )
+        return "ok"
 
     except Exception as e:
         debug = True
         if debug:
             print(f"Failed to download image: {e}")
+        if manifest is not None:
+            manifest.record(pulsar_name, hips, fov, "failed", error=str(e))
+        return "failed"
 
 
-def load_pulsar(pulsar_name, hips):
+def image_filename(pulsar_name, hips, image_format="jpg", fov=None):
+    # Cutouts at the default FOV keep the original name, others get an @fov
+    # suffix so each FOV the manifest tracks has a file of its own
+    extension = "npy" if image_format == "fits" else "jpg"
+    suffix = ""
+    if fov is not None and float(fov) != default_fov:
+        suffix = f"@{float(fov):g}"
+    name = f"{pulsar_name.replace('PSR ', '')}_{hips.replace('/', '-')}"
+    return f"{name}{suffix}.{extension}"
+
+
+def parse_image_filename(image_file):
+    # (pulsar, survey, fov), with fov None for files named without a suffix
+    pulsar_name, survey = image_file.split("_", 1)
+    survey = survey.rsplit(".", 1)[0]
+    fov = None
+    if "@" in survey:
+        survey, fov = survey.rsplit("@", 1)
+        fov = float(fov)
+    return pulsar_name, survey.replace("-", "/"), fov
+
+
+def load_pulsar(pulsar_name, hips, image_format="jpg", fov=None):
     image_path = os.path.join(
-        image_folder,
-        f"{pulsar_name.replace('PSR ', '')}_{hips.replace('/', '-')}.jpg",
+        image_folder, image_filename(pulsar_name, hips, image_format, fov)
     )
     details = {}
 
     try:
-        coordinates = fetch_pulsar_coordinates(pulsar_name)
-
-        details = {
-            "Name": pulsar_name,
-            "RA": coordinates.ra.deg[0],
-            "DEC": coordinates.dec.deg[0],
-            "GLON": coordinates.galactic.l.deg[0],
-            "GLAT": coordinates.galactic.b.deg[0],
-        }
+        details = {"Name": pulsar_name, **get_pulsar_coordinates(pulsar_name)}
 
     except Exception as e:
         debug = False
@@ -144,7 +346,10 @@ def load_pulsar(pulsar_name, hips):
             print(f"Failed to download image: {e}")
 
     if os.path.exists(image_path):
-        image = Image.open(image_path)
+        if image_format == "fits":
+            image = to_image(load_cutout(image_path))
+        else:
+            image = Image.open(image_path)
         return image, details
     else:
         return None
@@ -0,0 +1,130 @@
+import bisect
+
+# Default sort puts images noisier than this in their own tier. It was tuned
+# on the spread of a 200px window, features' window_noise, not on the MAD
+# noise shown in the sorter
+noise_threshold = 50
+
+
+def sort_key(attrs, sort_type="default"):
+    if attrs is None:
+        return (float("inf"), 0, 0, 0)
+
+    brightness = attrs["brightness"]
+    contrast = attrs["contrast"]
+    num_circles = attrs.get("num_circles")
+    noise = attrs["noise"]
+
+    if brightness == 255:
+        return (float("inf"),)
+
+    # Rejected by the first stage of the scoring cascade
+    if attrs.get("stage") == 0:
+        return (float("inf"),)
+
+    if sort_type == "brightness":
+        return (brightness,)
+    elif sort_type == "contrast":
+        return (float("inf"), contrast) if contrast == 0 else (contrast,)
+    elif sort_type == "circles":
+        # Images the arc detector has not reached yet go last
+        if num_circles is None:
+            return (float("inf"),)
+        return (-num_circles,)
+    elif sort_type == "noise":
+        return (float("inf"), noise) if brightness == 255 else (noise,)
+    else:  # default
+        # The classifier's probability, once scored, outranks the hand rule
+        if attrs.get("bow_shock") is not None:
+            return (-1, -attrs["bow_shock"])
+        if attrs["window_noise"] > noise_threshold:
+            return (1, noise, brightness, contrast)
+        brightness_score = brightness
+        contrast_score = contrast
+        return (0, brightness_score, contrast_score, 0)
+
+
+sort_types = ("default", "brightness", "contrast", "noise", "circles")
+
+
+class RankingIndex:
+    # Every (survey, sort type) order is sorted once, on first use, then kept
+    # sorted as attributes arrive, so switching survey or sort type is a
+    # lookup rather than a resort. attributes is the sorter's own
+    # {pulsar: {survey: attrs}} dict, so update() only needs the key
+    def __init__(self, pulsars, attributes):
+        self.pulsars = sorted(pulsars)
+        self.attributes = attributes
+        self.keys = {}
+        self.orders = {}
+        self.rankings = {}
+
+    def key(self, pulsar, survey, sort_type):
+        # NaNs would break the ordering bisect relies on, so they sort last
+        key = sort_key(self.attributes.get(pulsar, {}).get(survey), sort_type)
+        return tuple(float("inf") if value != value else value for value in key)
+
+    def update(self, pulsar, survey):
+        self.rankings.pop((None, "best"), None)
+        for sort_type in sort_types:
+            order = self.orders.get((survey, sort_type))
+            if order is None:
+                continue
+            keys = self.keys[(survey, sort_type)]
+            key = self.key(pulsar, survey, sort_type)
+            if key == keys[pulsar]:
+                continue
+            entry = (keys[pulsar], pulsar)
+            index = bisect.bisect_left(order, entry)
+            if index < len(order) and order[index] == entry:
+                del order[index]
+            else:
+                # Not where its key says, so the order is searched for it
+                order.remove(entry)
+            bisect.insort(order, (key, pulsar))
+            keys[pulsar] = key
+            self.rankings.pop((survey, sort_type), None)
+
+    def order(self, survey, sort_type):
+        if (survey, sort_type) not in self.orders:
+            keys = {
+                pulsar: self.key(pulsar, survey, sort_type) for pulsar in self.pulsars
+            }
+            self.keys[(survey, sort_type)] = keys
+            self.orders[(survey, sort_type)] = sorted(
+                (key, pulsar) for pulsar, key in keys.items()
+            )
+        return self.orders[(survey, sort_type)]
+
+    def best_ranks(self):
+        # Each pulsar's smart sort ranks in every survey, best first and
+        # unscored surveys last, so ties fall to the next best survey
+        surveys = {survey for surveys in self.attributes.values() for survey in surveys}
+        ranks = {pulsar: [] for pulsar in self.pulsars}
+        for survey in surveys:
+            for rank, (key, pulsar) in enumerate(self.order(survey, "default")):
+                if key[0] != float("inf"):
+                    ranks[pulsar].append(rank)
+        padding = [float("inf")] * len(surveys)
+        return sorted(
+            self.pulsars,
+            key=lambda pulsar: (
+                (sorted(ranks[pulsar]) + padding)[: len(surveys)],
+                pulsar,
+            ),
+        )
+
+    def ranking(self, survey, sort_type):
+        # The ordered pulsars and each one's position in them
+        if sort_type in ("alphabetical", "best"):
+            survey = None
+        if (survey, sort_type) not in self.rankings:
+            if sort_type == "alphabetical":
+                pulsars = self.pulsars
+            elif sort_type == "best":
+                pulsars = self.best_ranks()
+            else:
+                pulsars = [pulsar for _, pulsar in self.order(survey, sort_type)]
+            positions = {pulsar: index for index, pulsar in enumerate(pulsars)}
+            self.rankings[(survey, sort_type)] = (pulsars, positions)
+        return self.rankings[(survey, sort_type)]
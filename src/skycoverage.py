@@ -0,0 +1,121 @@
+import os
+import json
+import threading
+import requests
+import numpy as np
+
+moc_folder = os.path.join("cache", "moc")
+moc_url = "https://alasky.cds.unistra.fr/MocServer/query"
+
+_coverages = {}
+_coverage_lock = threading.Lock()
+
+
+def _spread_bits(values, order):
+    spread = np.zeros_like(values)
+    for bit in range(order):
+        spread |= ((values >> bit) & 1) << (2 * bit)
+    return spread
+
+
+def ang2pix_nest(order, ra, dec):
+    # Vectorized port of the HEALPix C++ loc2pix for the NESTED scheme
+    nside = 1 << order
+    z = np.sin(np.radians(dec))
+    za = np.abs(z)
+    tt = np.mod(np.radians(ra) / (np.pi / 2), 4.0)
+
+    temp1 = nside * (0.5 + tt)
+    temp2 = nside * z * 0.75
+    jp = (temp1 - temp2).astype(np.int64)
+    jm = (temp1 + temp2).astype(np.int64)
+    ifp = jp >> order
+    ifm = jm >> order
+    equatorial_face = np.where(ifp == ifm, ifp | 4, np.where(ifp < ifm, ifp, ifm + 8))
+    equatorial_x = jm & (nside - 1)
+    equatorial_y = nside - (jp & (nside - 1)) - 1
+
+    ntt = np.minimum(3, tt.astype(np.int64))
+    tp = tt - ntt
+    tmp = nside * np.sqrt(3 * (1 - za))
+    jp = np.minimum((tp * tmp).astype(np.int64), nside - 1)
+    jm = np.minimum(((1.0 - tp) * tmp).astype(np.int64), nside - 1)
+    north = z >= 0
+    polar_face = np.where(north, ntt, ntt + 8)
+    polar_x = np.where(north, nside - jm - 1, jp)
+    polar_y = np.where(north, nside - jp - 1, jm)
+
+    equatorial = za <= 2.0 / 3.0
+    face = np.where(equatorial, equatorial_face, polar_face)
+    x = np.where(equatorial, equatorial_x, polar_x)
+    y = np.where(equatorial, equatorial_y, polar_y)
+    return (
+        (face << (2 * order)) + _spread_bits(x, order) + (_spread_bits(y, order) << 1)
+    )
+
+
+class Coverage:
+    def __init__(self, cells):
+        # cells maps HEALPix order -> NESTED pixel indices, as in a MOC
+        self.cells = {
+            int(order): np.unique(np.asarray(pixels, dtype=np.int64))
+            for order, pixels in cells.items()
+            if len(pixels)
+        }
+        self.max_order = max(self.cells, default=0)
+
+    def contains(self, ra, dec):
+        ra = np.atleast_1d(np.asarray(ra, dtype=float))
+        dec = np.atleast_1d(np.asarray(dec, dtype=float))
+        pixels = ang2pix_nest(self.max_order, ra, dec)
+        inside = np.zeros(pixels.shape, dtype=bool)
+        for order, cells in self.cells.items():
+            inside |= np.isin(pixels >> (2 * (self.max_order - order)), cells)
+        return inside
+
+    def fraction(self, ra, dec, fov, samples=9):
+        # Share of a samples x samples grid across each fov x fov cutout
+        # (degrees) that falls inside the footprint
+        ra = np.atleast_1d(np.asarray(ra, dtype=float))[:, None]
+        dec = np.atleast_1d(np.asarray(dec, dtype=float))[:, None]
+        offsets = np.linspace(-fov / 2, fov / 2, samples)
+        dx, dy = [grid.ravel()[None, :] for grid in np.meshgrid(offsets, offsets)]
+        grid_dec = np.clip(dec + dy, -90, 90)
+        grid_ra = ra + dx / np.maximum(np.cos(np.radians(grid_dec)), 1e-6)
+        inside = self.contains(grid_ra.ravel(), grid_dec.ravel())
+        return inside.reshape(grid_ra.shape).mean(axis=1)
+
+
+def moc_path(survey):
+    return os.path.join(moc_folder, f"{survey.strip('/').replace('/', '-')}.json")
+
+
+def load_coverage(survey, session=None):
+    survey = survey.strip().strip("/")
+    with _coverage_lock:
+        if survey in _coverages:
+            return _coverages[survey]
+
+    path = moc_path(survey)
+    try:
+        if os.path.exists(path):
+            with open(path) as f:
+                cells = json.load(f)
+        else:
+            response = (session or requests).get(
+                moc_url, params={"ID": survey, "get": "moc", "fmt": "json"}
+            )
+            response.raise_for_status()
+            cells = response.json()
+            os.makedirs(moc_folder, exist_ok=True)
+            with open(path, "w") as f:
+                json.dump(cells, f)
+        coverage = Coverage(cells) if cells else None
+    except Exception as e:
+        # Without a footprint nothing is pruned
+        print(f"Failed to load coverage for {survey}: {e}")
+        coverage = None
+
+    with _coverage_lock:
+        _coverages[survey] = coverage
+    return coverage
@@ -1,15 +1,68 @@
 import io
 import os
-import cv2
+import time
+import queue
+import threading
+import multiprocessing
+import concurrent.futures
 import numpy as np
 import tkinter as tk
 from tkinter import ttk, messagebox
-from pulsars import fetch_pulsar_coordinates
-from PIL import Image, ImageTk, ImageDraw, ImageEnhance
+from pulsars import get_pulsar_coordinates
+from cutouts import display_stretch, load_cutout, to_image
+from packstore import PackedStore, loose_files
+from features import (
+    cascade_report,
+    cascade_thresholds,
+    detect_arcs,
+    eager_features,
+    score_chunk,
+)
+from featurestore import FeatureStore, source_signature
+from classifier import Classifier, model_path, tflite_path
+from denoise import denoise_array, denoise_params
+from imagecache import ImageCache
+from ranking import RankingIndex
+from stretch import (
+    float_levels,
+    interval,
+    interval_methods,
+    level_values,
+    quantize,
+    stretch_lut,
+    stretches,
+)
+from PIL import Image, ImageTk, ImageDraw
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 from matplotlib.widgets import Slider
 
+# FOV in arcmin shown for surveys downloaded at several
+display_fov = 1
+
+# Seconds between re-ranks of the listbox while attributes stream in
+rank_interval = 1.0
+
+# Arcs are searched for lazily: in viewed images and the best ranked ones,
+# unless every image should be searched while the sorter loads
+arc_candidates = 50
+detect_all_arcs = False
+
+# Pulsars decoded ahead of and behind the selection while browsing the list
+prefetch_ahead = 3
+prefetch_behind = 1
+
+# Bytes of denoised images kept, so they are shown again on coming back
+denoise_cache_budget = 128 * 2**20
+
+# OpenCV already spreads each filter across the cores, so one runs at a time
+# and the rest wait in the queue, where cancel_denoise can still drop them
+denoise_workers = 1
+
+# Rendered images are cached per image and view settings, this many at a time
+display_size = 550
+render_cache_size = 16
+
 
 class PulsarSorter:
     def __init__(self, parent):
@@ -25,6 +78,7 @@ class PulsarSorter:
 
         self.image_frame = ttk.Frame(self.window)
         self.image_frame.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.create_image_widgets()
 
         self.info_frame = ttk.Frame(self.window)
         self.info_frame.pack(side=tk.RIGHT, fill=tk.Y, padx=10, pady=10)
@@ -95,6 +149,25 @@ class PulsarSorter:
         ttk.Label(self.info_frame, text="Zoom").pack(side=tk.TOP, fill=tk.X)
         self.zoom_slider.pack(side=tk.TOP, fill=tk.X, pady=0)
 
+        # Stretch function and the limits it spans
+        stretch_frame = ttk.Frame(self.info_frame)
+        stretch_frame.pack(side=tk.TOP, fill=tk.X, pady=(5, 0))
+        self.stretch_var = tk.StringVar(value="linear")
+        self.limits_var = tk.StringVar(value="auto")
+        for variable, values in [
+            (self.stretch_var, stretches),
+            (self.limits_var, interval_methods),
+        ]:
+            combobox = ttk.Combobox(
+                stretch_frame,
+                textvariable=variable,
+                values=values,
+                state="readonly",
+                width=8,
+            )
+            combobox.pack(side=tk.LEFT, fill=tk.X, expand=True)
+            combobox.bind("<<ComboboxSelected>>", lambda event: self.update_image())
+
         ttk.Separator(self.info_frame, orient="horizontal").pack(fill="x", pady=10)
 
         self.sort_frame = ttk.Frame(self.info_frame)
@@ -135,6 +208,20 @@ class PulsarSorter:
         )
         self.noise_button.pack(side=tk.TOP, fill=tk.X, pady=2)
 
+        self.arcs_button = ttk.Button(
+            self.sort_frame,
+            text="Sort by Arcs",
+            command=self.sort_by_arcs,
+        )
+        self.arcs_button.pack(side=tk.TOP, fill=tk.X, pady=2)
+
+        self.best_button = ttk.Button(
+            self.sort_frame,
+            text="Sort by Best Survey",
+            command=lambda: self.sort_pulsars("best"),
+        )
+        self.best_button.pack(side=tk.TOP, fill=tk.X, pady=2)
+
         ttk.Separator(self.sort_frame, orient="horizontal").pack(fill="x", pady=10)
 
         self.denoise_button = ttk.Button(
@@ -144,6 +231,27 @@ class PulsarSorter:
         )
         self.denoise_button.pack(side=tk.TOP, fill=tk.X, pady=2)
 
+        # Filter strength and the patch and search window sizes
+        denoise_frame = ttk.Frame(self.sort_frame)
+        denoise_frame.pack(side=tk.TOP, fill=tk.X)
+        self.denoise_vars = {}
+        for name, label, low, high, step in [
+            ("h", "h", 1, 40, 1),
+            ("template_window", "Patch", 3, 11, 2),
+            ("search_window", "Search", 7, 35, 2),
+        ]:
+            variable = tk.IntVar(value=denoise_params[name])
+            ttk.Label(denoise_frame, text=label).pack(side=tk.LEFT)
+            ttk.Spinbox(
+                denoise_frame,
+                textvariable=variable,
+                from_=low,
+                to=high,
+                increment=step,
+                width=3,
+            ).pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(2, 4))
+            self.denoise_vars[name] = variable
+
         ttk.Separator(self.sort_frame, orient="horizontal").pack(fill="x", pady=10)
 
         def copy_to_clipboard_with_feedback():
@@ -187,12 +295,24 @@ class PulsarSorter:
 
         self.current_zoom = 1.0
         self.current_pulsar = None
+        self.image_store = PackedStore() if PackedStore.exists() else None
         self.pulsar_image_dict = self.create_pulsar_image_dict()
         self.current_survey = "CDS/P/VPHAS/DR4/Halpha"
         self.pulsar_attributes = {}
+        self.ranking = RankingIndex(self.pulsar_image_dict, self.pulsar_attributes)
+        self.listed_pulsars = None
+        self.sort_type = "default"
         self.populate_listbox()
-        self.calculate_all_pulsar_attributes()
+        if self.pulsar_listbox.size() > 0:
+            self.pulsar_listbox.selection_set(0)
+            self.current_pulsar = self.pulsar_listbox.get(0)
+        self.start_prefetcher()
+        self.start_denoiser()
         self.load_pulsar_images()
+        if self.current_pulsar is not None:
+            self.prefetch_neighbours(0)
+        self.start_attribute_workers()
+        self.start_classifier()
 
         # Initialize matplotlib figure and axes
         # self.fig, self.ax = plt.subplots(figsize=(5.5, 5.5))
@@ -204,6 +324,9 @@ class PulsarSorter:
         self.survey_offsets = {
             survey: 0 for survey in self.pulsar_image_dict[self.current_pulsar].keys()
         }
+        self.survey_stack = None
+        self.combined_cache = None
+        self.combined_pending = False
 
         # Center the window
         parent.eval(f"tk::PlaceWindow {str(self.window)} center")
@@ -280,7 +403,6 @@ class PulsarSorter:
         apply_to_viewer_checkbox.pack(side=tk.BOTTOM, pady=10)
 
         # Initialize with the combined image
-        self.combined_image = self.create_combined_image()
         self.settings_image_label = ttk.Label(self.settings_image_frame)
         self.settings_image_label.pack(fill=tk.BOTH, expand=True)
         self.update_combined_image()
@@ -288,7 +410,7 @@ class PulsarSorter:
     def update_survey_offset(self, survey, value):
         self.survey_offsets[survey] = value
         self.entry_vars[survey].set(f"{value:.1f}")
-        self.update_combined_image()
+        self.schedule_combined_image()
 
     def update_from_entry(self, survey):
         try:
@@ -296,22 +418,85 @@ class PulsarSorter:
             value = max(-100, min(100, value))  # Clamp value between -100 and 100
             self.survey_sliders[survey].set(value)
             self.survey_offsets[survey] = value
-            self.update_combined_image()
+            self.schedule_combined_image()
         except ValueError:
             # If the entry is not a valid float, reset it to the current slider value
             self.entry_vars[survey].set(f"{self.survey_offsets[survey]:.1f}")
 
+    def load_survey_stack(self):
+        # The pulsar's cutouts, decoded once into one float32 (S, H, W, C)
+        # stack for as long as the pulsar and its surveys stay the same
+        key = (self.current_pulsar, tuple(self.survey_offsets))
+        if self.survey_stack is not None and self.survey_stack[0] == key:
+            return self.survey_stack[1:]
+
+        surveys, images = [], []
+        for survey in self.survey_offsets:
+            img = self.load_survey_image(survey)
+            if img is not None:
+                surveys.append(survey)
+                # Single-band flux cutouts broadcast against RGB ones
+                images.append(img[..., None] if img.ndim == 2 else img)
+        if not images:
+            # Nothing loaded, so there is nothing to combine
+            self.survey_stack = (key, surveys, None, False)
+            self.combined_cache = None
+            return surveys, None, False
+        shape = np.broadcast_shapes(*(img.shape for img in images))
+        stack = np.empty((len(images), *shape), dtype=np.float32)
+        for layer, img in zip(stack, images):
+            layer[...] = img
+        uint8 = all(img.dtype == np.uint8 for img in images)
+
+        self.survey_stack = (key, surveys, stack, uint8)
+        self.combined_buffer = np.empty(shape, dtype=np.float32)
+        self.combined_cache = None
+        return surveys, stack, uint8
+
     def create_combined_image(self):
-        combined_image = np.zeros_like(
-            self.load_survey_image(list(self.survey_offsets.keys())[0]), dtype=float
+        surveys, stack, uint8 = self.load_survey_stack()
+        if stack is None:
+            return None
+        weights = np.array(
+            [self.survey_offsets[survey] / 100 for survey in surveys], dtype=np.float32
         )
-        for survey, offset in self.survey_offsets.items():
-            img = self.load_survey_image(survey)
-            combined_image += (offset / 100) * img
-        return np.clip(combined_image, 0, 255).astype(np.uint8)
+        key = tuple(weights)
+        if self.combined_cache is not None and self.combined_cache[0] == key:
+            return self.combined_cache[1]
+
+        # One weighted sum over the survey axis, into the same buffer
+        np.matmul(
+            weights,
+            stack.reshape(len(stack), -1),
+            out=self.combined_buffer.reshape(-1),
+        )
+        combined_image = self.combined_buffer
+        if combined_image.shape[-1] == 1:
+            combined_image = combined_image[..., 0]
+
+        if uint8:
+            combined_image = np.clip(combined_image, 0, 255).astype(np.uint8)
+        else:
+            combined_image = display_stretch(combined_image)
+        self.combined_cache = (key, combined_image)
+        return combined_image
+
+    def schedule_combined_image(self):
+        # Slider events arrive faster than frames, so only the latest
+        # offsets are rendered, once the queued events have been handled
+        if not self.combined_pending:
+            self.combined_pending = True
+            self.window.after_idle(self.update_combined_image)
 
     def update_combined_image(self):
+        self.combined_pending = False
+        if not self.settings_image_label.winfo_exists():
+            return
         self.combined_image = self.create_combined_image()
+        if self.combined_image is None:
+            self.settings_image_label.configure(image="")
+            self.settings_image_label.image = None
+            return
         img = Image.fromarray(self.combined_image)
         img = img.resize((550, 550))  # Resize the image to fit the window
         img = ImageTk.PhotoImage(img)
@@ -319,23 +504,39 @@ class PulsarSorter:
         self.settings_image_label.image = img
 
     def load_survey_image(self, survey):
-        image_file = self.pulsar_image_dict[self.current_pulsar][survey]
-        image_path = os.path.join("images", image_file)
-        return np.array(Image.open(image_path))
-
-    def update_survey_offset(self, survey, value):
-        self.survey_offsets[survey] = value
-        self.update_combined_image()
+        return self.load_image_data(self.current_pulsar, survey)
+
+    def load_image_data(self, pulsar, survey):
+        # Entries are store keys when a packed store exists, filenames otherwise
+        source = self.pulsar_image_dict[pulsar][survey]
+        if isinstance(source, tuple):
+            return self.image_store.get(*source)
+        image_path = os.path.join("images", source)
+        if not os.path.exists(image_path):
+            return None
+        return load_cutout(image_path)
 
     def create_pulsar_image_dict(self):
+        # Store keys first, then any loose files the store doesn't have yet
+        sources = {}
+        if self.image_store is not None:
+            sources = {key: key for key in self.image_store.keys()}
+        for key, image_file in loose_files("images", display_fov).items():
+            sources.setdefault(key, image_file)
+
+        # One field per survey: display_fov where it was downloaded, otherwise
+        # the narrowest FOV there is
+        chosen = {}
+        for pulsar_name, survey, fov in sources:
+            best = chosen.get((pulsar_name, survey))
+            if best is None or (fov != display_fov, fov) < (best != display_fov, best):
+                chosen[(pulsar_name, survey)] = fov
+
         pulsar_image_dict = {}
-        image_files = os.listdir("images")
-        for image_file in image_files:
-            pulsar_name, survey = image_file.split("_", 1)
-            survey = survey.rsplit(".", 1)[0].replace("-", "/")
-            if pulsar_name not in pulsar_image_dict:
-                pulsar_image_dict[pulsar_name] = {}
-            pulsar_image_dict[pulsar_name][survey] = image_file
+        for (pulsar_name, survey), fov in sorted(chosen.items()):
+            pulsar_image_dict.setdefault(pulsar_name, {})[survey] = sources[
+                (pulsar_name, survey, fov)
+            ]
         return pulsar_image_dict
 
     def populate_listbox(self):
@@ -344,47 +545,266 @@ class PulsarSorter:
         for pulsar in pulsars:
             self.pulsar_listbox.insert(tk.END, pulsar)
 
-    def calculate_all_pulsar_attributes(self):
-        for pulsar, surveys in self.pulsar_image_dict.items():
-            for survey, image_file in surveys.items():
-                image_path = os.path.join("images", image_file)
-                if os.path.exists(image_path):
-                    pulsar, survey, attributes = self.calculate_image_attributes(
-                        pulsar, survey, image_path
-                    )
-                    if pulsar not in self.pulsar_attributes:
-                        self.pulsar_attributes[pulsar] = {}
-                    self.pulsar_attributes[pulsar][survey] = attributes
+    def start_attribute_workers(self, chunk_size=64):
+        # Attributes already in the feature store for this version of the
+        # image are used as they are, only missing or stale columns are scored
+        self.feature_store = FeatureStore()
+        self.image_sources = {}
+        self.pending_attributes = {}
+        names = eager_features + (["num_circles"] if detect_all_arcs else [])
+        jobs = []
+        for pulsar in sorted(self.pulsar_image_dict):
+            for survey, source in self.pulsar_image_dict[pulsar].items():
+                if not isinstance(source, tuple):
+                    source = os.path.join("images", source)
+                try:
+                    signature = source_signature(source, self.image_store)
+                except (OSError, KeyError):
+                    continue
+                self.image_sources[(pulsar, survey)] = (source, signature)
+                cached, missing = self.feature_store.lookup(
+                    pulsar, survey, signature, names
+                )
+                self.merge_attributes(pulsar, survey, cached)
+                if missing:
+                    jobs.append((pulsar, survey, source, missing))
+
+        self.attribute_results = queue.Queue()
+        self.attribute_executor = None
+        self.pending_chunks = 0
+        self.cascade_stages = []
+        self.unranked = bool(self.pulsar_attributes)
+        self.submit_attribute_jobs(jobs, chunk_size)
+
+        self.last_rank = time.monotonic()
+        self.window.bind("<Destroy>", self.stop_attribute_workers)
+        self.window.after(100, self.poll_attributes)
+
+    def submit_attribute_jobs(self, jobs, chunk_size=64):
+        # Score in worker processes, in the order given, and stream each
+        # finished chunk back to the Tk thread through a queue
+        if not jobs:
+            return
+        if self.attribute_executor is None:
+            self.attribute_executor = concurrent.futures.ProcessPoolExecutor(
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        store_folder = self.image_store.folder if self.image_store else None
+        for start in range(0, len(jobs), chunk_size):
+            future = self.attribute_executor.submit(
+                score_chunk,
+                jobs[start : start + chunk_size],
+                store_folder,
+                cascade_thresholds,
+            )
+            future.add_done_callback(self.attribute_results.put)
+            self.pending_chunks += 1
+
+    def merge_attributes(self, pulsar, survey, attributes):
+        # Images only join the ranking once every eager feature is known
+        if survey in self.pulsar_attributes.get(pulsar, {}):
+            self.pulsar_attributes[pulsar][survey].update(attributes)
+            self.ranking.update(pulsar, survey)
+            return
+        pending = self.pending_attributes.setdefault(
+            (pulsar, survey), {"num_circles": None, "bow_shock": None}
+        )
+        pending.update(attributes)
+        if all(name in pending for name in eager_features):
+            self.pulsar_attributes.setdefault(pulsar, {})[survey] = (
+                self.pending_attributes.pop((pulsar, survey))
+            )
+            self.ranking.update(pulsar, survey)
 
-        self.sort_pulsars()
+    def find_arcs(self, pulsar, survey):
+        img_array = self.load_image_data(pulsar, survey)
+        if img_array is None or (pulsar, survey) not in self.image_sources:
+            return
+        attributes = {"num_circles": detect_arcs(img_array)}
+        self.merge_attributes(pulsar, survey, attributes)
+        signature = self.image_sources[(pulsar, survey)][1]
+        self.feature_store.record(pulsar, survey, signature, attributes)
+
+    def find_top_arcs(self, index=0):
+        # Idle-time search of the best ranked pulsars, one image per tick
+        if not self.window.winfo_exists():
+            return
+        while index < min(arc_candidates, self.pulsar_listbox.size()):
+            pulsar = self.pulsar_listbox.get(index)
+            index += 1
+            attributes = self.pulsar_attributes.get(pulsar, {}).get(self.current_survey)
+            if attributes is not None and attributes["num_circles"] is None:
+                self.find_arcs(pulsar, self.current_survey)
+                self.window.after(1, self.find_top_arcs, index)
+                return
+
+    def sort_by_arcs(self):
+        # Searches every image that has not been searched yet, re-ranking as
+        # the results arrive
+        jobs = []
+        for (pulsar, survey), (source, _) in self.image_sources.items():
+            attributes = self.pulsar_attributes.get(pulsar, {}).get(survey)
+            if attributes is None:
+                attributes = self.pending_attributes.get((pulsar, survey), {})
+            if attributes.get("num_circles") is None:
+                jobs.append((pulsar, survey, source, ["num_circles"]))
+
+        idle = self.pending_chunks == 0
+        self.submit_attribute_jobs(jobs)
+        if idle and jobs:
+            self.window.after(100, self.poll_attributes)
+        self.sort_pulsars("circles")
+
+    def stop_attribute_workers(self, event=None):
+        if event is not None and event.widget is not self.window:
+            return
+        self.classifier_jobs.put(None)
+        self.prefetch_requests.put(None)
+        self.denoise_executor.shutdown(wait=False, cancel_futures=True)
+        stats = self.image_cache.stats()
+        print(
+            f"Image cache: {stats['hits']} hits, {stats['misses']} misses, "
+            f"{stats['entries']} pulsars in {stats['bytes'] / 2**20:.0f} MB"
+        )
+        if self.attribute_executor is not None:
+            self.attribute_executor.shutdown(wait=False, cancel_futures=True)
+
+    def start_classifier(self):
+        # The model loads in the background while the sorter opens, and
+        # scores the cutouts that survive the cascade once it has finished
+        self.classifier_jobs = queue.Queue()
+        self.classifier_results = queue.Queue()
+        self.classifier_queued = set()
+        self.classifier_pending = 0
+        self.classifier_thread = None
+        if os.path.exists(tflite_path) or os.path.exists(model_path):
+            self.classifier_thread = threading.Thread(
+                target=self.classifier_worker, daemon=True
+            )
+            self.classifier_thread.start()
 
-    def calculate_image_attributes(self, pulsar, survey, image_path):
-        image = Image.open(image_path)
-        img_array = np.array(image)
+    def classifier_worker(self):
+        try:
+            classifier = Classifier()
+        except Exception as e:
+            print(f"Failed to load the bow shock classifier: {e}")
+            return
 
-        # Calculate brightness
-        brightness = np.mean(img_array)
+        while True:
+            jobs = self.classifier_jobs.get()
+            if jobs is None:
+                return
+            for start in range(0, len(jobs), classifier.batch_size):
+                batch = jobs[start : start + classifier.batch_size]
+                images = [self.load_image_data(*job) for job in batch]
+                batch = [job for job, img in zip(batch, images) if img is not None]
+                images = [img for img in images if img is not None]
+                try:
+                    probabilities = classifier.score(images)
+                except Exception as e:
+                    print(f"Failed to classify images: {e}")
+                    probabilities = [None] * len(batch)
+                self.classifier_results.put(list(zip(batch, probabilities)))
+
+    def queue_classifier_jobs(self):
+        # Best ranked first, skipping junk rejected by the cascade
+        if self.classifier_thread is None or not self.classifier_thread.is_alive():
+            return
+        jobs = []
+        for pulsar in self.pulsar_listbox.get(0, tk.END):
+            for survey, attributes in self.pulsar_attributes.get(pulsar, {}).items():
+                if (pulsar, survey) in self.classifier_queued:
+                    continue
+                if attributes.get("bow_shock") is None and attributes["stage"] != 0:
+                    jobs.append((pulsar, survey))
+        if not jobs:
+            return
+        self.classifier_queued.update(jobs)
+        idle = self.classifier_pending == 0
+        self.classifier_pending += len(jobs)
+        self.classifier_jobs.put(jobs)
+        if idle:
+            self.window.after(100, self.poll_classifier)
+
+    def poll_classifier(self):
+        if not self.window.winfo_exists():
+            return
 
-        # Calculate contrast
-        contrast = np.std(img_array)
+        scored = False
+        while True:
+            try:
+                results = self.classifier_results.get_nowait()
+            except queue.Empty:
+                break
+            self.classifier_pending -= len(results)
+            for (pulsar, survey), probability in results:
+                if probability is None:
+                    continue
+                attributes = {"bow_shock": probability}
+                self.merge_attributes(pulsar, survey, attributes)
+                signature = self.image_sources[(pulsar, survey)][1]
+                self.feature_store.record(pulsar, survey, signature, attributes)
+                scored = True
+
+        if scored and self.sort_type == "default":
+            if time.monotonic() - self.last_rank > rank_interval:
+                self.sort_pulsars(select=False)
+                self.update_attribute_labels()
+                self.last_rank = time.monotonic()
+            else:
+                self.unranked = True
 
-        # Calculate noise from a random 100x100 spot
-        h, w = img_array.shape[:2]
-        x = np.random.randint(0, w - 200)
-        y = np.random.randint(0, h - 200)
-        random_spot = img_array[y : y + 200, x : x + 200]
-        noise = np.std(random_spot)
+        if self.classifier_pending > 0 and self.classifier_thread.is_alive():
+            self.window.after(100, self.poll_classifier)
+        elif self.unranked:
+            self.sort_pulsars(select=False)
+            self.unranked = False
 
-        return (
-            pulsar,
-            survey,
-            {
-                "brightness": brightness,
-                "contrast": contrast,
-                "num_circles": None,
-                "noise": noise,
-            },
-        )
+    def poll_attributes(self):
+        if not self.window.winfo_exists():
+            return
+
+        while True:
+            try:
+                future = self.attribute_results.get_nowait()
+            except queue.Empty:
+                break
+            self.pending_chunks -= 1
+            if future.cancelled():
+                continue
+            try:
+                results = future.result()
+            except Exception as e:
+                print(f"Failed to calculate attributes: {e}")
+                continue
+            for pulsar, survey, attributes in results:
+                signature = self.image_sources[(pulsar, survey)][1]
+                self.feature_store.record(pulsar, survey, signature, attributes)
+                self.merge_attributes(pulsar, survey, attributes)
+                self.cascade_stages.append(attributes["stage"])
+            self.unranked = True
+
+        finished = self.pending_chunks == 0
+        if self.unranked and (
+            finished or time.monotonic() - self.last_rank > rank_interval
+        ):
+            self.sort_pulsars(select=False)
+            self.update_attribute_labels()
+            self.last_rank = time.monotonic()
+            self.unranked = False
+
+        if finished:
+            if self.cascade_stages:
+                print(cascade_report(self.cascade_stages))
+                self.cascade_stages = []
+            self.feature_store.compact()
+            if self.attribute_executor is not None:
+                self.attribute_executor.shutdown(wait=False)
+                self.attribute_executor = None
+            self.window.after_idle(self.find_top_arcs)
+            self.queue_classifier_jobs()
+        else:
+            self.window.after(100, self.poll_attributes)
 
     def copy_to_clipboard(self):
         if self.current_images:
@@ -437,88 +857,133 @@ class PulsarSorter:
         else:
             messagebox.showinfo("No Image", "No image is currently selected.")
 
-    def sort_pulsars(self, sort_type="default"):
-        def sort_key(pulsar):
-            if self.current_survey is None:
-                return (float("inf"), 0, 0, 0)
-
-            attrs = self.pulsar_attributes[pulsar].get(self.current_survey)
-            if attrs is None:
-                return (float("inf"), 0, 0, 0)
-
-            brightness = attrs["brightness"]
-            contrast = attrs["contrast"]
-            num_circles = attrs["num_circles"]
-            noise = attrs["noise"]
-
-            if brightness == 255:
-                return (float("inf"),)
-
-            if sort_type == "brightness":
-                return (brightness,)
-            elif sort_type == "contrast":
-                return (float("inf"), contrast) if contrast == 0 else (contrast,)
-            elif sort_type == "circles":
-                return (
-                    (float("inf"), -num_circles)
-                    if brightness == 255
-                    else (-num_circles,)
-                )
-            elif sort_type == "noise":
-                return (float("inf"), noise) if brightness == 255 else (noise,)
-            elif sort_type == "alphabetical":
-                return (pulsar,)
-            else:  # default
-                if noise > 50:
-                    return (1, noise, brightness, contrast)
-                brightness_score = brightness
-                contrast_score = contrast
-                return (0, brightness_score, contrast_score, 0)
-
-        if sort_type == "alphabetical":
-            sorted_pulsars = sorted(self.pulsar_attributes.keys())
-        else:
-            sorted_pulsars = sorted(self.pulsar_attributes.keys(), key=sort_key)
-        # sorted_pulsars.reverse()
-
-        self.pulsar_listbox.delete(0, tk.END)
-        for pulsar in sorted_pulsars:
-            self.pulsar_listbox.insert(tk.END, pulsar)
+    def sort_pulsars(self, sort_type=None, select=True):
+        if sort_type is not None:
+            self.sort_type = sort_type
+        sorted_pulsars, positions = self.ranking.ranking(
+            self.current_survey, self.sort_type
+        )
 
-        if self.pulsar_listbox.size() > 0:
-            if self.current_pulsar:
-                index = sorted_pulsars.index(self.current_pulsar)
+        scroll = self.pulsar_listbox.yview()[0]
+        if sorted_pulsars is not self.listed_pulsars:
+            # Refill in one call, and only when the order has changed
+            self.pulsar_listbox.delete(0, tk.END)
+            self.pulsar_listbox.insert(tk.END, *sorted_pulsars)
+            self.listed_pulsars = sorted_pulsars
+        self.pulsar_listbox.selection_clear(0, tk.END)
+        index = positions.get(self.current_pulsar)
+
+        if not select:
+            # Re-rank in place without reloading the pulsar being viewed
+            self.pulsar_listbox.yview_moveto(scroll)
+            if index is not None:
                 self.pulsar_listbox.selection_set(index)
-                self.pulsar_listbox.event_generate("<<ListboxSelect>>")
-            else:
-                self.pulsar_listbox.selection_set(0)
-                self.pulsar_listbox.event_generate("<<ListboxSelect>>")
+        elif sorted_pulsars:
+            self.pulsar_listbox.selection_set(index or 0)
+            self.pulsar_listbox.event_generate("<<ListboxSelect>>")
 
     def on_pulsar_selected(self, event):
         selection = event.widget.curselection()
         if selection:
             index = selection[0]
             self.current_pulsar = event.widget.get(index)
+            self.cancel_denoise()
             self.load_pulsar_images()
+            self.prefetch_neighbours(index)
+
+    def start_prefetcher(self):
+        self.image_cache = ImageCache()
+        self.prefetch_requests = queue.Queue()
+        self.selected_index = None
+        threading.Thread(target=self.prefetch_worker, daemon=True).start()
+
+    def prefetch_worker(self):
+        while True:
+            pulsars = self.prefetch_requests.get()
+            if pulsars is None:
+                return
+            for pulsar in pulsars:
+                # A newer selection replaces what is left of this one
+                if not self.prefetch_requests.empty():
+                    break
+                if pulsar in self.image_cache:
+                    continue
+                try:
+                    signature = self.pulsar_signature(pulsar)
+                    images, size = self.decode_pulsar(pulsar)
+                except Exception as e:
+                    print(f"Failed to prefetch {pulsar}: {e}")
+                    continue
+                self.image_cache.put(pulsar, (signature, images), size)
+
+    def prefetch_neighbours(self, index):
+        # Mostly ahead in the direction of travel, and a little behind
+        step = 1
+        if self.selected_index is not None and index < self.selected_index:
+            step = -1
+        self.selected_index = index
+        pulsars = self.listed_pulsars or self.pulsar_listbox.get(0, tk.END)
+        indices = [index + step * offset for offset in range(1, prefetch_ahead + 1)]
+        indices += [index - step * offset for offset in range(1, prefetch_behind + 1)]
+        self.prefetch_requests.put(
+            [pulsars[i] for i in indices if 0 <= i < len(pulsars)]
+        )
+
+    def pulsar_signature(self, pulsar):
+        # Changes when any of the pulsar's cutouts is rewritten, e.g. by
+        # denoise.py or continuum.py while the sorter is open
+        signature = []
+        for source in self.pulsar_image_dict[pulsar].values():
+            if not isinstance(source, tuple):
+                source = os.path.join("images", source)
+            try:
+                signature.append(source_signature(source, self.image_store))
+            except (OSError, KeyError):
+                signature.append(None)
+        return tuple(signature)
+
+    def decode_pulsar(self, pulsar):
+        # Everything the viewer shows for a pulsar, and its size in memory
+        details = self.get_pulsar_details(pulsar)
+        images, size = [], 0
+        for survey in self.pulsar_image_dict[pulsar]:
+            img_array = self.load_image_data(pulsar, survey)
+            if img_array is None:
+                continue
+            image = to_image(img_array)
+            # Stretched from the flux itself, not the 8-bit preview. Copied
+            # out of the store's memory map so a hit doesn't read the disk
+            flux = np.array(img_array) if img_array.dtype.kind == "f" else None
+            images.append((image, details, survey, flux))
+            size += len(image.getbands()) * image.width * image.height
+            size += 0 if flux is None else flux.nbytes
+        return images, size
 
     def load_pulsar_images(self):
         self.current_images = []
+        self.flux_data = {}
         if self.current_pulsar in self.pulsar_image_dict:
-            for survey, image_file in self.pulsar_image_dict[
-                self.current_pulsar
-            ].items():
-                image_path = os.path.join("images", image_file)
-                if os.path.exists(image_path):
-                    image = Image.open(image_path)
-                    coordinates = fetch_pulsar_coordinates(f"PSR {self.current_pulsar}")
-                    details = {
-                        "Name": self.current_pulsar,
-                        "RA": coordinates.ra.deg[0],
-                        "DEC": coordinates.dec.deg[0],
-                        "GLON": coordinates.galactic.l.deg[0],
-                        "GLAT": coordinates.galactic.b.deg[0],
-                    }
-                    self.current_images.append((image, details, survey))
+            if self.image_store is not None:
+                self.image_store.refresh()
+            signature = self.pulsar_signature(self.current_pulsar)
+            entry = self.image_cache.get(self.current_pulsar)
+            if entry is not None and entry[0] != signature:
+                # Rewritten since it was decoded
+                self.image_cache.discard(self.current_pulsar)
+                entry = None
+            if entry is None:
+                images, size = self.decode_pulsar(self.current_pulsar)
+                self.image_cache.put(self.current_pulsar, (signature, images), size)
+            else:
+                images = entry[1]
+            for image, details, survey, flux in images:
+                key = self.denoise_key(self.current_pulsar, survey)
+                if key in self.denoised_images:
+                    # Denoised earlier, so shown that way again
+                    image, flux = self.denoised_images.get(key), None
+                self.current_images.append((image, details, survey))
+                if flux is not None:
+                    self.flux_data[id(image)] = (image, flux)
 
         if self.current_images:
             if self.current_survey and any(
@@ -537,27 +1002,100 @@ class PulsarSorter:
                 "Image Not Found", f"No images found for {self.current_pulsar}"
             )
 
+    def get_pulsar_details(self, pulsar):
+        try:
+            coordinates = get_pulsar_coordinates(f"PSR {pulsar}")
+        except Exception:
+            # Unresolved names (e.g. offline with a cold cache) still display
+            coordinates = {key: float("nan") for key in ("RA", "DEC", "GLON", "GLAT")}
+        return {"Name": pulsar, **coordinates}
+
+    def start_denoiser(self):
+        self.denoise_executor = concurrent.futures.ThreadPoolExecutor(denoise_workers)
+        self.denoise_jobs = {}
+        self.denoise_results = queue.Queue()
+        self.denoised_images = ImageCache(denoise_cache_budget)
+
+    def denoise_settings(self):
+        # The spinboxes' values, with the defaults for any left mid-edit
+        settings = dict(denoise_params)
+        for name, variable in self.denoise_vars.items():
+            try:
+                settings[name] = variable.get()
+            except tk.TclError:
+                pass
+        # Both windows have to be odd
+        for name in ("template_window", "search_window"):
+            settings[name] |= 1
+        return settings
+
+    def denoise_key(self, pulsar, survey):
+        return (pulsar, survey, tuple(sorted(self.denoise_settings().items())))
+
     def denoise(self):
         if not self.current_images:
             return
 
         image, details, hips = self.current_images[self.current_image_index]
+        key = self.denoise_key(self.current_pulsar, hips)
+        if key in self.denoise_jobs or key in self.denoised_images:
+            return
 
-        try:
-
-            # Convert PIL Image to OpenCV format (grayscale)
-            cv_image = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2GRAY)
-            denoised_image = cv2.fastNlMeansDenoising(cv_image, None, 10, 7, 21)
-            denoised_pil = Image.fromarray(denoised_image)
-            self.current_images[self.current_image_index] = (
-                denoised_pil,
-                details,
-                hips,
-            )
+        # Flux is denoised from the cutout itself, not the 8-bit preview
+        flux = self.flux_data.get(id(image), (None, None))
+        data = flux[1] if flux[0] is image else np.asarray(image)
+        future = self.denoise_executor.submit(
+            denoise_array, data, **self.denoise_settings()
+        )
+        self.denoise_jobs[key] = future
+        future.add_done_callback(
+            lambda future, key=key: self.denoise_results.put((key, future))
+        )
+        self.denoise_button.config(text="Denoising...")
+        if len(self.denoise_jobs) == 1:
+            self.window.after(50, self.poll_denoise)
+
+    def cancel_denoise(self):
+        # Queued jobs for pulsars no longer in view; running ones finish and
+        # are cached for when the pulsar comes back
+        for (pulsar, _, _), future in self.denoise_jobs.items():
+            if pulsar != self.current_pulsar:
+                future.cancel()
+
+    def poll_denoise(self):
+        if not self.window.winfo_exists():
+            return
 
-            self.update_image()
-        except:
-            pass
+        while True:
+            try:
+                key, future = self.denoise_results.get_nowait()
+            except queue.Empty:
+                break
+            self.denoise_jobs.pop(key, None)
+            if future.cancelled():
+                continue
+            try:
+                data = future.result()
+            except Exception as e:
+                print(f"Failed to denoise {key[0]} {key[1]}: {e}")
+                continue
+            image = Image.fromarray(data).convert("RGB")
+            self.denoised_images.put(key, image, image.width * image.height * 3)
+            if key[0] == self.current_pulsar:
+                self.show_denoised_images()
+
+        if self.denoise_jobs:
+            self.window.after(50, self.poll_denoise)
+        else:
+            self.denoise_button.config(text="Denoise")
+
+    def show_denoised_images(self):
+        for index, (image, details, hips) in enumerate(self.current_images):
+            key = self.denoise_key(self.current_pulsar, hips)
+            if key in self.denoised_images:
+                denoised = self.denoised_images.get(key)
+                self.current_images[index] = (denoised, details, hips)
+        self.update_image()
 
     def update_image(self, contrast_value=None):
         if len(self.current_images) == 0:
@@ -566,7 +1104,10 @@ class PulsarSorter:
         image, details, hips = self.current_images[self.current_image_index]
         if self.current_survey != hips:
             self.current_survey = hips
-            self.sort_pulsars()  # Resort when survey changes
+            # Re-rank for the new survey, keeping the images already loaded
+            self.sort_pulsars(select=False)
+            if self.pulsar_listbox.curselection():
+                self.pulsar_listbox.see(self.pulsar_listbox.curselection()[0])
 
         self.name_label.config(text=f"Name: {details['Name']}")
         self.ra_label.config(text=f"RA: {details['RA']:.4f}")
@@ -574,95 +1115,180 @@ class PulsarSorter:
         self.glon_label.config(text=f"GLON: {details['GLON']:.4f}")
         self.glat_label.config(text=f"GLAT: {details['GLAT']:.4f}")
 
-        attributes = self.pulsar_attributes[self.current_pulsar][hips]
-        self.brightness_label.config(text=f"Brightness: {attributes['brightness']:.2f}")
-        self.contrast_label.config(text=f"Contrast: {attributes['contrast']:.2f}")
+        self.update_attribute_labels()
 
-        if not attributes["num_circles"]:
-            attributes["num_circles"] = 0
+        self.render_image(image)
+        self.hips_label.config(text=f"Survey: {hips}")
 
-        self.circles_label.config(text=f"Detected Circles: {attributes['num_circles']}")
-        self.noise_label.config(text=f"Noise: {attributes['noise']:.2f}")
+        show_nav = len(self.current_images) > 1 and not self.apply_to_viewer_var.get()
+        if show_nav and not self.nav_frame.winfo_ismapped():
+            self.nav_frame.pack(side=tk.TOP, pady=(0, 0))
+        elif not show_nav:
+            self.nav_frame.pack_forget()
+
+        self.update_button_states()
+
+    def create_image_widgets(self):
+        # Created once and updated in place by render_image
+        self.photo = ImageTk.PhotoImage("RGBA", (display_size, display_size))
+        self.image_label = ttk.Label(self.image_frame, image=self.photo)
+        self.image_label.pack(side=tk.TOP, pady=10)
+
+        self.hips_label = ttk.Label(self.image_frame, text="")
+        self.hips_label.pack(side=tk.TOP, pady=(0, 10))
+
+        self.nav_frame = ttk.Frame(self.image_frame)
+        self.prev_button = ttk.Button(
+            self.nav_frame, text="Previous", command=self.show_previous_image
+        )
+        self.prev_button.pack(side=tk.LEFT, padx=5)
+        self.next_button = ttk.Button(
+            self.nav_frame, text="Next", command=self.show_next_image
+        )
+        self.next_button.pack(side=tk.LEFT, padx=5)
+
+        # Rounded corners and the crosshair, drawn once
+        self.display_mask = Image.new("L", (display_size, display_size), 0)
+        ImageDraw.Draw(self.display_mask).rounded_rectangle(
+            [(0, 0), (display_size, display_size)], 7, fill=255
+        )
+        self.crosshair = Image.new("L", (21, 21), 0)
+        draw = ImageDraw.Draw(self.crosshair)
+        draw.line([(0, 10), (20, 10)], fill=255, width=1)
+        draw.line([(10, 0), (10, 20)], fill=255, width=1)
+
+        self.zoom_cache = {}
+        self.limits_cache = {}
+        self.levels_cache = {}
+        self.enhance_cache = {}
+        self.flux_data = {}
+
+    def cached(self, cache, key, image, render):
+        # Keyed on the image object itself, so a denoised or reloaded image
+        # never picks up a stale render
+        entry = cache.get(key)
+        if entry is None or entry[0] is not image:
+            if len(cache) >= render_cache_size:
+                del cache[next(iter(cache))]
+            entry = cache[key] = (image, render())
+        return entry[1]
+
+    def zoom_image(self, image, flux=None):
+        if self.apply_to_viewer_var.get():
+            # Combined from survey offsets, when any of the surveys loaded
+            combined = self.create_combined_image()
+            if combined is not None:
+                image = Image.fromarray(combined)
 
         crop_width = int(image.width / self.current_zoom)
         crop_height = int(image.height / self.current_zoom)
-
         left = (image.width - crop_width) // 2
         top = (image.height - crop_height) // 2
-        right = left + crop_width
-        bottom = top + crop_height
-
-        if hasattr(self, "apply_to_viewer_var") and self.apply_to_viewer_var.get():
-            # Create a combined image using survey offsets
-            combined_image = np.zeros_like(np.array(image), dtype=float)
-            for survey, offset in self.survey_offsets.items():
-                survey_image = self.load_survey_image(survey)
-                combined_image += (offset / 100) * survey_image
-            combined_image = np.clip(combined_image, 0, 255).astype(np.uint8)
-            cropped_image = Image.fromarray(combined_image).crop(
-                (left, top, right, bottom)
-            )
-        else:
-            cropped_image = image.crop((left, top, right, bottom))
-
-        cropped_image = cropped_image.resize((550, 550))
-
-        # Adjust contrast
+        box = (left, top, left + crop_width, top + crop_height)
+        if flux is not None:
+            # Flux stays float until the lookup table maps it to grey levels
+            flux = Image.fromarray(np.asarray(flux, dtype=np.float32), "F")
+            return np.asarray(flux.crop(box).resize((display_size, display_size)))
+        return image.crop(box).convert("RGB").resize((display_size, display_size))
+
+    def display_levels(self, image, zoomed_image, flux, method, combined):
+        # What the lookup table indexes: grey levels, or flux quantized
+        # between the image's limits, with a histogram of each
+        low, high = self.cached(
+            self.limits_cache,
+            (id(image), combined, method),
+            image,
+            lambda: interval(
+                flux if flux is not None else zoomed_image if combined else image,
+                method,
+            ),
+        )
+        if flux is not None:
+            codes = quantize(zoomed_image, low, high)
+            histogram = np.bincount(codes.ravel(), minlength=float_levels)
+            return codes, level_values(low, high), histogram, low, high
+        histogram = zoomed_image.convert("L").histogram()
+        return zoomed_image, np.arange(256), histogram, low, high
+
+    def render_image(self, image):
         contrast_value = self.contrast_slider.get() / 10
         brightness_value = self.brightness_slider.get() / 10
-        contrast = ImageEnhance.Contrast(cropped_image)
-        cropped_image = contrast.enhance(contrast_value)
-        brightness = ImageEnhance.Brightness(cropped_image)
-        cropped_image = brightness.enhance(brightness_value)
-
-        # Create a new square image with rounded corners on all sides
-        size = min(cropped_image.width, cropped_image.height)
-        square_image = cropped_image.crop((0, 0, size, size))
-        rounded_image = Image.new("RGBA", (size, size), (0, 0, 0, 0))
-        draw = ImageDraw.Draw(rounded_image)
-        draw.rounded_rectangle([(0, 0), (size, size)], 7, fill=(255, 255, 255, 255))
-
-        # Paste the cropped image onto the rounded rectangle
-        rounded_image.paste(cropped_image, (0, 0), rounded_image)
-
-        # Draw crosshair on the rounded image
-        draw = ImageDraw.Draw(rounded_image)
-        self.rounded_image = rounded_image
-        center_x, center_y = rounded_image.width // 2, rounded_image.height // 2
-        draw.line(
-            [(center_x - 10, center_y), (center_x + 10, center_y)], fill="red", width=1
+        stretch = self.stretch_var.get()
+        method = self.limits_var.get()
+        combined = self.apply_to_viewer_var.get() and tuple(self.survey_offsets.items())
+        flux = self.flux_data.get(id(image), (None, None))
+        flux = flux[1] if flux[0] is image and not combined else None
+
+        view = (id(image), self.current_zoom, combined)
+        zoomed_image = self.cached(
+            self.zoom_cache, view, image, lambda: self.zoom_image(image, flux)
         )
-        draw.line(
-            [(center_x, center_y - 10), (center_x, center_y + 10)], fill="red", width=1
+        codes, values, histogram, low, high = self.cached(
+            self.levels_cache,
+            (*view, method),
+            image,
+            lambda: self.display_levels(image, zoomed_image, flux, method, combined),
         )
 
-        photo = ImageTk.PhotoImage(rounded_image)
-
-        for widget in self.image_frame.winfo_children():
-            widget.destroy()
-
-        image_label = ttk.Label(self.image_frame, image=photo)
-        image_label.image = photo
-        image_label.pack(side=tk.TOP, pady=10)
+        def stretch_image():
+            # Limits, stretch, contrast and brightness in one pass
+            lut = stretch_lut(
+                values,
+                low,
+                high,
+                stretch,
+                contrast_value,
+                brightness_value,
+                histogram,
+            )
+            if flux is not None:
+                return Image.fromarray(lut[codes], "L")
+            return codes.point(lut.tolist() * len(codes.getbands()))
+
+        enhanced_image = self.cached(
+            self.enhance_cache,
+            (*view, method, stretch, contrast_value, brightness_value),
+            image,
+            stretch_image,
+        )
 
-        hips_label = ttk.Label(self.image_frame, text=f"Survey: {hips}")
-        hips_label.pack(side=tk.TOP, pady=(0, 10))
+        rounded_image = enhanced_image.convert("RGBA")
+        rounded_image.putalpha(self.display_mask)
+        centre = display_size // 2
+        rounded_image.paste(
+            (255, 0, 0, 255),
+            (centre - 10, centre - 10, centre + 11, centre + 11),
+            self.crosshair,
+        )
+        self.rounded_image = rounded_image
+        # Written into the one PhotoImage the label already shows
+        self.photo.paste(rounded_image)
 
-        if len(self.current_images) > 1 and not self.apply_to_viewer_var.get():
-            nav_frame = ttk.Frame(self.image_frame)
-            nav_frame.pack(side=tk.TOP, pady=(0, 0))
+    def update_attribute_labels(self):
+        if len(self.current_images) == 0:
+            return
 
-            self.prev_button = ttk.Button(
-                nav_frame, text="Previous", command=self.show_previous_image
-            )
-            self.prev_button.pack(side=tk.LEFT, padx=5)
+        hips = self.current_images[self.current_image_index][2]
+        attributes = self.pulsar_attributes.get(self.current_pulsar, {}).get(hips)
+        if attributes is not None and attributes["num_circles"] is None:
+            self.find_arcs(self.current_pulsar, hips)
+        if attributes is None:
+            for label, name in [
+                (self.brightness_label, "Brightness"),
+                (self.contrast_label, "Contrast"),
+                (self.circles_label, "Detected Circles"),
+                (self.noise_label, "Noise"),
+            ]:
+                label.config(text=f"{name}: ...")
+            return
 
-            self.next_button = ttk.Button(
-                nav_frame, text="Next", command=self.show_next_image
-            )
-            self.next_button.pack(side=tk.LEFT, padx=5)
+        self.brightness_label.config(text=f"Brightness: {attributes['brightness']:.2f}")
+        self.contrast_label.config(text=f"Contrast: {attributes['contrast']:.2f}")
 
-        self.update_button_states()
+        self.circles_label.config(
+            text=f"Detected Circles: {int(attributes['num_circles'])}"
+        )
+        self.noise_label.config(text=f"Noise: {attributes['noise']:.2f}")
 
     def on_mouse_move(self, event):
         if not hasattr(self, "rounded_image"):
@@ -754,6 +1380,7 @@ class PulsarSorter:
 
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     root = tk.Tk()
     root.iconphoto(False, tk.PhotoImage(file="icon.png"))
     root.withdraw()  # Hide the root window
@@ -0,0 +1,81 @@
+import numpy as np
+from astropy.visualization import ZScaleInterval
+
+stretches = ("linear", "sqrt", "log", "asinh")
+interval_methods = ("auto", "minmax", "percentile", "zscale")
+percentiles = (0.5, 99.5)
+
+# Same softening as DS9's log and asinh stretches
+log_exponent = 1000
+asinh_softening = 0.1
+
+# Flux cutouts are quantized to this many levels between their limits, so
+# every stretch is still one lookup per pixel
+float_levels = 4096
+
+
+def interval(data, method="auto"):
+    # Black and white points, in the data's own units. Auto keeps 8-bit
+    # images as they were downloaded and shows flux like display_stretch
+    data = np.asarray(data)
+    if method == "auto":
+        if data.dtype == np.uint8:
+            return 0.0, 255.0
+        method = "percentile"
+    if data.ndim == 3:
+        data = data.mean(axis=-1)
+    # Every other pixel is plenty to place the limits
+    sample = np.asarray(data[::2, ::2], dtype=np.float32)
+    sample = sample[np.isfinite(sample)]
+    if sample.size == 0:
+        return 0.0, 1.0
+
+    if method == "zscale":
+        low, high = ZScaleInterval().get_limits(sample)
+    elif method == "percentile":
+        low, high = np.percentile(sample, percentiles)
+    else:
+        low, high = sample.min(), sample.max()
+    if high <= low:
+        high = low + 1
+    return float(low), float(high)
+
+
+def stretch_curve(x, stretch="linear"):
+    if stretch == "sqrt":
+        return np.sqrt(x)
+    if stretch == "log":
+        return np.log1p(log_exponent * x) / np.log1p(log_exponent)
+    if stretch == "asinh":
+        return np.arcsinh(x / asinh_softening) / np.arcsinh(1 / asinh_softening)
+    return x
+
+
+def stretch_lut(
+    values, low, high, stretch="linear", contrast=1.0, brightness=1.0, histogram=None
+):
+    # One table for the limits, the stretch and the contrast and brightness
+    # sliders. values are what each input level stands for, and histogram
+    # counts the pixels at each level. ImageEnhance's contrast pivots on the
+    # image's mean grey, which the histogram gives without another pass
+    x = np.clip((np.asarray(values, dtype=np.float64) - low) / (high - low), 0, 1)
+    levels = stretch_curve(x, stretch) * 255
+    if contrast != 1:
+        pivot = 127.5
+        if histogram is not None and np.sum(histogram) > 0:
+            pivot = int(np.dot(histogram, levels) / np.sum(histogram) + 0.5)
+        # Clipped before brightness, as separate ImageEnhance passes would be
+        levels = np.clip(pivot + contrast * (levels - pivot), 0, 255)
+    levels = levels * brightness
+    return np.clip(levels + 0.5, 0, 255).astype(np.uint8)
+
+
+def quantize(data, low, high, levels=float_levels):
+    # Flux to level indices, with NaNs at the black point
+    scale = (levels - 1) / (high - low)
+    codes = np.nan_to_num((np.asarray(data, dtype=np.float32) - low) * scale, nan=0)
+    return np.clip(codes, 0, levels - 1).astype(np.uint16)
+
+
+def level_values(low, high, levels=float_levels):
+    return np.linspace(low, high, levels)
@@ -0,0 +1,152 @@
+import os
+import time
+import argparse
+import numpy as np
+from classifier import image_size, preprocess
+from cutouts import image_extensions, is_blank, load_cutout
+from pulsars import image_folder
+
+batch_size = 32
+
+# Ranges the arc parameters are drawn from, in pixels of the 64x64 model input
+standoff_range = (3.0, 16.0)
+opening_range = (np.pi / 4, 2.3)  # Half-angle either side of the apex
+width_range = (0.7, 2.0)
+brightness_range = (0.04, 0.4)
+noise_range = (0.0, 0.05)
+
+
+def load_backgrounds(folder=image_folder, limit=None):
+    # Real cutouts, preprocessed once to the model input and kept in memory
+    backgrounds = []
+    for name in sorted(os.listdir(folder)):
+        if not name.endswith(image_extensions):
+            continue
+        try:
+            data = load_cutout(os.path.join(folder, name))
+        except Exception as e:
+            print(f"Skipping background {name}: {e}")
+            continue
+        if is_blank(data):
+            continue
+        backgrounds.append(preprocess(data))
+        if limit is not None and len(backgrounds) >= limit:
+            break
+    if not backgrounds:
+        raise ValueError(f"No usable background cutouts in {folder}")
+    return np.stack(backgrounds)
+
+
+def bow_shock_shape(theta):
+    # Wilkin (1996) thin-shell bow shock: distance from the star relative to
+    # the standoff distance, at angle theta from the apex
+    theta = np.maximum(theta, 1e-3)
+    return np.sqrt(3 * (1 - theta / np.tan(theta))) / np.sin(theta)
+
+
+def render_arcs(count, rng, size=image_size):
+    # The pulsar sits at the centre of every cutout, with the apex of its
+    # arc standoff pixels away in a random direction
+    centre = (size - 1) / 2
+    y, x = np.mgrid[:size, :size] - centre
+    radius = np.hypot(x, y)
+    angle = np.arctan2(y, x)
+
+    orientation = rng.uniform(-np.pi, np.pi, (count, 1, 1))
+    standoff = rng.uniform(*standoff_range, (count, 1, 1))
+    opening = rng.uniform(*opening_range, (count, 1, 1))
+    width = rng.uniform(*width_range, (count, 1, 1))
+    brightness = rng.uniform(*brightness_range, (count, 1, 1))
+
+    theta = np.abs((angle - orientation + np.pi) % (2 * np.pi) - np.pi)
+    shell = standoff * bow_shock_shape(theta)
+    arcs = np.exp(-0.5 * ((radius - shell) / width) ** 2)
+    # Fade along the wings and out past the opening angle
+    arcs *= standoff / shell * np.clip((opening - theta) / 0.3, 0, 1)
+    return (brightness * arcs).astype(np.float32)
+
+
+def synthetic_batch(backgrounds, rng, size=batch_size):
+    # Half the batch gets an arc, and every cutout is flipped, transposed
+    # and given extra noise at random so backgrounds rarely repeat
+    images = backgrounds[rng.integers(len(backgrounds), size=size)]
+    flip = rng.random(size) < 0.5
+    images[flip] = images[flip, :, ::-1]
+    transpose = rng.random(size) < 0.5
+    images[transpose] = images[transpose].transpose(0, 2, 1, 3)
+
+    labels = (rng.random(size) < 0.5).astype(np.float32)
+    positive = labels == 1
+    gain = rng.uniform(0.6, 1.0, (positive.sum(), 1, 1, 3)).astype(np.float32)
+    images[positive] += render_arcs(positive.sum(), rng)[..., None] * gain
+
+    noise = rng.uniform(*noise_range, (size, 1, 1, 1)).astype(np.float32)
+    images += noise * rng.standard_normal(images.shape, dtype=np.float32)
+    return np.clip(images, 0, 1, out=images), labels
+
+
+def stream(backgrounds, size=batch_size, seed=None):
+    rng = np.random.default_rng(seed)
+    while True:
+        yield synthetic_batch(backgrounds, rng, size)
+
+
+def dataset(backgrounds, size=batch_size, workers=None, seed=0):
+    # Batches rendered by map in parallel and prefetched, so the next ones
+    # are ready before model.fit asks for them. The backgrounds stay a
+    # NumPy array the render function closes over rather than becoming a
+    # graph constant, and each batch seeds its own generator so the stream
+    # is the same whichever thread renders it
+    import tensorflow as tf
+
+    def render(index):
+        return synthetic_batch(backgrounds, np.random.default_rng([seed, index]), size)
+
+    def batch(index):
+        images, labels = tf.numpy_function(render, [index], (tf.float32, tf.float32))
+        images.set_shape((size, image_size, image_size, 3))
+        labels.set_shape((size,))
+        return images, labels
+
+    return (
+        tf.data.Dataset.counter()
+        .map(
+            batch,
+            num_parallel_calls=workers or tf.data.AUTOTUNE,
+            deterministic=False,
+        )
+        .prefetch(tf.data.AUTOTUNE)
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time synthetic bow shock generation, or save a preview"
+    )
+    parser.add_argument("--folder", default=image_folder)
+    parser.add_argument("--batches", type=int, default=100)
+    parser.add_argument("--preview", help="Save a grid of one batch to this file")
+    args = parser.parse_args()
+
+    backgrounds = load_backgrounds(args.folder)
+    print(f"Loaded {len(backgrounds)} backgrounds")
+    batches = stream(backgrounds, seed=0)
+
+    if args.preview:
+        from PIL import Image
+
+        images, labels = next(batches)
+        grid = images.reshape(4, -1, image_size, image_size, 3).swapaxes(1, 2)
+        grid = grid.reshape(4 * image_size, -1, 3)
+        Image.fromarray((grid * 255).astype(np.uint8)).save(args.preview)
+        print(f"Saved {args.preview}, labels {labels.astype(int).tolist()}")
+
+    start = time.perf_counter()
+    for _ in range(args.batches):
+        next(batches)
+    seconds = time.perf_counter() - start
+    print(f"{args.batches * batch_size / seconds:.0f} images/s on one core")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,35 @@
+import io
+import json
+import hashlib
+import time
+import threading
 import unittest
+import pulsars
+import downloader
+import manifest
+import catalogue
+import skycoverage
+import cutouts
+import hips
+import packstore
+import pipeline
+import features
+import featurestore
+import classifier
+import synthetic
+import ranking
+import continuum
+import stretch
+import imagecache
+import denoise
+import numpy as np
 from pulsars import fetch_pulsar_coordinates, list_pulsars, load_pulsar, save_pulsar
 from astropy.coordinates import SkyCoord
 import os
-from PIL import Image
+import tempfile
+from unittest import mock
+from astropy.table import Table
+from PIL import Image, ImageEnhance
 
 
 class TestPulsarFunctions(unittest.TestCase):
@@ -57,5 +84,954 @@ class TestPulsarFunctions(unittest.TestCase):
         image.close()
 
 
+class TestCoordinateCache(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.original = (pulsars.coordinate_file, pulsars.offline)
+        pulsars.coordinate_file = os.path.join(self.temp_dir.name, "coordinates.json")
+        pulsars._coordinate_cache = None
+
+    def tearDown(self):
+        pulsars.coordinate_file, pulsars.offline = self.original
+        pulsars._coordinate_cache = None
+        self.temp_dir.cleanup()
+
+    def test_offline_lookup_uses_persisted_cache(self):
+        details = {"RA": 275.43625, "DEC": -3.52, "GLON": 25.45, "GLAT": 4.73}
+        pulsars.cache_coordinates({"PSR J1821-0331": details})
+
+        # Drop the in-memory layer so the lookup has to come from disk
+        pulsars._coordinate_cache = None
+        pulsars.offline = True
+        self.assertEqual(pulsars.get_pulsar_coordinates("J1821-0331"), details)
+        with self.assertRaises(ValueError):
+            pulsars.get_pulsar_coordinates("J0000+0000")
+
+    def test_bulk_resolution_maps_rows_back_to_names(self):
+        result = Table(
+            {
+                "RA": ["18 21 44.7", "18 25 30.6"],
+                "DEC": ["-03 31 12.7", "-09 35 21.1"],
+                "SCRIPT_NUMBER_ID": [1, 3],
+            }
+        )
+        names = ["J1821-0331", "Invalid", "J1825-0935"]
+        with mock.patch.object(
+            pulsars.Simbad, "query_objects", return_value=result
+        ) as query:
+            resolved = pulsars.resolve_pulsars(names + ["PSR J1821-0331"])
+            self.assertEqual(query.call_count, 1)
+            self.assertEqual(
+                set(resolved), {"J1821-0331", "J1825-0935", "PSR J1821-0331"}
+            )
+            self.assertAlmostEqual(resolved["J1825-0935"]["RA"], 276.3775)
+
+            # A second pass over the same names never reaches SIMBAD
+            pulsars.resolve_pulsars(names[:1] + names[2:])
+            self.assertEqual(query.call_count, 1)
+
+
+class TestDownloadEngine(unittest.TestCase):
+    def test_download_respects_hips2fits_limit(self):
+        lock = threading.Lock()
+        active = []
+        peak = []
+
+        def fake_save(*args, **kwargs):
+            with lock:
+                active.append(1)
+                peak.append(len(active))
+            time.sleep(0.01)
+            with lock:
+                active.pop()
+
+        engine = downloader.DownloadEngine(limits={"hips2fits": 3})
+        progress = []
+        coordinates = {f"J{i:04d}": {"RA": 0.0, "DEC": 0.0} for i in range(10)}
+        with mock.patch.object(downloader, "save_pulsar", side_effect=fake_save):
+            completed, total = engine.download(
+                list(coordinates),
+                ["CDS/P/SHS", "CDS/P/allWISE/W3"],
+                coordinates=coordinates,
+                progress=lambda done, total: progress.append(done),
+                resume=False,
+                prune=False,
+            )
+        engine.close()
+
+        self.assertEqual((completed, total), (20, 20))
+        self.assertEqual(progress[-1], 20)
+        self.assertLessEqual(max(peak), 3)
+
+    def test_prune_drops_pairs_outside_footprint(self):
+        # Order 0 pixel 4 is the equatorial face centred on RA 0, Dec 0
+        footprint = skycoverage.Coverage({0: [4]})
+        coordinates = {
+            "J0000+0000": {"RA": 0.0, "DEC": 0.0},
+            "J1200+0000": {"RA": 180.0, "DEC": 0.0},
+        }
+        engine = downloader.DownloadEngine()
+        with mock.patch.object(downloader, "load_coverage", return_value=footprint):
+            jobs, fractions = engine.prune(
+                [(pulsar, "CDS/P/SHS") for pulsar in coordinates], coordinates, 1
+            )
+        engine.close()
+        self.assertEqual(jobs, [("J0000+0000", "CDS/P/SHS")])
+        self.assertEqual(fractions[("J1200+0000", "CDS/P/SHS")], 0)
+
+
+class TestCoverage(unittest.TestCase):
+    def test_ang2pix_nest_matches_healpix(self):
+        # Reference values from the HEALPix C++ library
+        pixels = [
+            skycoverage.ang2pix_nest(order, np.array([ra]), np.array([dec]))[0]
+            for order, ra, dec in [
+                (6, 275.43625, -3.52),
+                (10, 83.63, 22.01),
+                (12, 10.0, -85.0),
+            ]
+        ]
+        self.assertEqual(pixels, [30338, 6191509, 134382882])
+
+    def test_fraction_flags_partial_coverage(self):
+        # Three order 8 cells along the equator near RA 0
+        order = 8
+        ra = np.array([0.0, 0.5, -0.5])
+        dec = np.array([0.0, 0.0, 0.0])
+        footprint = skycoverage.Coverage(
+            {order: skycoverage.ang2pix_nest(order, ra, dec)}
+        )
+        self.assertTrue(footprint.contains(0.0, 0.0)[0])
+        self.assertFalse(footprint.contains(180.0, 0.0)[0])
+        fractions = footprint.fraction([0.0, 180.0], [0.0, 0.0], fov=2.0)
+        self.assertTrue(0 < fractions[0] < 1)
+        self.assertEqual(fractions[1], 0)
+
+
+class TestCutouts(unittest.TestCase):
+    def test_fits_cutouts_round_trip_as_memory_maps(self):
+        from astropy.io import fits
+
+        data = np.arange(12, dtype=np.float64).reshape(3, 4)
+        data[0, 0] = np.nan
+        buffer = io.BytesIO()
+        fits.PrimaryHDU(data).writeto(buffer)
+        array = cutouts.fits_to_array(buffer.getvalue())
+        # Flipped so the first row is north, like the JPEG cutouts
+        self.assertEqual(array[-1, 1], 1.0)
+        self.assertFalse(cutouts.is_blank(array))
+
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "J1821-0331_CDS-P-SHS.npy")
+            cutouts.save_cutout(path, array)
+            loaded = cutouts.load_cutout(path)
+            self.assertIsInstance(loaded, np.memmap)
+            self.assertEqual(loaded.dtype, np.float32)
+            stretched = cutouts.display_stretch(loaded)
+            self.assertEqual(stretched.dtype, np.uint8)
+            self.assertEqual((stretched.min(), stretched.max()), (0, 255))
+            del loaded
+
+    def test_blank_detection(self):
+        self.assertTrue(cutouts.is_blank(np.full((4, 4), np.nan, dtype=np.float32)))
+        self.assertTrue(cutouts.is_blank(np.full((4, 4, 3), 255, dtype=np.uint8)))
+
+
+class TestHipsTiles(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.server = os.path.join(self.temp_dir.name, "server")
+        self.cache = hips.TileCache(os.path.join(self.temp_dir.name, "cache"))
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def write_tiles(self, order, width, ra, dec):
+        # Synthetic FITS tiles whose pixels hold their own HEALPix index
+        from astropy.io import fits
+
+        bits = width.bit_length() - 1
+        os.makedirs(self.server, exist_ok=True)
+        with open(os.path.join(self.server, "properties"), "w") as f:
+            f.write(f"hips_order = {order}\nhips_tile_width = {width}\n")
+            f.write("hips_tile_format = fits\nhips_frame = equatorial\n")
+        ra, dec = np.meshgrid(ra, dec)
+        for ipix in np.unique(skycoverage.ang2pix_nest(order, ra.ravel(), dec.ravel())):
+            sub = np.arange(width**2)
+            x, y = hips._deinterleave(sub, bits)
+            data = np.zeros((width, width), dtype=np.float32)
+            data[width - 1 - x, width - 1 - y] = (ipix << (2 * bits)) + sub
+            path = os.path.join(
+                self.server, f"Norder{order}", "Dir0", f"Npix{ipix}.fits"
+            )
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fits.PrimaryHDU(np.flipud(data)).writeto(path)
+
+    def test_cutout_matches_tan_projection(self):
+        from astropy.wcs import WCS
+
+        self.write_tiles(3, 8, np.linspace(5, 15, 21), np.linspace(15, 25, 21))
+        survey = hips.HipsSurvey("Test/Tiles", base_url=self.server, cache=self.cache)
+        cutout = survey.cutout(
+            10.0, 20.0, 4.0, width=41, height=41, image_format="fits"
+        )
+
+        wcs = WCS(naxis=2)
+        wcs.wcs.ctype = ["RA---TAN", "DEC--TAN"]
+        wcs.wcs.crval = [10.0, 20.0]
+        wcs.wcs.crpix = [21, 21]
+        wcs.wcs.cdelt = [-4.0 / 41, 4.0 / 41]
+        cols, rows = np.meshgrid(np.arange(41), np.arange(41))
+        ra, dec = wcs.wcs_pix2world(cols, 40 - rows, 0)
+        expected = skycoverage.ang2pix_nest(6, ra.ravel(), dec.ravel()).reshape(41, 41)
+        self.assertGreater(np.mean(cutout == expected), 0.999)
+
+        # The second pass is served entirely from the local tile cache
+        survey.base_url = os.path.join(self.temp_dir.name, "missing")
+        self.cache.decoded.clear()
+        again = survey.cutout(10.0, 20.0, 4.0, width=41, height=41, image_format="fits")
+        np.testing.assert_array_equal(again, cutout)
+
+    def test_tile_pixels_follow_the_hips_standard(self):
+        # The NESTED sub-index of each pixel in an 8x8 tile, top row first as
+        # drawn in the HiPS 1.0 standard
+        reference = np.array(
+            [
+                [63, 61, 55, 53, 31, 29, 23, 21],
+                [62, 60, 54, 52, 30, 28, 22, 20],
+                [59, 57, 51, 49, 27, 25, 19, 17],
+                [58, 56, 50, 48, 26, 24, 18, 16],
+                [47, 45, 39, 37, 15, 13, 7, 5],
+                [46, 44, 38, 36, 14, 12, 6, 4],
+                [43, 41, 35, 33, 11, 9, 3, 1],
+                [42, 40, 34, 32, 10, 8, 2, 0],
+            ],
+            dtype=np.uint8,
+        )
+        rng = np.random.default_rng(0)
+        ra, dec = rng.uniform(40, 50, 200), rng.uniform(10, 20, 200)
+        os.makedirs(os.path.join(self.server, "Norder3", "Dir0"))
+        with open(os.path.join(self.server, "properties"), "w") as f:
+            f.write("hips_order = 3\nhips_tile_width = 8\nhips_tile_format = png\n")
+        for ipix in np.unique(skycoverage.ang2pix_nest(3, ra, dec)):
+            Image.fromarray(reference).save(
+                os.path.join(self.server, "Norder3", "Dir0", f"Npix{ipix}.png")
+            )
+
+        survey = hips.HipsSurvey("Test/Tiles", base_url=self.server, cache=self.cache)
+        read = [
+            survey.cutout(r, d, 1e-3, width=1, height=1)[0, 0] for r, d in zip(ra, dec)
+        ]
+        np.testing.assert_array_equal(read, skycoverage.ang2pix_nest(6, ra, dec) % 64)
+
+    def test_missing_tiles_are_cached_and_png_decodes_to_rgb(self):
+        os.makedirs(os.path.join(self.server, "Norder3", "Dir0"))
+        with open(os.path.join(self.server, "properties"), "w") as f:
+            f.write("hips_order = 3\nhips_tile_width = 8\nhips_tile_format = png\n")
+        rgba = np.zeros((8, 8, 4), dtype=np.uint8)
+        rgba[..., 0] = 200
+        Image.fromarray(rgba, "RGBA").save(
+            os.path.join(self.server, "Norder3", "Dir0", "Npix1.png")
+        )
+        survey = hips.HipsSurvey("Test/Tiles", base_url=self.server, cache=self.cache)
+        self.assertEqual(survey.tile(3, 1, "png").shape, (8, 8, 3))
+
+        with mock.patch.object(survey, "read", wraps=survey.read) as read:
+            self.assertIsNone(survey.tile(3, 2, "png"))
+            self.assertIsNone(survey.tile(3, 2, "png"))
+        self.assertEqual(read.call_count, 1)
+
+    def test_touch_indexes_files_it_has_not_seen(self):
+        path = self.cache.path("Test/Tiles", 3, 0, "jpg")
+        os.makedirs(os.path.dirname(path))
+        with open(path, "wb") as f:
+            f.write(b"x" * 10)
+        self.cache.touch(path)
+        self.assertEqual(self.cache.files[path][1], 10)
+        self.assertEqual(self.cache.total_bytes, 10)
+
+    def test_eviction_drops_least_recently_used(self):
+        cache = hips.TileCache(os.path.join(self.temp_dir.name, "small"), max_bytes=25)
+        paths = [cache.path("Test/Tiles", 3, ipix, "jpg") for ipix in range(3)]
+        for i, path in enumerate(paths):
+            cache.store(path, b"x" * 10)
+            os.utime(path, (i, i))
+            cache.files[path] = (i, 10)
+        self.assertFalse(os.path.exists(paths[0]))
+        self.assertTrue(os.path.exists(paths[2]))
+        self.assertLessEqual(cache.total_bytes, 25)
+
+
+class TestPackedStore(unittest.TestCase):
+    def test_migrate_packs_folder_into_slots(self):
+        with tempfile.TemporaryDirectory() as folder:
+            gray = np.full((20, 20, 3), 7, dtype=np.uint8)
+            jpg_path = os.path.join(folder, "J1_CDS-P-VPHAS-DR4-Halpha+.jpg")
+            Image.fromarray(gray).save(jpg_path, quality=100)
+            cutouts.save_cutout(
+                os.path.join(folder, "J2_CDS-P-SHS.npy"), np.ones((20, 20))
+            )
+            # The manifest knows the real survey name behind the filename
+            manifest.DownloadManifest(folder).record(
+                "J1", "CDS/P/VPHAS/DR4/Halpha+", 2, "ok", image_path=jpg_path
+            )
+
+            self.assertEqual(packstore.migrate(folder), 2)
+            store = packstore.PackedStore(os.path.join(folder, "packed"))
+            self.assertEqual(
+                set(store.keys()),
+                {("J1", "CDS/P/VPHAS/DR4/Halpha+", 2), ("J2", "CDS/P/SHS", 1)},
+            )
+            self.assertEqual(
+                store.get("J1", "CDS/P/VPHAS/DR4/Halpha+", 2).shape, (20, 20)
+            )
+            self.assertEqual(store.get("J2", "CDS/P/SHS", 1).dtype, np.float32)
+
+            # Re-running only packs what is new
+            self.assertEqual(packstore.migrate(folder), 0)
+            stacks = {array.dtype.name: keys for keys, array in store.stacks()}
+            self.assertEqual(stacks["float32"], [("J2", "CDS/P/SHS", 1)])
+            store.maps.clear()
+
+    def test_unflushed_puts_and_concurrent_writers_keep_their_pixels(self):
+        def cutout(value):
+            return np.full((4, 4), value, np.float32)
+
+        with tempfile.TemporaryDirectory() as folder:
+            # A run that stops before flushing leaves slots the index lacks
+            store = packstore.PackedStore(folder)
+            store.put("J1", "CDS/P/SHS", 1, cutout(1))
+            store.flush()
+            store.put("J2", "CDS/P/SHS", 1, cutout(2))
+            reopened = packstore.PackedStore(folder)
+            reopened.put("J3", "CDS/P/SHS", 1, cutout(3))
+            reopened.flush()
+            self.assertEqual(reopened.get("J3", "CDS/P/SHS", 1)[0, 0], 3)
+
+            # Two stores open at once, each flushing its own entries
+            first = packstore.PackedStore(folder)
+            second = packstore.PackedStore(folder)
+            first.put("J4", "CDS/P/SHS", 1, cutout(4))
+            second.put("J5", "CDS/P/SHS", 1, cutout(5))
+            first.flush()
+            second.flush()
+            merged = packstore.PackedStore(folder)
+            for value in (1, 3, 4, 5):
+                self.assertEqual(merged.get(f"J{value}", "CDS/P/SHS", 1)[0, 0], value)
+            self.assertNotIn(("J2", "CDS/P/SHS", 1), merged)
+            self.assertFalse(os.path.exists(os.path.join(folder, "index.lock")))
+            for opened in (store, reopened, first, second, merged):
+                opened.maps.clear()
+
+    def test_readers_pick_up_flushed_rewrites(self):
+        with tempfile.TemporaryDirectory() as folder:
+            writer = packstore.PackedStore(folder)
+            writer.put("J1", "CDS/P/SHS", 1, np.zeros((4, 4), np.float32))
+            writer.flush()
+            reader = packstore.PackedStore(folder)
+            before = reader.signature("J1", "CDS/P/SHS", 1)
+
+            writer.put("J1", "CDS/P/SHS", 1, np.ones((4, 4), np.float32))
+            writer.put("J2", "CDS/P/SHS", 1, np.ones((4, 4), np.float32))
+            writer.flush()
+            reader.refresh()
+            self.assertNotEqual(reader.signature("J1", "CDS/P/SHS", 1), before)
+            self.assertEqual(reader.get("J2", "CDS/P/SHS", 1)[0, 0], 1)
+            reader.maps.clear()
+            writer.maps.clear()
+
+    def test_downloads_go_into_existing_store(self):
+        buffer = io.BytesIO()
+        Image.fromarray(np.full((20, 20, 3), 90, dtype=np.uint8)).save(buffer, "PNG")
+        session = mock.Mock()
+        session.get.return_value.content = buffer.getvalue()
+        with tempfile.TemporaryDirectory() as folder:
+            store = packstore.PackedStore(os.path.join(folder, "packed"))
+            with mock.patch.object(pulsars, "image_folder", folder):
+                status = save_pulsar(
+                    "J1",
+                    "CDS/P/SHS",
+                    5,
+                    {"RA": 1.0, "DEC": 2.0},
+                    session=session,
+                    store=store,
+                )
+            self.assertEqual(status, "ok")
+            self.assertEqual(store.get("J1", "CDS/P/SHS", 5).shape, (20, 20))
+            # The loose copy is listed under its FOV too
+            self.assertEqual(
+                packstore.loose_files(folder),
+                {("J1", "CDS/P/SHS", 5): "J1_CDS-P-SHS@5.jpg"},
+            )
+            store.maps.clear()
+
+
+class TestFeatures(unittest.TestCase):
+    def test_score_chunk_reads_paths_and_store_keys(self):
+        rng = np.random.default_rng(3)
+        with tempfile.TemporaryDirectory() as folder:
+            jpg_path = os.path.join(folder, "J1_CDS-P-SHS.jpg")
+            image = rng.normal(40, 10, (256, 256, 3)).clip(0, 255)
+            Image.fromarray(image.astype(np.uint8)).save(jpg_path)
+            store = packstore.PackedStore(folder)
+            flux = rng.normal(2, 0.1, (250, 250)).astype(np.float32)
+            store.put("J2", "CDS/P/SHS", 1, flux)
+            store.flush()
+
+            results = features.score_chunk(
+                [
+                    ("J1", "CDS/P/SHS", jpg_path, None),
+                    ("J2", "CDS/P/SHS", ("J2", "CDS/P/SHS", 1), ["brightness"]),
+                    ("J3", "CDS/P/SHS", os.path.join(folder, "missing.jpg"), None),
+                ],
+                folder,
+            )
+            features._stores.clear()
+
+        # Unreadable images are skipped rather than failing the whole chunk
+        self.assertEqual([result[0] for result in results], ["J1", "J2"])
+        self.assertAlmostEqual(results[0][2]["brightness"], 40, delta=1)
+        self.assertEqual(set(results[1][2]), {"brightness", "stage"})
+        self.assertAlmostEqual(results[1][2]["brightness"], 2, delta=0.01)
+
+    def test_cascade_rejects_junk_at_preview(self):
+        with tempfile.TemporaryDirectory() as folder:
+            chunk = []
+            for pulsar, value in [("J1", 255), ("J2", 90)]:
+                path = os.path.join(folder, f"{pulsar}_CDS-P-SHS.jpg")
+                image = np.full((256, 256, 3), value, dtype=np.uint8)
+                Image.fromarray(image).save(path)
+                chunk.append((pulsar, "CDS/P/SHS", path, None))
+
+            self.assertEqual(features.load_preview(chunk[0][2]).shape, (32, 32, 3))
+            results = features.score_chunk(chunk)
+            # A looser contrast threshold lets the flat cutout through
+            loose = features.score_chunk(
+                chunk, thresholds={"brightness": 255, "contrast": 0}
+            )
+
+        self.assertEqual([result[2]["stage"] for result in results], [0, 0])
+        self.assertEqual(results[1][2]["num_circles"], 0)
+        self.assertEqual([result[2]["stage"] for result in loose], [0, 1])
+        self.assertIn("2 rejected at preview", features.cascade_report([0, 0]))
+
+    def test_batch_attributes_are_deterministic_and_robust(self):
+        rng = np.random.default_rng(1)
+        stack = rng.normal(100, 5, (3, 120, 90)).astype(np.float32)
+        stack[:, 50:70, 35:55] += 200  # Bright source at the centre
+        stack[1, :10] = np.nan
+
+        first = features.calculate_batch_attributes(stack)
+        self.assertEqual(first.dtype, features.feature_dtype)
+        np.testing.assert_array_equal(first, features.calculate_batch_attributes(stack))
+        # The source barely moves the MAD noise or the clipped background
+        np.testing.assert_allclose(first["noise"], 5, rtol=0.15)
+        np.testing.assert_allclose(first["background"], 100, atol=1)
+        self.assertTrue(np.all(first["centre_contrast"] > 10))
+        # Ranking's window spread stays close to the old random window's
+        image = rng.normal(100, 20, (500, 500, 3)).clip(0, 255).astype(np.uint8)
+        window_noise = features.calculate_image_attributes(image)["window_noise"]
+        self.assertAlmostEqual(window_noise, np.std(image[150:350, 150:350]), delta=1)
+
+        # Images smaller than the old 200px noise window work too
+        small = features.calculate_image_attributes(np.full((20, 20, 3), 7, np.uint8))
+        self.assertEqual(small["brightness"], 7)
+        self.assertEqual(small["noise"], 0)
+
+    def test_detect_arcs_counts_arcs_around_the_centre(self):
+        rng = np.random.default_rng(2)
+        y, x = np.mgrid[:300, :300] - 149.5
+        radius, angle = np.hypot(y, x), np.arctan2(y, x)
+        image = rng.normal(100, 10, (300, 300))
+        # A central star is a halo, not a shock
+        image += 150 * np.exp(-(radius**2) / 500)
+        self.assertEqual(features.detect_arcs(image), 0)
+
+        image[(abs(radius - 60) < 3) & (abs(angle) < 1)] += 40
+        self.assertEqual(features.detect_arcs(image), 1)
+        image[(abs(radius - 110) < 3) & (abs(angle - 2.5) < 0.8)] += 40
+        self.assertEqual(features.detect_arcs(image.clip(0, 255).astype(np.uint8)), 2)
+
+
+class TestClassifier(unittest.TestCase):
+    def test_preprocess_matches_model_input(self):
+        image = classifier.preprocess(np.full((300, 200), 128, dtype=np.uint8))
+        self.assertEqual(image.shape, (64, 64, 3))
+        self.assertEqual(image.dtype, np.float32)
+
+    def test_score_pads_to_fixed_batches(self):
+        model = classifier.Classifier.__new__(classifier.Classifier)
+        model.batch_size = 4
+        shapes = []
+
+        def run_batch(batch):
+            shapes.append(batch.shape)
+            return batch.mean(axis=(1, 2, 3))[:, None]
+
+        model.run_batch = run_batch
+        images = [np.full((100, 100, 3), value, dtype=np.uint8) for value in range(6)]
+        probabilities = model.score(images)
+        self.assertEqual(len(probabilities), 6)
+        self.assertEqual(shapes, [(4, 64, 64, 3)] * 2)
+        self.assertTrue(all(isinstance(value, float) for value in probabilities))
+
+
+class TestSynthetic(unittest.TestCase):
+    def test_batches_are_reproducible(self):
+        backgrounds = np.full((3, 64, 64, 3), 0.2, dtype=np.float32)
+        images, labels = next(synthetic.stream(backgrounds, size=16, seed=1))
+        again, _ = next(synthetic.stream(backgrounds, size=16, seed=1))
+        self.assertEqual(images.shape, (16, 64, 64, 3))
+        self.assertEqual(images.dtype, np.float32)
+        self.assertEqual(set(labels), {0.0, 1.0})
+        np.testing.assert_array_equal(images, again)
+        self.assertEqual(backgrounds.max(), np.float32(0.2))
+
+    def test_only_positives_get_arcs(self):
+        backgrounds = np.full((1, 64, 64, 3), 0.2, dtype=np.float32)
+        with mock.patch.object(synthetic, "noise_range", (0.0, 0.0)):
+            images, labels = synthetic.synthetic_batch(
+                backgrounds, np.random.default_rng(0), 32
+            )
+        excess = (images - 0.2).max(axis=(1, 2, 3))
+        self.assertTrue(np.all(excess[labels == 1] > 0.02))
+        self.assertTrue(np.allclose(excess[labels == 0], 0))
+
+
+class TestRankingIndex(unittest.TestCase):
+    def attributes(self, brightness, stage=1):
+        return {
+            "brightness": brightness,
+            "contrast": 10.0,
+            "noise": 5.0,
+            "window_noise": 8.0,
+            "num_circles": None,
+            "stage": stage,
+        }
+
+    def test_updates_keep_orders_sorted(self):
+        attributes = {}
+        index = ranking.RankingIndex(["A", "B", "C"], attributes)
+        self.assertEqual(index.ranking("S", "default")[0], ["A", "B", "C"])
+
+        attributes["C"] = {"S": self.attributes(10.0)}
+        index.update("C", "S")
+        attributes["B"] = {"S": self.attributes(20.0)}
+        index.update("B", "S")
+        pulsars, positions = index.ranking("S", "default")
+        self.assertEqual(pulsars, ["C", "B", "A"])
+        self.assertEqual(positions["A"], 2)
+
+        attributes["C"]["S"].update(stage=0)
+        index.update("C", "S")
+        self.assertEqual(index.ranking("S", "default")[0], ["B", "C", "A"])
+        # Other surveys and the alphabetical order are untouched
+        self.assertEqual(index.ranking("T", "default")[0], ["A", "B", "C"])
+        self.assertEqual(index.ranking("S", "alphabetical")[0], ["A", "B", "C"])
+
+    def test_nan_attributes_sort_last_and_update_cleanly(self):
+        attributes = {
+            "A": {"S": self.attributes(float("nan"))},
+            "B": {"S": self.attributes(20.0)},
+        }
+        index = ranking.RankingIndex(["A", "B", "C"], attributes)
+        self.assertEqual(index.ranking("S", "brightness")[0], ["B", "A", "C"])
+        attributes["A"]["S"].update(brightness=10.0)
+        index.update("A", "S")
+        attributes["B"]["S"].update(brightness=float("nan"))
+        index.update("B", "S")
+        order = index.order("S", "brightness")
+        self.assertEqual([pulsar for _, pulsar in order], ["A", "B", "C"])
+        self.assertEqual(order, sorted(order))
+
+    def test_best_rank_across_surveys(self):
+        attributes = {
+            "A": {"S": self.attributes(50.0), "T": self.attributes(50.0)},
+            "B": {"S": self.attributes(10.0)},
+            "C": {"T": self.attributes(20.0)},
+        }
+        index = ranking.RankingIndex(["A", "B", "C", "D"], attributes)
+        # B and C both rank first once, and A is second in both surveys
+        self.assertEqual(index.ranking(None, "best")[0], ["B", "C", "A", "D"])
+        attributes["A"]["T"].update(brightness=1.0)
+        index.update("A", "T")
+        self.assertEqual(index.ranking(None, "best")[0], ["A", "B", "C", "D"])
+
+
+class TestContinuum(unittest.TestCase):
+    def make_pair(self, rng, count):
+        broad = (1000 + rng.gamma(2, 5, (count, 80, 80))).astype(np.float32)
+        narrow = 0.08 * broad + 5 + rng.normal(0, 0.1, broad.shape)
+        narrow[:, 40:43, 20:60] += 50  # Line emission only in the narrow band
+        return narrow.astype(np.float32), broad
+
+    def test_fit_ignores_line_emission(self):
+        narrow, broad = self.make_pair(np.random.default_rng(0), 3)
+        scale, offset = continuum.fit_continuum(narrow, broad)
+        np.testing.assert_allclose(scale, 0.08, rtol=1e-2)
+        subtracted = continuum.subtract(narrow, broad)
+        self.assertTrue(np.all(subtracted[:, 41, 20:60] > 45))
+        self.assertLess(np.abs(subtracted[:, :30]).mean(), 0.2)
+
+    def test_writes_pseudo_survey_once(self):
+        narrow, broad = self.make_pair(np.random.default_rng(1), 2)
+        with tempfile.TemporaryDirectory() as folder:
+            for pulsar, narrow_data, broad_data in zip(["J1", "J2"], narrow, broad):
+                for survey, data in [
+                    ("CDS/P/VPHAS/DR4/Halpha", narrow_data),
+                    ("CDS/P/VPHAS/DR4/r", broad_data),
+                ]:
+                    path = os.path.join(
+                        folder, pulsars.image_filename(pulsar, survey, "fits")
+                    )
+                    cutouts.save_cutout(path, data)
+
+            self.assertEqual(continuum.ContinuumSubtractor(folder).run(), 2)
+            subtractor = continuum.ContinuumSubtractor(folder)
+            self.assertIn(
+                ("J1", "CDS/P/VPHAS/DR4/Halpha/subtracted", 1), subtractor.images
+            )
+            self.assertEqual(subtractor.run(), 0)
+            self.assertEqual(subtractor.run(force=True), 2)
+
+
+class TestStretch(unittest.TestCase):
+    def test_default_lut_is_identity(self):
+        image = np.arange(256, dtype=np.uint8).reshape(16, 16)
+        low, high = stretch.interval(image)
+        lut = stretch.stretch_lut(np.arange(256), low, high)
+        np.testing.assert_array_equal(lut, np.arange(256))
+
+    def test_lut_matches_image_enhance(self):
+        rng = np.random.default_rng(0)
+        image = Image.fromarray(rng.integers(0, 256, (64, 64, 3), dtype=np.uint8))
+        expected = ImageEnhance.Contrast(image).enhance(1.4)
+        expected = ImageEnhance.Brightness(expected).enhance(0.8)
+        lut = stretch.stretch_lut(
+            np.arange(256),
+            0,
+            255,
+            contrast=1.4,
+            brightness=0.8,
+            histogram=image.convert("L").histogram(),
+        )
+        result = image.point(lut.tolist() * 3)
+        difference = np.abs(
+            np.asarray(result, dtype=int) - np.asarray(expected, dtype=int)
+        )
+        self.assertLessEqual(difference.max(), 1)
+
+    def test_flux_is_quantized_between_limits(self):
+        flux = np.array([[np.nan, -5.0], [0.0, 10.0]], dtype=np.float32)
+        codes = stretch.quantize(flux, 0.0, 10.0)
+        self.assertEqual(codes.tolist(), [[0, 0], [0, stretch.float_levels - 1]])
+        values = stretch.level_values(0.0, 10.0)
+        for name in stretch.stretches:
+            lut = stretch.stretch_lut(values, 0.0, 10.0, name)
+            self.assertEqual((lut[0], lut[-1]), (0, 255))
+            self.assertTrue(np.all(np.diff(lut.astype(int)) >= 0))
+
+
+class TestImageCache(unittest.TestCase):
+    def test_evicts_least_recently_used_over_budget(self):
+        cache = imagecache.ImageCache(budget=100)
+        cache.put("A", "a", 40)
+        cache.put("B", "b", 40)
+        self.assertEqual(cache.get("A"), "a")
+        cache.put("C", "c", 40)
+        self.assertNotIn("B", cache)
+        self.assertEqual(cache.size, 80)
+        self.assertIsNone(cache.get("B"))
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 1))
+
+    def test_keeps_newest_entry_over_budget(self):
+        cache = imagecache.ImageCache(budget=10)
+        cache.put("A", "a", 5)
+        cache.put("B", "b", 50)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.get("B"), "b")
+        cache.discard("B")
+        cache.discard("B")
+        self.assertEqual((len(cache), cache.size), (0, 0))
+
+
+class TestDenoise(unittest.TestCase):
+    def test_keeps_colour_and_greyscale(self):
+        rng = np.random.default_rng(0)
+        grey = rng.integers(0, 256, (40, 40), dtype=np.uint8)
+        rgb = np.repeat(grey[..., None], 3, axis=2)
+        result = denoise.denoise_array(rgb, search_window=7)
+        self.assertEqual(result.shape, (40, 40, 3))
+        np.testing.assert_array_equal(result[..., 0], result[..., 2])
+
+        colour = rng.integers(0, 256, (40, 40, 3), dtype=np.uint8)
+        result = denoise.denoise_array(colour, search_window=7)
+        self.assertFalse(np.array_equal(result[..., 0], result[..., 2]))
+        self.assertEqual(denoise.denoise_array(grey.astype(np.float32)).ndim, 2)
+
+    def test_denoise_all_writes_derived_survey(self):
+        with tempfile.TemporaryDirectory() as folder:
+            image = np.random.default_rng(1).integers(0, 256, (40, 40, 3), np.uint8)
+            Image.fromarray(image).save(os.path.join(folder, "J1_CDS-P-SHS.jpg"))
+            Image.fromarray(image).save(os.path.join(folder, "J1_CDS-P-SHS@5.jpg"))
+            self.assertEqual(
+                set(denoise.find_sources(folder)),
+                {("J1", "CDS/P/SHS", 1), ("J1", "CDS/P/SHS", 5)},
+            )
+            self.assertEqual(denoise.denoise_all(folder, workers=1), 2)
+            for name in ("J1_CDS-P-SHS-denoised.jpg", "J1_CDS-P-SHS-denoised@5.jpg"):
+                self.assertTrue(os.path.exists(os.path.join(folder, name)))
+            # Up to date, and derived surveys are not denoised again
+            self.assertEqual(denoise.denoise_all(folder, workers=1), 0)
+
+
+class TestFeatureStore(unittest.TestCase):
+    def test_reuses_current_columns_only(self):
+        attributes = {name: 1.0 for name in features.feature_versions}
+        with tempfile.TemporaryDirectory() as folder:
+            store = featurestore.FeatureStore(folder)
+            store.record("J1", "CDS/P/SHS", "a", attributes)
+            store.record("J1", "CDS/P/SHS", "a", {"noise": 4.0})
+
+            store = featurestore.FeatureStore(folder)
+            cached, missing = store.lookup("J1", "CDS/P/SHS", "a")
+            self.assertEqual(cached, {**attributes, "noise": 4.0})
+            self.assertEqual(missing, [])
+
+            # A changed image invalidates everything stored for it
+            self.assertEqual(
+                store.lookup("J1", "CDS/P/SHS", "b")[1],
+                features.eager_features,
+            )
+
+            # A bumped feature version invalidates just that column
+            noise_version = features.feature_versions["noise"] + 1
+            with mock.patch.dict(features.feature_versions, {"noise": noise_version}):
+                cached, missing = store.lookup("J1", "CDS/P/SHS", "a")
+            self.assertEqual(missing, ["noise"])
+            self.assertNotIn("noise", cached)
+
+            store.compact()
+            with open(store.path) as f:
+                self.assertEqual(len(f.readlines()), 1)
+
+    def test_packed_slot_signature_changes_on_rewrite(self):
+        with tempfile.TemporaryDirectory() as folder:
+            store = packstore.PackedStore(folder)
+            store.put("J1", "CDS/P/SHS", 1, np.zeros((4, 4), np.uint8))
+            before = featurestore.source_signature(("J1", "CDS/P/SHS", 1), store)
+            store.put("J1", "CDS/P/SHS", 1, np.ones((4, 4), np.uint8))
+            store.flush()
+
+            reopened = packstore.PackedStore(folder)
+            after = featurestore.source_signature(("J1", "CDS/P/SHS", 1), reopened)
+            self.assertNotEqual(before, after)
+            self.assertEqual(after, store.signature("J1", "CDS/P/SHS", 1))
+
+
+class FakeEngine:
+    batch_size = 2
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def list_pulsars(self, options):
+        return ["J0001+0001", "J0002+0002", "J0003+0003"]
+
+    def resolve(self, pulsars):
+        return {pulsar: {"RA": 1.0, "DEC": 2.0} for pulsar in pulsars}
+
+    def prune(self, jobs, coordinates, fov, manifest=None):
+        return jobs, {}
+
+    def fetch(self, pulsar, survey, fov, coordinates, manifest, coverage, image_format):
+        # Brightness grows with the pulsar number, so the ranking is known
+        level = int(pulsar[1:5]) * 40
+        image = np.random.default_rng(0).normal(level, 5, (250, 250, 3))
+        image = image.clip(0, 255).astype(np.uint8)
+        path = os.path.join(self.folder, pulsars.image_filename(pulsar, survey))
+        Image.fromarray(image).save(path)
+        manifest.record(pulsar, survey, fov, "ok", image_path=path)
+        return "ok"
+
+    def close(self):
+        pass
+
+
+class TestPipeline(unittest.TestCase):
+    def test_pipeline_streams_to_ranked_table(self):
+        with tempfile.TemporaryDirectory() as folder:
+            output = os.path.join(folder, "candidates.csv")
+            with mock.patch.object(pipeline, "image_folder", folder):
+                run = pipeline.Pipeline(
+                    ["CDS/P/SHS", "CDS/P/allWISE/W3"],
+                    download_workers=2,
+                    score_workers=2,
+                    engine=FakeEngine(folder),
+                )
+                rows = run.run({}, output)
+            self.assertTrue(os.path.exists(output))
+
+        self.assertEqual(len(rows), 6)
+        self.assertEqual([row["rank"] for row in rows], list(range(1, 7)))
+        self.assertEqual(rows[0]["pulsar"], "J0001+0001")
+        self.assertEqual(rows[-1]["pulsar"], "J0003+0003")
+        self.assertEqual(rows[0]["ra"], 1.0)
+        self.assertEqual({row["stage"] for row in rows}, {1})
+
+
+class TestDownloadManifest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.folder = self.temp_dir.name
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_resume_skips_recorded_and_refetches_stale(self):
+        image_path = os.path.join(self.folder, "J1821-0331_CDS-P-SHS.jpg")
+        with open(image_path, "wb") as f:
+            f.write(b"cutout")
+
+        first = manifest.DownloadManifest(self.folder)
+        first.record("J1821-0331", "CDS/P/SHS", 1, "ok", image_path=image_path)
+        first.record("J1825-0935", "CDS/P/SHS", 1, "blank")
+        first.record("J1830-1059", "CDS/P/SHS", 1, "failed", error="timeout")
+
+        # A fresh run reads the same state back from disk
+        resumed = manifest.DownloadManifest(self.folder)
+        self.assertFalse(resumed.needs_fetch("J1821-0331", "CDS/P/SHS", "1"))
+        self.assertFalse(resumed.needs_fetch("J1825-0935", "CDS/P/SHS", 1))
+        self.assertFalse(resumed.needs_fetch("J1830-1059", "CDS/P/SHS", 1))
+        self.assertTrue(resumed.needs_fetch("J1821-0331", "CDS/P/SHS", 2))
+
+        with open(image_path, "wb") as f:
+            f.write(b"a different cutout")
+        self.assertTrue(resumed.needs_fetch("J1821-0331", "CDS/P/SHS", 1))
+
+        with mock.patch.object(manifest, "retry_failed_after", -1):
+            self.assertTrue(resumed.needs_fetch("J1830-1059", "CDS/P/SHS", 1))
+
+    def test_each_fov_has_its_own_file(self):
+        survey = "CDS/P/VPHAS/DR4/Halpha"
+        recorder = manifest.DownloadManifest(self.folder)
+        image_files = set()
+        for fov in (1, 5, 1.5, 0.5):
+            image_path = os.path.join(
+                self.folder, pulsars.image_filename("J1821-0331", survey, fov=fov)
+            )
+            image_files.add(image_path)
+            with open(image_path, "wb") as f:
+                f.write(f"cutout at {fov}".encode())
+            recorder.record("J1821-0331", survey, fov, "ok", image_path=image_path)
+            self.assertEqual(
+                pulsars.parse_image_filename(os.path.basename(image_path)),
+                ("J1821-0331", survey, None if fov == 1 else fov),
+            )
+        self.assertEqual(len(image_files), 4)
+
+        resumed = manifest.DownloadManifest(self.folder)
+        for fov in (1, 5, 1.5, 0.5, "1.5"):
+            self.assertFalse(resumed.needs_fetch("J1821-0331", survey, fov))
+        self.assertTrue(resumed.needs_fetch("J1821-0331", survey, 2))
+
+    def test_each_format_is_fetched_once(self):
+        recorder = manifest.DownloadManifest(self.folder)
+        for image_format, extension in [("jpg", ".jpg"), ("fits", ".npy")]:
+            self.assertTrue(recorder.needs_fetch("J1", "CDS/P/SHS", 1, extension))
+            image_path = os.path.join(
+                self.folder, pulsars.image_filename("J1", "CDS/P/SHS", image_format)
+            )
+            with open(image_path, "wb") as f:
+                f.write(image_format.encode())
+            recorder.record("J1", "CDS/P/SHS", 1, "ok", image_path=image_path)
+
+        resumed = manifest.DownloadManifest(self.folder)
+        self.assertFalse(resumed.needs_fetch("J1", "CDS/P/SHS", 1, ".jpg"))
+        self.assertFalse(resumed.needs_fetch("J1", "CDS/P/SHS", 1, ".npy"))
+        resumed.record("J1", "CDS/P/SHS", 1, "failed", error="timeout")
+        self.assertFalse(resumed.needs_fetch("J1", "CDS/P/SHS", 1, ".jpg"))
+
+    def test_reads_entries_with_a_single_file(self):
+        image_path = os.path.join(self.folder, "J1_CDS-P-SHS.jpg")
+        with open(image_path, "wb") as f:
+            f.write(b"cutout")
+        stat = os.stat(image_path)
+        entry = {
+            "key": ["J1", "CDS/P/SHS", 1],
+            "status": "ok",
+            "time": time.time(),
+            "file": "J1_CDS-P-SHS.jpg",
+            "sha256": hashlib.sha256(b"cutout").hexdigest(),
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+        }
+        with open(os.path.join(self.folder, manifest.manifest_name), "w") as f:
+            f.write(json.dumps(entry) + "\n")
+
+        resumed = manifest.DownloadManifest(self.folder)
+        self.assertFalse(resumed.needs_fetch("J1", "CDS/P/SHS", 1, ".jpg"))
+        self.assertTrue(resumed.needs_fetch("J1", "CDS/P/SHS", 1, ".npy"))
+
+
+class TestCatalogueSnapshot(unittest.TestCase):
+    database = """#CATALOGUE 2.1.1
+PSRJ     J1821-0331                    xx+13
+RAJ      18:21:44.7               1.000e-01   xx+13
+DECJ     -03:31:12.7              3            xx+13
+DATE     2013                      xx+13
+@-----------------------------------------------------------------
+PSRJ     J0534+2200                    xx+68
+PSRB     B0531+21                      xx+68
+RAJ      05:34:31.973             5.000e-03   xx+68
+DECJ     +22:00:52.06             6.000e-02   xx+68
+DATE     1968                      xx+68
+@-----------------------------------------------------------------
+PSRJ     J1825-0935
+DATE     2015
+@-----------------------------------------------------------------
+"""
+
+    def setUp(self):
+        self.catalogue = catalogue.parse_database(self.database)
+
+    def test_parses_columns(self):
+        self.assertEqual(self.catalogue.version, "2.1.1")
+        self.assertEqual(len(self.catalogue), 3)
+        i = self.catalogue.index["J1821-0331"]
+        self.assertAlmostEqual(self.catalogue.ra[i], 275.43625)
+        self.assertAlmostEqual(self.catalogue.dec[i], -3.5201944, places=6)
+        # "3" is in units of the last quoted digit
+        self.assertAlmostEqual(self.catalogue.dec_error[i], 0.3)
+
+    def test_filters_match_psrcat_conditions(self):
+        options = {
+            "max_dec": "0",
+            "min_dec": "-90",
+            "max_gb": 5,
+            "min_gb": -5,
+            "min_year": 2012,
+            "max_error": 1,
+            "pulsar_name": "",
+        }
+        self.assertEqual(self.catalogue.query(options), ["J1821-0331"])
+        self.assertEqual(
+            self.catalogue.query({"pulsar_name": "PSR B0531+21"}), ["J0534+2200"]
+        )
+        self.assertEqual(
+            list(self.catalogue.coordinates(["J1825-0935", "J0534+2200"])),
+            ["J0534+2200"],
+        )
+
+    def test_snapshot_round_trip(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "psrcat_2.1.1.npz")
+            self.catalogue.save(path)
+            loaded = catalogue.Catalogue.load(path)
+        self.assertEqual(loaded.version, "2.1.1")
+        self.assertEqual(loaded.name.tolist(), self.catalogue.name.tolist())
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -1,8 +1,117 @@
+import os
+import csv
+import zlib
+import argparse
 import tensorflow as tf
-from tensorflow.keras.preprocessing.image import ImageDataGenerator
 from tensorflow.keras.models import Sequential
 from tensorflow.keras.layers import Conv2D, MaxPooling2D, Flatten, Dense, Dropout
 
+image_extensions = (".jpg", ".jpeg", ".png")
+batch_size = 32
+shuffle_buffer = 4096
+validation_split = 0.2
+
+
+def is_validation(name, split=validation_split):
+    # Hashing the name keeps each image on the same side of the split
+    # between runs, machines and newly added data
+    return zlib.crc32(name.encode()) % 1000 < split * 1000
+
+
+def labelled_files(folder):
+    # One subfolder per class in alphabetical order, like flow_from_directory
+    classes = sorted(
+        name for name in os.listdir(folder) if os.path.isdir(os.path.join(folder, name))
+    )
+    paths, labels = [], []
+    for label, name in enumerate(classes):
+        for root, _, files in os.walk(os.path.join(folder, name)):
+            for file in sorted(files):
+                if file.lower().endswith(image_extensions):
+                    paths.append(os.path.join(root, file))
+                    labels.append(float(label))
+    print(f"Found {len(paths)} images in classes {classes}")
+    return paths, labels
+
+
+def folder_datasets(folder, image_size):
+    paths, labels = labelled_files(folder)
+
+    def decode(path, label):
+        image = tf.io.decode_image(
+            tf.io.read_file(path), channels=3, expand_animations=False
+        )
+        image = tf.image.resize(image, image_size, method="nearest")
+        return tf.cast(image, tf.float32) / 255, label
+
+    datasets = []
+    for validation in (False, True):
+        subset = [
+            (path, label)
+            for path, label in zip(paths, labels)
+            if is_validation(os.path.relpath(path, folder).replace(os.sep, "/"))
+            == validation
+        ]
+        subset_paths = [path for path, _ in subset]
+        subset_labels = [label for _, label in subset]
+        dataset = tf.data.Dataset.from_tensor_slices((subset_paths, subset_labels))
+        datasets.append(dataset.map(decode, num_parallel_calls=tf.data.AUTOTUNE))
+    return datasets
+
+
+def packed_datasets(folder, labels_path, image_size):
+    # Labels come from a CSV of pulsar,survey,label[,fov] rows, and the
+    # cutouts are read pack by pack in slot order from the memory maps
+    from classifier import preprocess
+    from manifest import DownloadManifest
+    from packstore import PackedStore
+
+    with open(labels_path, newline="") as f:
+        labels = {
+            DownloadManifest.key(
+                row["pulsar"], row["survey"], row.get("fov") or 1
+            ): float(row["label"])
+            for row in csv.DictReader(f)
+        }
+    store = PackedStore(folder)
+    missing = [key for key in labels if key not in store.index]
+    if missing:
+        print(f"{len(missing)} labelled cutouts are not in {folder}")
+
+    def cutouts(validation):
+        for keys, stack in store.stacks():
+            for key, data in zip(keys, stack):
+                if key in labels and is_validation("_".join(key[:2])) == validation:
+                    yield preprocess(data), labels[key]
+
+    signature = (
+        tf.TensorSpec((*image_size, 3), tf.float32),
+        tf.TensorSpec((), tf.float32),
+    )
+    return [
+        tf.data.Dataset.from_generator(
+            lambda validation=validation: cutouts(validation),
+            output_signature=signature,
+        )
+        for validation in (False, True)
+    ]
+
+
+def input_pipeline(train, validation, cache=""):
+    # Decoded, resized images are cached after the first epoch, in memory or
+    # in files under cache, then shuffled, batched and prefetched from there
+    if cache:
+        os.makedirs(cache, exist_ok=True)
+        train = train.cache(os.path.join(cache, "train"))
+        validation = validation.cache(os.path.join(cache, "validation"))
+    else:
+        train, validation = train.cache(), validation.cache()
+    train = train.shuffle(shuffle_buffer, reshuffle_each_iteration=True)
+    return (
+        train.batch(batch_size).prefetch(tf.data.AUTOTUNE),
+        validation.batch(batch_size).prefetch(tf.data.AUTOTUNE),
+    )
+
 
 def create_model(image_width, image_height):
     model = Sequential(
@@ -28,38 +137,67 @@ def create_model(image_width, image_height):
     return model
 
 
-def main():
-    # Set the dimensions to which all images will be resized
-    image_width, image_height = 64, 64
-
-    datagen = ImageDataGenerator(rescale=1.0 / 255, validation_split=0.2)
+def train_synthetic(model, args):
+    # Arcs injected into real cutouts from images/, generated as training
+    # runs rather than read from disk
+    from synthetic import dataset, load_backgrounds, stream
 
-    train_generator = datagen.flow_from_directory(
-        "path_to_data",
-        target_size=(image_width, image_height),
-        batch_size=32,
-        class_mode="binary",
-        subset="training",
+    backgrounds = load_backgrounds(args.backgrounds)
+    print(f"Generating bow shocks on {len(backgrounds)} backgrounds")
+    # A fixed validation set, from a seed none of the training streams use
+    validation = next(stream(backgrounds, size=1024, seed=2**32))
+    return model.fit(
+        dataset(backgrounds),
+        steps_per_epoch=args.steps,
+        epochs=args.epochs,
+        validation_data=validation,
     )
 
-    validation_generator = datagen.flow_from_directory(
-        "path_to_data",
-        target_size=(image_width, image_height),
-        batch_size=32,
-        class_mode="binary",
-        subset="validation",
+
+def main():
+    parser = argparse.ArgumentParser(description="Train the bow shock classifier")
+    parser.add_argument(
+        "--data", default="path_to_data", help="A folder with one subfolder per class"
+    )
+    parser.add_argument(
+        "--packed", help="Read cutouts from this packed store instead of --data"
+    )
+    parser.add_argument("--labels", help="CSV of pulsar,survey,label for --packed")
+    parser.add_argument(
+        "--cache",
+        default="",
+        help="Cache preprocessed images in this folder, else in memory. Delete it "
+        "after changing the data",
+    )
+    parser.add_argument("--epochs", type=int, default=10)
+    parser.add_argument(
+        "--synthetic",
+        action="store_true",
+        help="Train on generated bow shocks instead of --data",
     )
+    parser.add_argument("--backgrounds", default="images")
+    parser.add_argument("--steps", type=int, default=500)
+    args = parser.parse_args()
+
+    # Set the dimensions to which all images will be resized
+    image_width, image_height = 64, 64
 
     model = create_model(image_width, image_height)
     model.summary()
 
-    history = model.fit(
-        train_generator,
-        steps_per_epoch=train_generator.n // train_generator.batch_size,
-        epochs=10,
-        validation_data=validation_generator,
-        validation_steps=validation_generator.n // validation_generator.batch_size,
-    )
+    if args.synthetic:
+        train_synthetic(model, args)
+    else:
+        if args.packed:
+            if not args.labels:
+                parser.error("--packed needs --labels")
+            train, validation = packed_datasets(
+                args.packed, args.labels, (image_width, image_height)
+            )
+        else:
+            train, validation = folder_datasets(args.data, (image_width, image_height))
+        train, validation = input_pipeline(train, validation, args.cache)
+        history = model.fit(train, epochs=args.epochs, validation_data=validation)
 
     # Save the model
     model.save("pulsar_bow_shock_classifier.h5")